@@ -11,6 +11,7 @@ from twisted.python import failure
 from twisted.conch.ssh import filetransfer
 from twisted.internet.error import TimeoutError
 import fnmatch
+import os
 import stat
 
 # Local Code
@@ -18,7 +19,20 @@ from transport import SSHTransport
 from connection import Connection
 from auth import PasswordAuth
 from channel import CommandChannel
+from channel import StreamingCommandChannel
 from channel import SFTPChannel
+from channel import _CallableConsumer
+from channel import PRIORITY_INTERACTIVE, PRIORITY_BULK
+from channel import CAPTURE_ALL, CAPTURE_DISCARD, CAPTURE_HEAD, CAPTURE_TAIL
+from cache import SingleFlight
+from lines import LineConsumer, LineIterator, DEFAULT_MAX_BATCHES
+from shell import ShellChannel
+from batch import BatchChannel
+from tree import GetTree, PutTree, DEFAULT_TREE_CONCURRENCY
+from tree import SYMLINKS_COPY, SYMLINKS_FOLLOW, SYMLINKS_SKIP
+from delta import DeltaGet, DeltaPut
+from sftp import SFTPPool, DEFAULT_IDLE_TIMEOUT, DEFAULT_SFTP_REQUESTS
+from sftp import TransferChunks, RangeChunks, SFTPReader, SFTPWriter
 
 # PEP-396 version. (https://www.python.org/dev/peps/pep-0396/)
 __version__ = "1.0.1"
@@ -40,11 +54,24 @@ class SSHClient(ReconnectingClientFactory):
         #           'user': 'user',
         #           'password': 'password',
         #           'identities': ['~/.ssh/id_rsa', '~/.ssh/id_dsa']
-        #           'buffersize': 32768}
+        #           'buffersize': 32768,
+        #           'spoolsize': 64 * 1024 * 1024,
+        #           'maxchannels': 10,
+        #           'maxqueue': None,
+        #           'coalesce': False,
+        #           'windowsize': None,
+        #           'maxpacket': None,
+        #           'autotune': False,
+        #           'maxwindowsize': 16 * 1024 * 1024,
+        #           'sftpminidle': 0,
+        #           'sftpmaxsize': 1,
+        #           'sftpidletimeout': 300,
+        #           'sftprequests': 64}
 
         # Defaults
         self.connectionTimeout = 100  # Connection timeout in seconds
         self.commandTimeout = None  # Timeout for the commands in seconds
+        self.resultCache = None  # Optional cache.ResultCache for run()
         self.maxDelay = 200  # Maximum delay in seconds before retrying to
                             # connect.
         # Runtime
@@ -63,9 +90,20 @@ class SSHClient(ReconnectingClientFactory):
         self.runningDeferreds = []  # Handle closing these on connection
                                     # lost or failed.
 
+        # Identical run()/get() requests currently in flight
+        self.inflight = SingleFlight(self.reactor)
+
         # Deferred that fires if the connection is ready
         self.dSftpclient = None
 
+        # SFTP channels shared by the file operations
+        self.sftpPool = SFTPPool(
+            minIdle=self.options.get('sftpminidle', 0),
+            maxSize=self.options.get('sftpmaxsize', 1),
+            idleTimeout=self.options.get('sftpidletimeout',
+                                         DEFAULT_IDLE_TIMEOUT),
+            reactor=self.reactor)
+
         # Initialize the deferreds
         self.resetConnection()
 
@@ -99,6 +137,9 @@ class SSHClient(ReconnectingClientFactory):
         dConnected, self.dConnected = self.dConnected, defer.Deferred()
         dSftpclient, self.dSftpclient = self.dSftpclient, None
 
+        # Open the pre-warmed SFTP sessions before any queued operation
+        self.dConnected.addCallback(self._cbWarmSFTP)
+
         self.dTransport.addCallback(self._startConnection,
                                     self.dConnected)
 
@@ -165,14 +206,99 @@ class SSHClient(ReconnectingClientFactory):
 
     # Begin Helper callbacks
     # ------------------------------------------------------------------
-    def _cbRun(self, connection, command, result, timeout=None):
+    def _cbRun(self, connection, command, result, timeout=None,
+               spoolSize=None, priority=PRIORITY_INTERACTIVE, channels=None,
+               stdin=None, capture=CAPTURE_ALL, captureSize=None, parser=None):
+        if result.called:
+            # Cancelled before we got connected.
+            return connection
         log.debug('_cbRun: Creating Command Channel')
         channel = CommandChannel(command, result, conn=connection,
-                                 timeout=timeout)
+                                 timeout=timeout, spoolSize=spoolSize,
+                                 priority=priority, stdin=stdin,
+                                 capture=capture, captureSize=captureSize,
+                                 parser=parser)
+        if channels is not None:
+            channels.append(channel)
         if connection:
+            # The timeout includes time queued behind maxchannels.
+            channel.startTimer()
             connection.openChannel(channel)
         return connection
 
+    def _cancelRun(self, channels):
+        for channel in channels:
+            channel.loseConnection()
+
+    def _cbStream(self, connection, command, consumer, errConsumer, result,
+                  timeout=None, stdin=None):
+        log.debug('_cbStream: Creating Streaming Command Channel')
+        channel = StreamingCommandChannel(command, result, consumer,
+                                          errConsumer=errConsumer,
+                                          conn=connection,
+                                          timeout=timeout,
+                                          stdin=stdin)
+        if connection:
+            channel.startTimer()
+            connection.openChannel(channel)
+        return connection
+
+    def _cbWarmSFTP(self, connection):
+        if connection:
+            self.sftpPool.warm(connection)
+        return connection
+
+    def _cbOpenChannel(self, connection, channel):
+        log.debug('_cbOpenChannel: Opening %s' % channel)
+        if connection:
+            connection.openChannel(channel)
+        return connection
+
+    def _cacheKey(self, value):
+        return (self.host, self.port, self.options['user'], value)
+
+    def _cachedRun(self, ttl, tags, command, *args):
+        key = self._cacheKey(command)
+        results, fresh = self.resultCache.get(key)
+        if results is None:
+            d = self._run(command, *args)
+            d.addCallback(self._cbCacheResults, key, ttl, tags)
+            return d
+        if not fresh and self.resultCache.startRefresh(key):
+            log.debug('run: refreshing stale cached result for %s' % command)
+            d = self._run(command, *args)
+            d.addCallback(self._cbCacheResults, key, ttl, tags)
+            d.addErrback(self._ebCacheRefresh, key)
+        return defer.succeed(results)
+
+    def _cbCacheResults(self, results, key, ttl, tags):
+        # Spooled output is a file handle; it can't be handed out twice.
+        if isinstance(results.output, str) and \
+                isinstance(results.stderr, str):
+            self.resultCache.put(key, results, ttl,
+                                 [self._cacheKey(tag) for tag in tags])
+        return results
+
+    def _ebCacheRefresh(self, reason, key):
+        log.debug('Refreshing cached result failed: %s' % reason)
+        self.resultCache.refreshFailed(key)
+
+    def _cbInvalidatePaths(self, result, *paths):
+        self.invalidatePaths(*paths)
+        return result
+
+    def _cbRunManyResult(self, result, index, onResult):
+        onResult(index, result)
+        return result
+
+    def _cbRunManyDone(self, results):
+        return [result for success, result in results]
+
+    def _ebBatch(self, reason, channel):
+        # The commands have their own deferreds; make sure they fire.
+        log.debug('Batch failed: %s' % reason)
+        channel.failPending(reason)
+
     def _cbreadfile(self, files, l, directory, glob):
         'Recursively scan the directories'
         if not isinstance(files, failure.Failure):
@@ -202,6 +328,9 @@ class SSHClient(ReconnectingClientFactory):
 
     def _cbdone(self, result, callback):
         'Callback to store the results'
+        if callback.called:
+            # Timed out or cancelled already
+            return
         if isinstance(result, failure.Failure):
             callback.errback(result)
         else:
@@ -218,6 +347,24 @@ class SSHClient(ReconnectingClientFactory):
         client.makeLink(source, destination).addBoth(self._cbdone, result)
         return client
 
+    def _cbstat(self, client, path, followLinks, result):
+        log.debug('_cbstat: %s' % path)
+        d = client.getAttrs(path, followLinks)
+        d.addBoth(self._cbdone, result)
+        return d
+
+    def _cbreadlink(self, client, path, result):
+        log.debug('_cbreadlink: %s' % path)
+        d = client.readLink(path)
+        d.addBoth(self._cbdone, result)
+        return d
+
+    def _cbutime(self, client, path, atime, mtime, result):
+        log.debug('_cbutime: %s %s %s' % (path, atime, mtime))
+        d = client.setAttrs(path, {'atime': int(atime), 'mtime': int(mtime)})
+        d.addBoth(self._cbdone, result)
+        return d
+
     def _cbchown(self, client, path, owner, result):
         log.debug('_cbchown: Setting %s ownership to %s' % (path, owner))
         owner = int(owner)
@@ -226,120 +373,250 @@ class SSHClient(ReconnectingClientFactory):
         d.addBoth(self._cbdone, result)
         return d
 
-    def _cbgetopenfile(self, remote, local):
+    def _cbgetopenfile(self, remote, local, verify=0):
         'get remote file'
         d = remote.getAttrs()
-        d.addCallback(self._cbGetFileSize, remote, local)
+        d.addCallback(self._cbGetFileSize, remote, local, verify)
         return d
 
     def _cbgetdone(self, d, remote, local):
         'Close the remote and local file handles'
         local.close()
         remote.close()
-        return
+        if isinstance(d, failure.Failure):
+            return d
 
-    def _cbGetFileSize(self, attrs, remote, local):
+    def _cbGetFileSize(self, attrs, remote, local, verify=0):
         'get remote filesize'
         if not stat.S_ISREG(attrs['permissions']):
             remote.close()
             local.close()
             return "Can't get non-regular file: %s" % remote.name
         remote.size = attrs['size']
-        remote.total = 0.0
-        bufSize = int(self.options['buffersize'] or 32768)
-        chunks = []
-        d = self._cbgetread('', remote, local, chunks, 0, bufSize, remote.size)
-        d.addCallback(self._cbgetdone, remote, local)
-        return d
-
-    def _getNextChunk(self, chunks):
-        'chunk index'
-        end = 0
-        for chunk in chunks:
-            try:
-                if chunk[1] == 'eof':
-                    return
-            except Exception:
-                pass
-            if end == 'eof':
-                return  # nothing more to get
-            if end != chunk[0]:
-                i = chunks.index(chunk)
-                chunks.insert(i, (end, chunk[0]))
-                return (end, chunk[0] - end)
-            end = chunk[1]
-        bufSize = int(self.options['buffersize'] or 32768)
-        chunks.append((end, end + bufSize))
-        return (end, bufSize)
-
-    def _cbgetread(self, data, remote, local, chunks, start,
-                   bufSize, remoteSize):
-        'read chunks of bufSize from remote file'
-        if data and isinstance(data, failure.Failure):
-            reason = data
-            reason.trap(EOFError)
-            i = chunks.index((start, start + bufSize))
-            del chunks[i]
-            chunks.insert(i, (start, 'eof'))
-        elif data:
-            local.seek(start)
-            local.write(data)
-            if len(data) != bufSize:
-                log.debug('_cbgetread: got less than we asked for: %i < %i' %
-                          (len(data), bufSize))
-                i = chunks.index((start, start + bufSize))
-                del chunks[i]
-                chunks.insert(i, (start, start + len(data)))
-            remote.total += len(data)
-        chunk = self._getNextChunk(chunks)
-        if not chunk:
-            return
+        # A resumed get starts after what is already on disk.
+        start = local.tell()
+        if start > remote.size:
+            start = 0
+        if start and verify:
+            length = min(verify, start)
+            d = self._readRange(remote, start - length, length)
+            d.addCallback(self._cbgetverified, remote, local, start)
         else:
-            start, length = chunk
-        log.debug('_cbgetread: asking for %i -> %i' % (start, start+length))
-        d = remote.readChunk(start, length)
-        d.addBoth(self._cbgetread, remote, local, chunks, start,
-                  length, remote.size)
+            d = self._getFrom(remote, local, start)
+        d.addBoth(self._cbgetdone, remote, local)
         return d
 
+    def _cbgetverified(self, data, remote, local, start):
+        'resume at start if the local tail matches the remote data'
+        local.seek(start - len(data))
+        if local.read(len(data)) != data:
+            log.debug('_cbgetverified: %s changed, getting it again' %
+                      remote.name)
+            start = 0
+        return self._getFrom(remote, local, start)
+
+    def _getFrom(self, remote, local, start):
+        '''read a remote file into local from start on.  The data is
+           written in order, so the local file never has holes.
+        '''
+        local.seek(start)
+        local.truncate()
+        reader = SFTPReader(remote, _CallableConsumer(local.write),
+                            self._bufSize(),
+                            self._sftpRequests(remote.size - start),
+                            start=start)
+        return self._startReader(remote, reader)
+
+    def _readRange(self, remote, offset, length):
+        'read length bytes at offset from an open remote file'
+        data = []
+        reader = SFTPReader(remote, _CallableConsumer(data.append),
+                            self._bufSize(), self._sftpRequests(length),
+                            start=offset, end=offset + length)
+        d = self._startReader(remote, reader)
+        d.addCallback(lambda size: ''.join(data))
+        return d
+
+    def _bufSize(self):
+        'Bytes per SFTP read or write request'
+        return int(self.options.get('buffersize') or 32768)
+
+    def _sftpRequests(self, size):
+        '''Number of requests to keep in flight for a size byte file.
+           Small files need fewer; one more finds the EOF.  At most
+           sftprequests * buffersize bytes are held in memory.
+        '''
+        bufSize = self._bufSize()
+        requests = int(self.options.get('sftprequests') or
+                       DEFAULT_SFTP_REQUESTS)
+        return max(min(requests, size / bufSize + 1), 1)
+
+    def _cbtransferred(self, ignored, handle):
+        'Report the first error of a transfer once every request is done'
+        return handle.error
+
     def _ebcloselocalfile(self, f, local):
         'Close an open localfile on error'
         local.close()
         return f
 
-    def _cbget(self, client, source, destination, result):
+    def _cbget(self, client, sftp, source, destination, result,
+               resume=False, verify=0):
         log.debug('_cbget: Copying files from remote')
         log.debug('_cbget: remote: %s, local: %s' % (source, destination))
-        lf = open(destination, 'w')
-        lf.seek(0)
+        if resume and os.path.isfile(destination):
+            lf = open(destination, 'r+')
+            lf.seek(0, os.SEEK_END)
+        else:
+            lf = open(destination, 'w')
+            lf.seek(0)
         flags = filetransfer.FXF_READ
         d = client.openFile(source, flags, {})
-        d.addCallback(self._cbgetopenfile, lf)
+        d.addCallback(sftp.track)
+        d.addCallback(self._cbgetopenfile, lf, verify)
         d.addErrback(self._ebcloselocalfile, lf)
         d.addBoth(self._cbdone, result)
         return d
 
-    def _cbputfile(self, remote, local):
-        'recursively write to a remote file'
-        chunks = []
-        d = self._cbputwrite(None, remote, local, chunks)
-        d.addCallback(self._cbputdone, remote, local)
+    def _cbgetconsumer(self, client, sftp, source, consumer, maxSize,
+                       result):
+        log.debug('_cbgetconsumer: Reading %s from remote' % source)
+        d = client.openFile(source, filetransfer.FXF_READ, {})
+        d.addCallback(sftp.track)
+        d.addCallback(self._cbgetreader, consumer, maxSize)
+        d.addBoth(self._cbdone, result)
+        return d
+
+    def _cbgetreader(self, remote, consumer, maxSize):
+        'read an open remote file into consumer'
+        d = remote.getAttrs()
+        d.addCallback(self._cbstartreader, remote, consumer, maxSize)
+        d.addBoth(self._cbclosehandle, remote)
         return d
 
-    def _cbputwrite(self, ignored, remote, local, chunks):
-        'write a chunk to the remote file'
-        chunk = self._getNextChunk(chunks)
-        log.debug('entering cbputwrite')
-        log.debug(chunk)
+    def _cbstartreader(self, attrs, remote, consumer, maxSize):
+        if not stat.S_ISREG(attrs['permissions']):
+            raise ValueError("Can't get non-regular file: %s" % remote.name)
+        if maxSize is not None and attrs['size'] > maxSize:
+            raise ValueError('%s is larger than %i bytes' % (remote.name,
+                                                             maxSize))
+        bufSize = self._bufSize()
+        reader = SFTPReader(remote, consumer, bufSize,
+                            self._sftpRequests(attrs['size']), maxSize)
+        return self._startReader(remote, reader)
+
+    def _startReader(self, remote, reader):
+        'start an SFTPReader on remote, where FTPConnection can stop it'
+        remote.transfer = reader
+        if remote.error is not None:
+            # Stopped before it started
+            reader.stopProducing()
+        return reader.start()
+
+    def _cbclosehandle(self, result, remote):
+        'Close a remote file handle, passing on the result'
+        remote.close()
+        return result
+
+    def _cbputfile(self, remote, local, start=0, chunks=None):
+        'write to a remote file, several chunks at a time'
+        if chunks is None:
+            chunks = TransferChunks(self._bufSize(), start)
+        size = os.fstat(local.fileno()).st_size
+        writers = []
+        for i in range(self._sftpRequests(size - start)):
+            # A writer with nothing left to write returns None.
+            writers.append(defer.maybeDeferred(self._cbputwrite, None,
+                                               remote, local, chunks))
+        d = defer.DeferredList(writers)
+        d.addCallback(self._cbtransferred, remote)
+        d.addBoth(self._cbputdone, remote, local)
+        return d
+
+    def _cbputwrite(self, result, remote, local, chunks):
+        'write the next chunk to the remote file'
+        if isinstance(result, failure.Failure):
+            # Let the other writes drain; the first error is reported.
+            if remote.error is None:
+                remote.error = result
+            return
+        if remote.error is not None:
+            return
+        chunk = chunks.next()
+        if not chunk:
+            return
         start, size = chunk
         local.seek(start)
         data = local.read(size)
-        if data:
-            d = remote.writeChunk(start, data)
-            d.addCallback(self._cbputwrite, remote, local, chunks)
-            return d
-        else:
+        if len(data) < size:
+            chunks.eof(start + len(data))
+        if not data:
+            return
+        log.debug('_cbputwrite: writing %i -> %i' % (start,
+                                                     start + len(data)))
+        d = remote.writeChunk(start, data)
+        d.addBoth(self._cbputwrite, remote, local, chunks)
+        return d
+
+    def _cbgetranges(self, client, sftp, source, destination, ranges,
+                     result):
+        log.debug('_cbgetranges: Reading %s from remote' % source)
+        lf = open(destination, 'r+b')
+        d = client.openFile(source, filetransfer.FXF_READ, {})
+        d.addCallback(sftp.track)
+        d.addCallback(self._cbgetrangesfile, lf, ranges)
+        d.addErrback(self._ebcloselocalfile, lf)
+        d.addBoth(self._cbdone, result)
+        return d
+
+    def _cbgetrangesfile(self, remote, local, ranges):
+        'read ranges of a remote file, several chunks at a time'
+        chunks = RangeChunks(self._bufSize(), ranges)
+        readers = []
+        for i in range(self._sftpRequests(sum([r[1] for r in ranges]))):
+            readers.append(defer.maybeDeferred(self._cbgetrange, None,
+                                               remote, local, chunks))
+        d = defer.DeferredList(readers)
+        d.addCallback(self._cbtransferred, remote)
+        d.addBoth(self._cbgetdone, remote, local)
+        return d
+
+    def _cbgetrange(self, result, remote, local, chunks):
+        'read the next chunk into the same place in the local file'
+        if isinstance(result, failure.Failure):
+            if remote.error is None:
+                remote.error = result
             return
+        if remote.error is not None:
+            return
+        chunk = chunks.next()
+        if not chunk:
+            return
+        start, size = chunk
+        d = remote.readChunk(start, size)
+        d.addCallback(self._cbgotrange, local, chunks, start, size)
+        d.addBoth(self._cbgetrange, remote, local, chunks)
+        return d
+
+    def _cbgotrange(self, data, local, chunks, start, size):
+        chunks.received(start, size, len(data))
+        local.seek(start)
+        local.write(data)
+
+    def _cbputranges(self, client, sftp, source, destination, ranges,
+                     result):
+        log.debug('_cbputranges: Writing %s to remote' % destination)
+        lf = open(source, 'rb')
+        flags = filetransfer.FXF_WRITE | \
+            filetransfer.FXF_CREAT | \
+            filetransfer.FXF_TRUNC
+        d = client.openFile(destination, flags, {})
+        d.addCallback(sftp.track)
+        d.addCallback(self._cbputfile, lf,
+                      chunks=RangeChunks(self._bufSize(), ranges))
+        d.addErrback(self._ebcloselocalfile, lf)
+        d.addBoth(self._cbdone, result)
+        return d
 
     def _cbputdone(self, d, remote, local):
         'Close the remote and local file handles'
@@ -347,6 +624,75 @@ class SSHClient(ReconnectingClientFactory):
         remote.close()
         return d
 
+    def _cbputresume(self, remote, client, local, destination, verify):
+        'find where a resumed put starts'
+        d = remote.getAttrs()
+        d.addErrback(self._cbclosehandle, remote)
+        d.addCallback(self._cbputstart, remote, client, local, destination,
+                      verify)
+        return d
+
+    def _cbputstart(self, attrs, remote, client, local, destination,
+                    verify):
+        start = attrs['size']
+        if start > os.fstat(local.fileno()).st_size:
+            return self._putagain(remote, client, local, destination)
+        if start and verify:
+            length = min(verify, start)
+            d = self._readRange(remote, start - length, length)
+            d.addErrback(self._cbclosehandle, remote)
+            d.addCallback(self._cbputverified, remote, client, local,
+                          destination, start)
+            return d
+        return self._cbputfile(remote, local, start)
+
+    def _cbputverified(self, data, remote, client, local, destination,
+                       start):
+        'resume at start if the remote tail matches the local data'
+        local.seek(start - len(data))
+        if local.read(len(data)) != data:
+            return self._putagain(remote, client, local, destination)
+        return self._cbputfile(remote, local, start)
+
+    def _putagain(self, remote, client, local, destination):
+        'put the whole file after all, truncating what is there'
+        log.debug('_putagain: %s changed, putting it again' % destination)
+        remote.close()
+        flags = filetransfer.FXF_WRITE | \
+            filetransfer.FXF_CREAT | \
+            filetransfer.FXF_TRUNC
+        d = client.openFile(destination, flags, {})
+        d.addCallback(remote.sftp.track)
+        d.addCallback(self._cbputfile, local)
+        return d
+
+    def _cbputsource(self, client, source, destination, result):
+        log.debug('_cbputsource: Writing %s to remote' % destination)
+        flags = filetransfer.FXF_WRITE | \
+            filetransfer.FXF_CREAT | \
+            filetransfer.FXF_TRUNC
+        d = client.openFile(destination, flags, {})
+        d.addCallback(self._cbputwriter, source)
+        d.addBoth(self._cbdone, result)
+        return d
+
+    def _cbputwriter(self, remote, source):
+        'write a string or the output of a producer to an open remote file'
+        bufSize = self._bufSize()
+        requests = int(self.options.get('sftprequests') or
+                       DEFAULT_SFTP_REQUESTS)
+        writer = SFTPWriter(remote, bufSize, requests)
+        if isinstance(source, str):
+            writer.write(source)
+            d = writer.finish()
+        else:
+            d = source.startProducing(writer)
+            if not d.called:
+                writer.registerProducer(source, True)
+            d.addBoth(writer.producerDone)
+        d.addBoth(self._cbclosehandle, remote)
+        return d
+
     def _cbsetusrgrp(self, attrs, client, path, owner=None, group=None):
         new = {}
         new['uid'] = (owner is not None) and owner or attrs['uid']
@@ -393,16 +739,25 @@ class SSHClient(ReconnectingClientFactory):
         d.addBoth(self._cbdone, result)
         return d
 
-    def _cbput(self, client, source, destination, result):
+    def _cbput(self, client, sftp, source, destination, result,
+               resume=False, verify=0):
         log.debug('_cbput: Copying files to remote')
         log.debug('_cbput: remote: %s, local: %s' % (destination, source))
 
         lf = open(source, 'r')
         flags = filetransfer.FXF_WRITE | \
-            filetransfer.FXF_CREAT | \
-            filetransfer.FXF_TRUNC
+            filetransfer.FXF_CREAT
+        if resume:
+            # Keep what is there; it is read back to check it.
+            flags |= filetransfer.FXF_READ
+        else:
+            flags |= filetransfer.FXF_TRUNC
         d = client.openFile(destination, flags, {})
-        d.addCallback(self._cbputfile, lf)
+        d.addCallback(sftp.track)
+        if resume:
+            d.addCallback(self._cbputresume, client, lf, destination, verify)
+        else:
+            d.addCallback(self._cbputfile, lf)
         d.addErrback(self._ebcloselocalfile, lf)
         d.addBoth(self._cbdone, result)
         return d
@@ -424,7 +779,9 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, path)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbchgrp, path, group, d)
         return d
 
@@ -443,10 +800,64 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, path)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbchmod, path, perms, d)
         return d
 
+    def stat(self, path, followLinks=True, timeout=None):
+        '''get the attributes of a remote path.
+           @param: path: a remote path. (string)
+           @param: followLinks: Describe the target of a symbolic link
+                   rather than the link itself. (bool)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred firing with a dict of size, uid, gid,
+           permissions, atime and mtime.
+        '''
+        log.debug('stat: %s @ %s:%s ' % (path, self.host, self.port))
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
+        c.addCallback(self._cbstat, path, followLinks, d)
+        return d
+
+    def readlink(self, path, timeout=None):
+        '''get the target of a remote symbolic link.
+           @param: path: a remote path. (string)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred firing with the target. (string)
+        '''
+        log.debug('readlink: %s @ %s:%s ' % (path, self.host, self.port))
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
+        c.addCallback(self._cbreadlink, path, d)
+        return d
+
+    def utime(self, path, atime, mtime, timeout=None):
+        '''set the access and modification times of a remote path.
+           @param: path: a remote path. (string)
+           @param: atime: access time, in seconds since the epoch. (int)
+           @param: mtime: modification time, in seconds since the epoch.
+                   (int)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred.
+        '''
+        log.debug('utime: %s @ %s:%s ' % (path, self.host, self.port))
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        d.addBoth(self._cbInvalidatePaths, path)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
+        c.addCallback(self._cbutime, path, atime, mtime, d)
+        return d
+
     def chown(self, path, owner, timeout=None):
         '''change ownership of a remote file.
            This command does not validate the owner.
@@ -462,27 +873,125 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, path)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbchown, path, owner, d)
         return d
 
-    def get(self, source, destination, timeout=None):
+    def get(self, source, destination, timeout=None, coalesce=None,
+            resume=False, verify=0):
         '''get a remote file.
            This command does not validate the source or destination.
            @param: source: a path to a remote file to get. (string)
            @param: destination: the destination path. (string)
            @param: timeout: An optional timeout. (int/float)
+           @param: coalesce: Share one transfer between identical gets
+                   that are in flight at the same time.  Defaults to
+                   options['coalesce']. (bool)
+           @param: resume: Keep an existing destination and get only what
+                   is past its end, e.g. after a dropped connection.  If
+                   it is larger than the source it is got again. (bool)
+           @param: verify: With resume, compare the last verify bytes of
+                   the destination with the source first and get the
+                   whole file if they differ. (int)
            returns a deferred.
         '''
+        timeout = timeout or self.commandTimeout
+        if coalesce is None:
+            coalesce = self.options.get('coalesce', False)
+        if coalesce:
+            return self.inflight.call(('get', source, destination, resume,
+                                       verify),
+                                      lambda: self._get(source,
+                                                        destination,
+                                                        None, resume,
+                                                        verify),
+                                      timeout)
+        return self._get(source, destination, timeout, resume, verify)
+
+    def _get(self, source, destination, timeout, resume=False, verify=0):
         log.debug('get: remote %s, local: %s @ %s:%s' % (source,
                                                          destination,
                                                          self.host,
                                                          self.port))
+        # Cancelling stops the transfer; a coalesced get is cancelled
+        # once all of its callers have gone.
+        d = defer.Deferred(lambda d: c.close())
+        self.trackDeferred(d)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          priority=PRIORITY_BULK, session=self.sftpPool)
+        c.addCallback(self._cbget, c, source, destination, d, resume, verify)
+        return d
+
+    def getDelta(self, source, destination, timeout=None):
+        '''get a remote file that changed since the local destination
+           was got, reading only the blocks that differ, like rsync.
+           The remote host needs python (options['deltapython'] names
+           it) to sum the file.  A missing destination is got whole.
+           @param: source: a path to a remote file to get. (string)
+           @param: destination: the destination path. (string)
+           @param: timeout: An optional timeout for each step.
+                   (int/float)
+           returns a deferred firing with a dict of the file's size and
+           the bytes sent and matched.
+        '''
+        log.debug('getDelta: remote %s, local: %s @ %s:%s' % (source,
+                                                              destination,
+                                                              self.host,
+                                                              self.port))
+        return DeltaGet(self, source, destination, timeout).start()
+
+    def _getRanges(self, source, destination, ranges, timeout):
+        '''read (offset, length) ranges of a remote file into the same
+           places in an existing local file.
+        '''
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          priority=PRIORITY_BULK, session=self.sftpPool)
+        c.addCallback(self._cbgetranges, c, source, destination, ranges, d)
+        return d
+
+    def getToConsumer(self, source, consumer, timeout=None):
+        '''get a remote file, writing it to consumer as it arrives.
+           Nothing is written to disk.  Reads are pipelined as for get()
+           and written in order; while the consumer is paused no new
+           reads are sent.
+           @param: source: a path to a remote file to get. (string)
+           @param: consumer: an IConsumer or callable for the file's
+                   data.  It is registered with a push producer.
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred firing with the number of bytes read.
+        '''
+        return self._getToConsumer(source, consumer, None, timeout)
+
+    def getBytes(self, source, maxSize=None, timeout=None):
+        '''get a remote file into memory.
+           @param: source: a path to a remote file to get. (string)
+           @param: maxSize: An optional size limit; larger files fail
+                   with ValueError without being read. (int)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred firing with the file's contents. (string)
+        '''
+        data = []
+        d = self._getToConsumer(source, data.append, maxSize, timeout)
+        d.addCallback(lambda size: ''.join(data))
+        return d
+
+    def _getToConsumer(self, source, consumer, maxSize, timeout):
+        log.debug('getToConsumer: remote %s @ %s:%s' % (source,
+                                                       self.host,
+                                                       self.port))
         timeout = timeout or self.commandTimeout
+        if not hasattr(consumer, 'write'):
+            consumer = _CallableConsumer(consumer)
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
-        c.addCallback(self._cbget, source, destination, d)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          priority=PRIORITY_BULK, session=self.sftpPool)
+        c.addCallback(self._cbgetconsumer, c, source, consumer, maxSize, d)
         return d
 
     def ln(self, source, destination, timeout=None):
@@ -501,7 +1010,9 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, source, destination)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbln, source, destination, d)
         return d
 
@@ -519,7 +1030,9 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, directory)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbmkdir, directory, d)
         return d
 
@@ -538,7 +1051,9 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, old, new)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbrename, old, new, d)
         return d
 
@@ -556,7 +1071,9 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, path)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbrm, path, d)
         return d
 
@@ -575,28 +1092,268 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        d.addBoth(self._cbInvalidatePaths, directory)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbrmdir, directory, d)
         return d
 
-    def run(self, command, timeout=None):
+    def run(self, command, timeout=None, spoolSize=None,
+            priority=PRIORITY_INTERACTIVE, cacheTTL=None, cacheTags=(),
+            coalesce=None, stdin=None, capture=CAPTURE_ALL,
+            captureSize=None, parser=None):
         '''run a command on a remote server.
            @param: command: a command to run. (string)
            @param: timeout: An optional timeout. (int/float)
+           @param: spoolSize: An optional number of bytes of stdout/stderr
+                   to keep in memory.  Larger output is spilled to a
+                   temporary file and returned as a SpooledOutput.
+                   Defaults to options['spoolsize']. (int)
+           @param: priority: The channel open priority when more than
+                   options['maxchannels'] channels are wanted, lower
+                   opens first. (int)
+           @param: cacheTTL: Seconds to serve the Results from
+                   self.resultCache before running the command again.
+                   Results are only cached when this is given. (int/float)
+           @param: cacheTags: Remote paths whose modification through this
+                   client (put, rm, ...) drops the cached Results.
+                   (list of strings)
+           @param: coalesce: Share one channel between identical commands
+                   that are in flight at the same time; each caller still
+                   has its own timeout and can cancel.  Output that was
+                   spooled to a file only goes to the first caller; the
+                   others run the command again.  Defaults to
+                   options['coalesce']. (bool)
+           @param: stdin: Data streamed to the command's stdin before EOF,
+                   following the SSH window: a string, a file, or a
+                   producer with startProducing(consumer) returning a
+                   deferred, such as twisted.web.client.FileBodyProducer.
+                   A bare IPushProducer is not enough: nothing would tell
+                   it where to write or when it is done.
+                   Commands with stdin are never cached or shared.
+           @param: capture: What to keep of the output.  CAPTURE_ALL keeps
+                   everything.  CAPTURE_DISCARD drops stdout and keeps the
+                   exit code and stderr.  CAPTURE_HEAD keeps the first
+                   captureSize bytes of stdout and stderr, then signals the
+                   remote command and closes the channel.  CAPTURE_TAIL
+                   keeps the last captureSize bytes.  Results.truncated is
+                   set when output was dropped.  Commands that don't
+                   capture everything are never cached or shared.
+           @param: captureSize: Bytes kept per stream for CAPTURE_HEAD and
+                   CAPTURE_TAIL. (int)
+           @param: parser: A new sshclient.parsers.Parser for the output.
+                   stdout is parsed as it arrives and Results.output is the
+                   list of records; the raw output is never kept.  Can be
+                   combined with CAPTURE_HEAD.  Parsed commands are never
+                   cached or shared.
            returns a deferred.
         '''
+        if capture in (CAPTURE_HEAD, CAPTURE_TAIL) and captureSize is None:
+            raise ValueError('capture %s needs a captureSize' % capture)
+        timeout = timeout or self.commandTimeout
+        if spoolSize is None:
+            spoolSize = self.options.get('spoolsize')
+        if stdin is not None or capture != CAPTURE_ALL or parser is not None:
+            return self._run(command, timeout, spoolSize, priority,
+                             stdin=stdin, capture=capture,
+                             captureSize=captureSize, parser=parser)
+        if coalesce is None:
+            coalesce = self.options.get('coalesce', False)
+        args = (command, timeout, spoolSize, priority, coalesce)
+        if cacheTTL is not None and self.resultCache is not None:
+            return self._cachedRun(cacheTTL, cacheTags, *args)
+        return self._run(*args)
+
+    def _run(self, command, timeout, spoolSize, priority, coalesce=False,
+             stdin=None, capture=CAPTURE_ALL, captureSize=None, parser=None):
+        if coalesce:
+            d = self.inflight.call(('run', command, spoolSize),
+                                   lambda: self._run(command, None,
+                                                     spoolSize, priority),
+                                   timeout)
+            d.addCallback(self._cbCoalescedRun, command, timeout,
+                          spoolSize, priority)
+            return d
         log.debug('run: @ %s:%s ' % (self.host, self.port))
+        channels = []
+        d = defer.Deferred(lambda d: self._cancelRun(channels))
+        self.trackDeferred(d)
+        self.dConnected.addCallback(self._cbRun, command, d, timeout,
+                                    spoolSize, priority, channels, stdin,
+                                    capture, captureSize, parser)
+        return d
+
+    def _cbCoalescedRun(self, results, command, timeout, spoolSize,
+                        priority):
+        # Spooled output is a file handle; it can't be handed out twice.
+        # The first caller gets it and the others run the command again.
+        if isinstance(results.output, str) and \
+                isinstance(results.stderr, str):
+            return results
+        if not results.taken:
+            results.taken = True
+            return results
+        log.debug('run: output of %s was spooled, running it again' %
+                  command)
+        return self._run(command, timeout, spoolSize, priority)
+
+    def runMany(self, commands, concurrency=10, timeout=None,
+                onResult=None, batchSize=None):
+        '''run several commands on a remote server over one connection.
+           At most concurrency command channels are open at once; the rest
+           wait their turn.  A failed command shows up in the results as a
+           Failure instead of failing the whole batch.
+           @param: commands: the commands to run. (list of strings)
+           @param: concurrency: maximum number of open channels. (int)
+           @param: timeout: An optional timeout per command, or per channel
+                   when batching. (int/float)
+           @param: onResult: An optional callable called with
+                   (index, result) as each command finishes.
+           @param: batchSize: Run up to this many commands in each channel
+                   with a single exec, see runBatch(). (int)
+           returns a deferred firing with the results in command order.
+        '''
+        log.debug('runMany: %i commands @ %s:%s ' % (len(commands),
+                                                    self.host,
+                                                    self.port))
+        semaphore = defer.DeferredSemaphore(concurrency)
+        deferreds = []
+        if batchSize:
+            for start in range(0, len(commands), batchSize):
+                batch = commands[start:start + batchSize]
+                results = [defer.Deferred() for command in batch]
+                semaphore.run(self._batch, batch, results, timeout)
+                deferreds.extend(results)
+        else:
+            for command in commands:
+                deferreds.append(semaphore.run(self.run, command, timeout))
+        if onResult:
+            for index, d in enumerate(deferreds):
+                d.addBoth(self._cbRunManyResult, index, onResult)
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(self._cbRunManyDone)
+        return d
+
+    def runBatch(self, commands, timeout=None, onResult=None):
+        '''run several commands on a remote server with a single exec.
+           The commands run one after another in a remote shell script
+           that frames each one's exit code, stdout and stderr, and the
+           output is split back into a Results per command.  One channel
+           instead of one per command saves a session setup (PAM, motd,
+           login scripts) and a MaxSessions slot for each command.  Each
+           command runs in its own subshell with stdin from /dev/null; its
+           output is staged in temporary files on the remote host.
+           @param: commands: the commands to run. (list of strings)
+           @param: timeout: An optional timeout for the whole batch.
+                   (int/float)
+           @param: onResult: An optional callable called with
+                   (index, result) as each command finishes.
+           returns a deferred firing with the results in command order.
+        '''
+        return self.runMany(commands, concurrency=1, timeout=timeout,
+                            onResult=onResult, batchSize=len(commands))
+
+    def _batch(self, commands, results, timeout=None):
+        log.debug('batch: %i commands @ %s:%s ' % (len(commands),
+                                                  self.host,
+                                                  self.port))
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        self.dConnected.addCallback(self._cbRun, command, d, timeout)
+        channel = BatchChannel(commands, results, d, timeout=timeout)
+        d.addErrback(self._ebBatch, channel)
+        self.dConnected.addCallback(self._cbOpenChannel, channel)
         return d
 
-    def put(self, source, destination, timeout=None):
+    def openShell(self, shell='/bin/sh', timeout=None):
+        '''open a persistent shell session on a remote server.
+           Commands run through session.run(command, timeout=None) share
+           one channel and cost about one round trip each.  Call
+           session.close() when done; session.result fires once the shell
+           has exited.
+           @param: shell: the remote shell to start. (string)
+           @param: timeout: An optional default timeout for each command.
+                   (int/float)
+           returns a ShellChannel.
+        '''
+        log.debug('openShell: %s @ %s:%s ' % (shell, self.host, self.port))
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        session = ShellChannel(shell, d, commandTimeout=timeout)
+        self.dConnected.addCallback(self._cbOpenChannel, session)
+        return session
+
+    def stream(self, command, consumer, errConsumer=None, timeout=None,
+               stdin=None):
+        '''run a command on a remote server, streaming its output.
+           stdout is written to consumer as it arrives instead of being
+           collected into Results.output.  The remote command is throttled
+           through the SSH window whenever the consumer pauses us.
+           @param: command: a command to run. (string)
+           @param: consumer: an IConsumer or callable for stdout chunks.
+           @param: errConsumer: an optional IConsumer or callable for
+                   stderr chunks.  stderr is buffered into Results.stderr
+                   when omitted.
+           @param: timeout: An optional timeout. (int/float)
+           @param: stdin: Optional data for the command's stdin, as for
+                   run().
+           returns a deferred.
+        '''
+        log.debug('stream: @ %s:%s ' % (self.host, self.port))
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        self.dConnected.addCallback(self._cbStream, command, consumer,
+                                    errConsumer, d, timeout, stdin)
+        return d
+
+    def runLines(self, command, onLines, timeout=None, stdin=None):
+        '''run a command on a remote server, a batch of lines at a time.
+           stdout is split into lines as it arrives, so the whole output
+           is never held in memory.  Results.output is empty.
+           @param: command: a command to run. (string)
+           @param: onLines: called with each list of complete lines,
+                   without their newlines.
+           @param: timeout: An optional timeout. (int/float)
+           @param: stdin: Optional data for the command's stdin, as for
+                   run().
+           returns a deferred.
+        '''
+        return self.stream(command, LineConsumer(onLines), timeout=timeout,
+                           stdin=stdin)
+
+    def iterLines(self, command, timeout=None, stdin=None,
+                  maxBatches=DEFAULT_MAX_BATCHES):
+        '''run a command on a remote server and iterate over its lines.
+           Returns a LineIterator; its next() returns a deferred firing
+           with the next list of lines, or None at the end of the output.
+           The remote command is paused while maxBatches batches are
+           waiting to be read.
+           @param: command: a command to run. (string)
+           @param: timeout: An optional timeout. (int/float)
+           @param: stdin: Optional data for the command's stdin, as for
+                   run().
+           @param: maxBatches: batches to queue before pausing. (int)
+           returns a LineIterator.
+        '''
+        lines = LineIterator(maxBatches)
+        d = self.stream(command, lines, timeout=timeout, stdin=stdin)
+        d.addBoth(lines.finish)
+        return lines
+
+    def put(self, source, destination, timeout=None, resume=False,
+            verify=0):
         '''put a local file to remote server destination.
            @param: source: a local path (string)
            @param: destination: a remote path (string)
            @param: timeout: An optional timeout. (int/float)
+           @param: resume: Keep an existing destination and put only what
+                   is past its end.  If it is larger than the source it is
+                   put again. (bool)
+           @param: verify: With resume, compare the last verify bytes of
+                   the destination with the source first and put the
+                   whole file if they differ. (int)
            returns a deferred.
         '''
         log.debug('put: source:%s destination: %s @ %s:%s ' % (source,
@@ -606,10 +1363,142 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
-        c.addCallback(self._cbput, source, destination, d)
+        d.addBoth(self._cbInvalidatePaths, destination)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          priority=PRIORITY_BULK, session=self.sftpPool)
+        c.addCallback(self._cbput, c, source, destination, d, resume, verify)
         return d
 
+    def putDelta(self, source, destination, timeout=None):
+        '''put a local file that changed since the remote destination
+           was put, writing only the blocks that differ, like rsync.
+           The new file is put together next to the destination and
+           renamed over it.  The remote host needs python
+           (options['deltapython'] names it).  A missing or empty
+           destination is put whole.
+           @param: source: a local path (string)
+           @param: destination: a remote path (string)
+           @param: timeout: An optional timeout for each step.
+                   (int/float)
+           returns a deferred firing with a dict of the file's size and
+           the bytes sent and matched.
+        '''
+        log.debug('putDelta: source:%s destination: %s @ %s:%s ' % (
+            source, destination, self.host, self.port))
+        d = DeltaPut(self, source, destination, timeout).start()
+        d.addBoth(self._cbInvalidatePaths, destination)
+        return d
+
+    def _putRanges(self, source, destination, ranges, timeout):
+        '''write (offset, length) ranges of a local file to the same
+           places in a new remote file.
+        '''
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          priority=PRIORITY_BULK, session=self.sftpPool)
+        c.addCallback(self._cbputranges, c, source, destination, ranges, d)
+        return d
+
+    def putBytes(self, data, destination, timeout=None):
+        '''write a string to a remote file.
+           Nothing is written to local disk.
+           @param: data: the file's contents. (string)
+           @param: destination: a remote path (string)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred firing with the number of bytes written.
+        '''
+        return self._putSource(data, destination, timeout)
+
+    def putFromProducer(self, producer, destination, timeout=None):
+        '''write the output of a producer to a remote file.
+           The producer is paused while sftprequests writes are waiting
+           for the server and stopped if a write fails.
+           @param: producer: a producer with startProducing(consumer)
+                   returning a deferred, e.g. FileBodyProducer.
+           @param: destination: a remote path (string)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred firing with the number of bytes written.
+        '''
+        return self._putSource(producer, destination, timeout)
+
+    def _putSource(self, source, destination, timeout):
+        log.debug('putSource: destination: %s @ %s:%s ' % (destination,
+                                                            self.host,
+                                                            self.port))
+        timeout = timeout or self.commandTimeout
+        d = defer.Deferred()
+        self.trackDeferred(d)
+        d.addBoth(self._cbInvalidatePaths, destination)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          priority=PRIORITY_BULK, session=self.sftpPool)
+        c.addCallback(self._cbputsource, source, destination, d)
+        return d
+
+    def getTree(self, source, destination,
+                concurrency=DEFAULT_TREE_CONCURRENCY,
+                symlinks=SYMLINKS_COPY, preserve=False, timeout=None,
+                sync=False, delete=False):
+        '''get a remote directory tree.
+           Directories are created as they are found and files are got
+           concurrency at a time over the shared SFTP sessions.  A failed
+           entry doesn't stop the rest.
+           @param: source: a remote directory. (string)
+           @param: destination: the local directory to copy it to; it is
+                   created if missing. (string)
+           @param: concurrency: listings and transfers to run at once.
+                   (int)
+           @param: symlinks: SYMLINKS_COPY to recreate symbolic links,
+                   SYMLINKS_FOLLOW to copy what they point at or
+                   SYMLINKS_SKIP to leave them out.
+           @param: preserve: Copy permission bits too. (bool)
+           @param: timeout: An optional timeout for each operation.
+                   (int/float)
+           @param: sync: Skip files whose size and mtime match the
+                   destination and give the files copied the source's
+                   mtime, like rsync -t.  Skipped files are left out of
+                   the results. (bool)
+           @param: delete: Remove destination entries that aren't in the
+                   source; they are in the results with a source of None.
+                   (bool)
+           returns a deferred firing with a list of (source, destination,
+           result) for every directory, file and link, where result is
+           None or a Failure.
+        '''
+        log.debug('getTree: remote %s, local: %s @ %s:%s' % (source,
+                                                             destination,
+                                                             self.host,
+                                                             self.port))
+        return GetTree(self, source, destination, concurrency, symlinks,
+                       preserve, timeout, sync, delete).start()
+
+    def putTree(self, source, destination,
+                concurrency=DEFAULT_TREE_CONCURRENCY,
+                symlinks=SYMLINKS_COPY, preserve=False, timeout=None,
+                sync=False, delete=False):
+        '''put a local directory tree to the remote server.
+           The counterpart of getTree(); the arguments and result are the
+           same with source local and destination remote.
+           returns a deferred.
+        '''
+        log.debug('putTree: local %s, remote: %s @ %s:%s' % (source,
+                                                             destination,
+                                                             self.host,
+                                                             self.port))
+        return PutTree(self, source, destination, concurrency, symlinks,
+                       preserve, timeout, sync, delete).start()
+
+    def invalidatePaths(self, *paths):
+        '''drop cached run() Results tagged with any of the remote paths.
+           Modifying calls on this client do this for the paths they touch.
+           @param: paths: remote paths. (strings)
+        '''
+        if self.resultCache is None:
+            return
+        for path in paths:
+            self.resultCache.invalidateTag(self._cacheKey(path))
+
     def ls(self, path, timeout=None):
         '''ls files on a remote server.
            @param: path: a remote path (string)
@@ -620,7 +1509,8 @@ class SSHClient(ReconnectingClientFactory):
         timeout = timeout or self.commandTimeout
         d = defer.Deferred()
         self.trackDeferred(d)
-        c = FTPConnection(self.dConnected, d, commandTimeout=timeout)
+        c = FTPConnection(self.dConnected, d, commandTimeout=timeout,
+                          session=self.sftpPool)
         c.addCallback(self._cbls, path, d)
         return d
 
@@ -632,26 +1522,47 @@ class FTPConnection:
     def __init__(self, connection, deferred,
                  connectTimeout=None,
                  commandTimeout=None,
-                 reactor=reactor):
+                 reactor=reactor,
+                 priority=PRIORITY_INTERACTIVE,
+                 session=None):
         self.connection = connection
         self.deferred = deferred
         self.reactor = reactor
+        self.priority = priority
+        self.session = session  # Shared SFTP session, if any
 
         self.channel = None
         self.ftpClient = None
         self.connectTimeout = connectTimeout
         self.commandTimeout = commandTimeout
         self.timeoutId = None
+        self.closed = False
+        self.remotes = []  # Open files whose transfers close() stops
         self.open()
 
     def _cbopen(self, connection):
+        if self.session is not None:
+            if connection:
+                d = self.session.getClient(connection, self.priority)
+                d.addCallbacks(self._cbsession, self._ebsession)
+            return connection
         # This will create the ftpClient and open a channel
         self.channel = SFTPChannel(self.ftpClient, connection=connection,
-                                   timeout=self.connectTimeout)
+                                   timeout=self.connectTimeout,
+                                   priority=self.priority)
         if connection:
             connection.openChannel(self.channel)
         return connection
 
+    def _cbsession(self, client):
+        if self.ftpClient is not None:
+            self.ftpClient.callback(client)
+
+    def _ebsession(self, reason):
+        log.debug('FTPConnection: no SFTP session %s' % reason)
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
     def open(self):
         self.ftpClient = defer.Deferred()
         log.debug('Opening ftp channel/client')
@@ -665,10 +1576,38 @@ class FTPConnection:
         # Initiate the connection
         self.connection.addCallback(self._cbopen)
 
+    def track(self, remote):
+        '''Callback for an open remote file: if the operation times out
+           or is cancelled, the transfer on it is stopped.  Its requests
+           in flight drain and then the transfer's own callbacks close
+           it and the local file.  Returns remote.
+        '''
+        remote.error = None  # The first error of the transfer
+        remote.transfer = None  # Its SFTPReader, if any
+        remote.sftp = self
+        if self.closed:
+            self._stop(remote)
+        else:
+            self.remotes.append(remote)
+        return remote
+
+    def _stop(self, remote):
+        'No more reads or writes on remote'
+        if remote.error is None:
+            remote.error = failure.Failure(defer.CancelledError())
+        if remote.transfer is not None:
+            remote.transfer.stopProducing()
+
     def close(self):
         log.debug('Closing ftp channel')
+        self.closed = True
         channel, self.channel = self.channel, None
         ftpClient, self.ftpClient = self.ftpClient, None
+        remotes, self.remotes = self.remotes, []
+
+        # A transfer that is done already ignores this.
+        for remote in remotes:
+            self._stop(remote)
 
         if channel:
             channel.loseConnection()
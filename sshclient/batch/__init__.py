@@ -0,0 +1,143 @@
+from twisted.internet import reactor
+from twisted.internet.error import TimeoutError, ConnectionDone
+
+from sshclient.channel import CommandChannel, OutputBuffer, Results
+
+import logging
+log = logging.getLogger('txsshclient.batch')
+
+MARKER = 'txsshclient-batch'
+
+# Each command's output is collected in temporary files so its frame can
+# start with the exact lengths: "MARKER index exit outlen errlen\n", then
+# outlen bytes of stdout and errlen bytes of stderr.  Commands run in a
+# subshell with stdin from /dev/null, as if each had its own exec.
+SCRIPT = '''__txssh_o=$(mktemp) && __txssh_e=$(mktemp) || exit 1
+trap 'rm -f "$__txssh_o" "$__txssh_e"' EXIT
+%(commands)s'''
+
+COMMAND = '''( %(command)s
+) >"$__txssh_o" 2>"$__txssh_e" </dev/null
+printf '%(marker)s %(index)d %%d %%d %%d\\n' $? \
+$(wc -c <"$__txssh_o") $(wc -c <"$__txssh_e")
+cat "$__txssh_o" "$__txssh_e"
+'''
+
+
+def script(commands):
+    'Return the shell script that runs commands and frames their output'
+    return SCRIPT % {'commands': ''.join(
+        COMMAND % {'command': command, 'marker': MARKER, 'index': index}
+        for index, command in enumerate(commands))}
+
+
+class FrameSplitter:
+    '''Split batch output into (index, exit, stdout, stderr) frames.
+
+       feed() returns the frames completed by a chunk.  A header that
+       doesn't parse raises ValueError.
+    '''
+
+    def __init__(self):
+        self.header = []
+        self.frame = None
+        self.out = None
+        self.err = None
+
+    def feed(self, data):
+        frames = []
+        while data:
+            if self.frame is None:
+                index = data.find('\n')
+                if index == -1:
+                    self.header.append(data)
+                    break
+                self.header.append(data[:index])
+                data = data[index + 1:]
+                self.startFrame(''.join(self.header))
+                self.header = []
+            else:
+                data = self.fill(data)
+            if self.frame is not None and \
+                    self.frame[2] == len(self.out) and \
+                    self.frame[3] == len(self.err):
+                index, exit = self.frame[:2]
+                frames.append((index, exit, self.out.getvalue(),
+                               self.err.getvalue()))
+                self.frame = None
+        return frames
+
+    def startFrame(self, header):
+        fields = header.split()
+        if len(fields) != 5 or fields[0] != MARKER:
+            raise ValueError('Bad batch frame header %r' % header[:80])
+        self.frame = [int(field) for field in fields[1:]]
+        self.out = OutputBuffer()
+        self.err = OutputBuffer()
+
+    def fill(self, data):
+        'Add data to the current frame, returning what is left over'
+        for size, buf in ((self.frame[2], self.out),
+                          (self.frame[3], self.err)):
+            room = size - len(buf)
+            if room > 0:
+                buf.write(data[:room])
+                data = data[room:]
+        return data
+
+
+class BatchChannel(CommandChannel):
+    '''Runs several commands in one exec and splits their results apart.
+
+       Servers with a low MaxSessions or costly session setup (PAM, motd,
+       login scripts) then pay for one channel instead of one per
+       command.  results is a Deferred per command, fired with its own
+       Results as soon as it finishes.  result fires with the Results of
+       the wrapping script once the channel closes.  If the channel closes
+       or times out early, the commands that didn't finish fail.
+    '''
+
+    def __init__(self, commands, results, result, timeout=None,
+                 reactor=reactor, *args, **kwargs):
+        CommandChannel.__init__(self, script(commands), result,
+                                timeout=timeout, reactor=reactor,
+                                *args, **kwargs)
+        self.commands = commands
+        self.results = results
+        self.splitter = FrameSplitter()
+        self.failed = False
+
+    def dataReceived(self, data):
+        if self.failed:
+            return
+        try:
+            frames = self.splitter.feed(data)
+        except ValueError as e:
+            log.debug('BatchChannel: %s' % e)
+            self.failed = True
+            self.failPending(e)
+            self.loseConnection()
+            return
+        for index, exit, out, err in frames:
+            if not 0 <= index < len(self.results):
+                continue
+            d = self.results[index]
+            if not d.called:
+                d.callback(Results(self.commands[index], out, exit, err))
+
+    def failPending(self, reason):
+        for d in self.results:
+            if not d.called:
+                d.errback(reason)
+
+    def _timeoutCalled(self):
+        self.failPending(TimeoutError())
+        CommandChannel._timeoutCalled(self)
+
+    def openFailed(self, reason):
+        self.failPending(reason)
+        CommandChannel.openFailed(self, reason)
+
+    def closed(self):
+        self.failPending(ConnectionDone('Batch channel closed'))
+        CommandChannel.closed(self)
@@ -0,0 +1,193 @@
+from twisted.internet import reactor
+from twisted.internet import defer
+from twisted.internet.error import TimeoutError
+from twisted.python import failure
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger('txsshclient.cache')
+
+
+class CacheEntry:
+    def __init__(self, value, expires, staleUntil, tags):
+        self.value = value
+        self.expires = expires
+        self.staleUntil = staleUntil
+        self.tags = tags
+        self.refreshing = False
+
+
+class ResultCache:
+    '''A bounded LRU cache of command results with per-entry TTLs.
+
+       An entry is fresh for its ttl and then stale for staleTTL more
+       seconds.  Stale entries are still returned, but the caller is asked
+       to refresh them (once) in the background.  Entries can be tagged,
+       e.g. with the remote paths a command reads, and dropped by tag.
+       One cache can be shared by several SSHClients.
+    '''
+
+    def __init__(self, maxSize=1024, staleTTL=0, clock=None):
+        self.maxSize = maxSize
+        self.staleTTL = staleTTL
+        self.clock = clock or reactor.seconds
+        self.entries = OrderedDict()
+        self.tags = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        '''Look up a key.
+           Returns (value, fresh), or (None, False) on a miss.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+        now = self.clock()
+        if now >= entry.staleUntil:
+            self.invalidate(key)
+            return None, False
+        # Mark as most recently used
+        del self.entries[key]
+        self.entries[key] = entry
+        return entry.value, now < entry.expires
+
+    def put(self, key, value, ttl, tags=()):
+        self.invalidate(key)
+        now = self.clock()
+        entry = CacheEntry(value, now + ttl, now + ttl + self.staleTTL,
+                           frozenset(tags))
+        self.entries[key] = entry
+        for tag in entry.tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.maxSize:
+            self.invalidate(next(iter(self.entries)))
+
+    def startRefresh(self, key):
+        '''Claim the background refresh of a stale key.
+           Returns False if a refresh is already running.
+        '''
+        entry = self.entries.get(key)
+        if entry is None or entry.refreshing:
+            return False
+        entry.refreshing = True
+        return True
+
+    def refreshFailed(self, key):
+        'Let the next lookup of a stale key try to refresh it again'
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.refreshing = False
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self.tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidateTag(self, tag):
+        for key in list(self.tags.get(tag, ())):
+            log.debug('Invalidating cached %s for %s' % (key, tag))
+            self.invalidate(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.tags.clear()
+
+
+class Flight:
+    '''One shared operation and the callers waiting on it'''
+
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self.deferred = None
+        self.waiters = []
+        self.finished = False
+        self.result = None
+
+    def start(self, deferred):
+        self.deferred = deferred
+        deferred.addBoth(self._fire)
+
+    def join(self, timeout=None):
+        '''Return a Deferred for the shared result.
+           Each caller's Deferred times out and can be cancelled on its
+           own; the shared operation is cancelled once nobody waits on it.
+        '''
+        if self.finished:
+            if isinstance(self.result, failure.Failure):
+                return defer.fail(self.result)
+            return defer.succeed(self.result)
+        d = defer.Deferred(self._leave)
+        self.waiters.append(d)
+        if timeout:
+            timeoutId = self.reactor.callLater(timeout, self._timeoutCalled,
+                                               d)
+            d.addBoth(self._cbStopTimer, timeoutId)
+        return d
+
+    def _cbStopTimer(self, result, timeoutId):
+        if timeoutId.active():
+            timeoutId.cancel()
+        return result
+
+    def _timeoutCalled(self, d):
+        self._leave(d)
+        if not d.called:
+            d.errback(TimeoutError())
+
+    def _leave(self, d):
+        if d in self.waiters:
+            self.waiters.remove(d)
+        if not self.waiters and not self.deferred.called:
+            log.debug('No callers left, cancelling shared operation')
+            self.deferred.cancel()
+
+    def _fire(self, result):
+        self.finished = True
+        self.result = result
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class SingleFlight:
+    '''Coalesce identical in-flight requests into one operation.'''
+
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self.flights = {}
+
+    def __contains__(self, key):
+        return key in self.flights
+
+    def call(self, key, start, timeout=None):
+        '''Return a Deferred for the result of start().
+           start is only called if no request for key is in flight;
+           otherwise the caller shares the running one.
+        '''
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(self.reactor)
+            d = start()
+            d.addBoth(self._land, key, flight)
+            flight.start(d)
+        else:
+            log.debug('Joining in-flight request %s' % (key,))
+        return flight.join(timeout)
+
+    def _land(self, result, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        return result
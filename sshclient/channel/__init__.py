@@ -2,34 +2,291 @@ from twisted.conch.ssh import channel
 from twisted.conch.ssh import common
 from twisted.conch.error import ConchError
 from twisted.internet import reactor
+import collections
 import struct
+import tempfile
+import mmap
 from twisted.conch.ssh.common import NS
 from twisted.conch.ssh.filetransfer import FileTransferClient
-from twisted.internet.error import TimeoutError
+from twisted.internet import defer
+from twisted.internet.error import TimeoutError, ConnectionLost
+from twisted.python import failure
+from twisted.internet.interfaces import IPushProducer, IConsumer
+from twisted.protocols.basic import FileSender
+from zope.interface import implements
 
 import logging
 log = logging.getLogger('txsshclient.channel')
 
+# Channel open priorities, lower opens first when channels are queued.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Output capture policies for CommandChannel.
+CAPTURE_ALL = 'all'  # Keep all of the output
+CAPTURE_DISCARD = 'discard'  # Drop stdout, keep only the exit code
+CAPTURE_HEAD = 'head'  # Keep the first bytes, then stop the command
+CAPTURE_TAIL = 'tail'  # Keep only the last bytes
+
 
 class Results:
-    def __init__(self, command, output, exitCode, stderr):
+    def __init__(self, command, output, exitCode, stderr, truncated=False):
         self.command = command
         self.output = output
         self.exitCode = exitCode
         self.stderr = stderr
+        self.truncated = truncated  # Some output was not kept
+        self.taken = False  # A coalesced run() handed out spooled output
+
+
+class OutputBuffer:
+    '''Append-only buffer for channel output.
+
+       Packets are kept as a list of chunks and joined once when the value
+       is asked for, instead of copying the whole output on every packet.
+    '''
+
+    truncated = False
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def getvalue(self):
+        'Return the buffered output as a single string'
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks and self.chunks[0] or ''
+
+    def memoryview(self):
+        'Return a zero-copy view of the buffered output'
+        return memoryview(self.getvalue())
+
+
+class SpooledOutput:
+    '''Command output that was spilled to a temporary file.
+
+       Reads like a file positioned at the start of the output.  The
+       temporary file is removed once this object is closed or collected.
+    '''
+
+    def __init__(self, fileobj, size):
+        self.file = fileobj
+        self.size = size
+        self.file.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def mmap(self):
+        'Return a read-only mmap of the whole output'
+        return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.file.close()
+
+
+class SpoolingBuffer(OutputBuffer):
+    '''OutputBuffer that moves to a temporary file past maxSize bytes.
+
+       getvalue() returns a string while the output fits in memory and a
+       SpooledOutput once it has been spilled; use its mmap() for
+       zero-copy access to spilled output.
+    '''
+
+    def __init__(self, maxSize, directory=None):
+        OutputBuffer.__init__(self)
+        self.maxSize = maxSize
+        self.directory = directory
+        self.file = None
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+            self.size += len(data)
+            return
+        OutputBuffer.write(self, data)
+        if self.size > self.maxSize:
+            self.rollover()
+
+    def rollover(self):
+        'Move the buffered chunks to a temporary file'
+        log.debug('Spooling %i bytes of output to disk', self.size)
+        self.file = tempfile.TemporaryFile(prefix='txsshclient',
+                                           dir=self.directory)
+        chunks, self.chunks = self.chunks, []
+        for chunk in chunks:
+            self.file.write(chunk)
+
+    def getvalue(self):
+        if self.file is None:
+            return OutputBuffer.getvalue(self)
+        self.file.flush()
+        return SpooledOutput(self.file, self.size)
+
+
+class DiscardBuffer(OutputBuffer):
+    'Counts the output but keeps none of it'
+
+    def write(self, data):
+        if data:
+            self.size += len(data)
+            self.truncated = True
+
+
+class CappedBuffer:
+    '''Keeps the first maxSize bytes written to an underlying buffer.
+
+       onFull is called once, when the first byte past maxSize arrives.
+    '''
+    truncated = False
+
+    def __init__(self, maxSize, buffer, onFull=None):
+        self.maxSize = maxSize
+        self.buffer = buffer
+        self.onFull = onFull
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        room = self.maxSize - len(self.buffer)
+        if len(data) > room:
+            self.buffer.write(data[:room])
+            if not self.truncated:
+                self.truncated = True
+                if self.onFull is not None:
+                    self.onFull()
+            return
+        self.buffer.write(data)
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+class TailBuffer(OutputBuffer):
+    '''Keeps only the last maxSize bytes of the output.
+
+       Whole chunks are dropped from the front as new ones arrive, so at
+       most one chunk more than maxSize is held.
+    '''
+
+    def __init__(self, maxSize):
+        OutputBuffer.__init__(self)
+        self.chunks = collections.deque()
+        self.maxSize = maxSize
+
+    def write(self, data):
+        OutputBuffer.write(self, data)
+        while self.chunks and self.size - len(self.chunks[0]) >= self.maxSize:
+            self.size -= len(self.chunks.popleft())
+            self.truncated = True
+
+    def getvalue(self):
+        data = ''.join(self.chunks)
+        if len(data) > self.maxSize:
+            data = data[-self.maxSize:]
+            self.truncated = True
+        self.chunks = collections.deque([data])
+        self.size = len(data)
+        return data
+
+
+class ParsingBuffer:
+    '''Feeds the output to a parser instead of keeping it.
+
+       getvalue() finishes the parser and returns its records.  If the
+       parser raises, the error is handed to onError and the rest of the
+       output is dropped.
+    '''
+    truncated = False
+
+    def __init__(self, parser, onError=None):
+        self.parser = parser
+        self.onError = onError
+        self.size = 0
+        self.failed = False
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        self.size += len(data)
+        if self.failed:
+            return
+        try:
+            self.parser.feed(data)
+        except Exception:
+            self.failed = True
+            if self.onError is not None:
+                self.onError(failure.Failure())
+
+    def getvalue(self):
+        self.parser.finish()
+        return self.parser.records()
 
 
 class CommandChannel(channel.SSHChannel):
     name = "session"
+    implements(IConsumer)
+    killSignal = 'TERM'  # Sent when CAPTURE_HEAD output overflows
 
     def __init__(self, command, result, timeout=None,
-                 reactor=reactor, *args, **kwargs):
+                 reactor=reactor, spoolSize=None,
+                 priority=PRIORITY_INTERACTIVE, stdin=None,
+                 capture=CAPTURE_ALL, captureSize=None, parser=None,
+                 *args, **kwargs):
         """
         @param command: command to run
         @type command: string
         @param result: deferred to callback (exit, stdout, stderr)
                        or errback (code, value) with
         @type result: Deferred
+        @param spoolSize: bytes of stdout/stderr to keep in memory before
+                          spilling to a temporary file, None to never spill
+        @type spoolSize: int
+        @param priority: open priority when channels are queued
+        @type priority: int
+        @param stdin: data for the command's stdin: a string, a file or
+                      a producer with startProducing(consumer) returning
+                      a Deferred (e.g. FileBodyProducer); a bare
+                      IPushProducer can't be given its consumer.  EOF is
+                      sent once it has all been written.
+        @param capture: what to keep of the output: CAPTURE_ALL,
+                        CAPTURE_DISCARD (stdout is dropped), CAPTURE_HEAD
+                        (the first captureSize bytes of each stream, then
+                        the command is signalled and the channel closed)
+                        or CAPTURE_TAIL (the last captureSize bytes)
+        @type capture: string
+        @param captureSize: bytes of each stream kept for CAPTURE_HEAD and
+                            CAPTURE_TAIL
+        @type captureSize: int
+        @param parser: a parsers.Parser fed stdout as it arrives; Results
+                       .output is then its list of records and the raw
+                       output is not kept
         @param conn: connection to create the channel on
         @type conn: Twisted connection object
         """
@@ -38,14 +295,54 @@ class CommandChannel(channel.SSHChannel):
         self.result = result
         self.timeout = timeout
         self.reactor = reactor
-        self.data = ''
-        self.err = ''
+        self.capture = capture
+        if capture == CAPTURE_DISCARD:
+            self.data = DiscardBuffer()
+        else:
+            self.data = self.makeBuffer(capture, captureSize, spoolSize,
+                                        parser)
+        self.err = self.makeBuffer(capture, captureSize, spoolSize)
         self.exit = 1
         self.timeoutId = None
+        self.priority = priority
+        self.stdin = stdin
+        self.stdinProducer = None
+        self.stdinStreaming = False
+        self.eofPending = False
         log.debug('Command Channel initialized')
 
+    def makeBuffer(self, capture, captureSize, spoolSize, parser=None):
+        if parser is not None:
+            buffer = ParsingBuffer(parser, self._parseFailed)
+        elif capture == CAPTURE_TAIL:
+            return TailBuffer(captureSize)
+        elif spoolSize is None:
+            buffer = OutputBuffer()
+        else:
+            buffer = SpoolingBuffer(spoolSize)
+        if capture == CAPTURE_HEAD:
+            return CappedBuffer(captureSize, buffer, self._outputFull)
+        return buffer
+
+    def _outputFull(self):
+        log.debug('CommandChannel: output of "%s" over the cap, stopping it',
+                  self.command)
+        # Servers that don't support signals still stop the command when
+        # the channel closes: its next write fails.
+        if self.conn and not self.localClosed:
+            self.conn.sendRequest(self, 'signal', common.NS(self.killSignal))
+        self.loseConnection()
+
+    def _parseFailed(self, reason):
+        log.debug('CommandChannel: parsing output of "%s" failed %s',
+                  self.command, reason)
+        if not self.result.called:
+            self.result.errback(reason)
+        self.loseConnection()
+
     def openFailed(self, reason):
         log.debug('CommandChannel: open failed because %s' % reason)
+        self.timeoutCancel()
         if isinstance(reason, ConchError):
             res = (reason.data, reason.value)
         else:
@@ -79,20 +376,92 @@ class CommandChannel(channel.SSHChannel):
                                     "exec",
                                     common.NS(self.command),
                                     wantReply=True)
-        req.addCallback(lambda _: self.conn.sendEOF(self))
+        req.addCallback(self._cbSendStdin)
 
         def passthru(data):
             return data
         req.addErrback(passthru)
         return req
 
+    def _cbSendStdin(self, _):
+        stdin, self.stdin = self.stdin, None
+        if stdin is None:
+            self.conn.sendEOF(self)
+            return
+        if isinstance(stdin, str):
+            self.write(stdin)
+            self._cbStdinDone(None)
+            return
+        if hasattr(stdin, 'read'):
+            d = FileSender().beginFileTransfer(stdin, self)
+        else:
+            # Push producers write on their own; we pause them while the
+            # remote window is full.
+            d = stdin.startProducing(self)
+            if not d.called:
+                self.registerProducer(stdin, True)
+                d.addBoth(self._cbUnregisterStdin)
+        d.addCallbacks(self._cbStdinDone, self._ebStdin)
+
+    def _cbUnregisterStdin(self, result):
+        self.unregisterProducer()
+        return result
+
+    def _cbStdinDone(self, _):
+        self._sendEOF()
+
+    def _sendEOF(self):
+        # Only send EOF once the data still waiting on the window is out.
+        if self.buf:
+            self.eofPending = True
+        else:
+            self.conn.sendEOF(self)
+
+    def _ebStdin(self, reason):
+        log.debug('CommandChannel: writing stdin failed %s' % reason)
+        if not self.result.called:
+            self.result.errback(reason)
+        self.loseConnection()
+
+    # IConsumer, for stdin producers
+    def registerProducer(self, producer, streaming):
+        self.stdinProducer = producer
+        self.stdinStreaming = streaming
+        if streaming and not self.areWriting:
+            producer.pauseProducing()
+        self._pullStdin()
+
+    def unregisterProducer(self):
+        self.stdinProducer = None
+
+    def _pullStdin(self):
+        while self.stdinProducer is not None and \
+                not self.stdinStreaming and \
+                self.areWriting and not self.buf:
+            self.stdinProducer.resumeProducing()
+
+    def stopWriting(self):
+        # The remote window is full
+        if self.stdinProducer is not None and self.stdinStreaming:
+            self.stdinProducer.pauseProducing()
+
+    def startWriting(self):
+        if self.stdinProducer is not None and self.stdinStreaming:
+            self.stdinProducer.resumeProducing()
+
+    def addWindowBytes(self, bytes):
+        channel.SSHChannel.addWindowBytes(self, bytes)
+        self._pullStdin()
+        if self.eofPending and not self.buf:
+            self.eofPending = False
+            self.conn.sendEOF(self)
+
     def dataReceived(self, data):
-        log.debug('[%s] Received %s' % (id(self), data))
-        self.data = self.data + data
+        self.data.write(data)
 
     def extReceived(self, dataType, data):
         if dataType == 1:
-            self.err = self.err + data
+            self.err.write(data)
 
     def request_exit_status(self, data):
         self.exit = struct.unpack('>L', data)[0]
@@ -101,35 +470,155 @@ class CommandChannel(channel.SSHChannel):
         self.timeoutCancel()
 
     def closed(self):
-        log.debug('[%s] Sending results back to the callback (%s)' % (id(self), self.data))
+        log.debug('[%s] Sending results back to the callback (%i bytes)',
+                  id(self), len(self.data))
         if not self.result.called:
             #self.result.callback((self.exit, self.data, self.err))
-            self.result.callback(Results(self.command,
-                                         self.data,
-                                         self.exit,
-                                         self.err))
+            try:
+                results = Results(self.command,
+                                  self.data.getvalue(),
+                                  self.exit,
+                                  self.err.getvalue(),
+                                  self.data.truncated or self.err.truncated)
+            except Exception:
+                self.result.errback(failure.Failure())
+            else:
+                self.result.callback(results)
+        # The command exited without reading all of stdin.
+        producer, self.stdinProducer = self.stdinProducer, None
+        if producer is not None:
+            producer.stopProducing()
+
+
+class _CallableConsumer:
+    'Adapt a plain callable to the parts of IConsumer we use'
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.callback(data)
+
+
+class _OutputProducer:
+    'Push producer handed to a single consumer of a StreamingCommandChannel'
+    implements(IPushProducer)
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+        self.channel.holdWindow()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.channel.releaseWindow()
+
+    def stopProducing(self):
+        self.channel.loseConnection()
+
+
+class StreamingCommandChannel(CommandChannel):
+    '''CommandChannel that writes output to consumers as it arrives.
+
+       stdout is written to consumer and stderr to errConsumer (or
+       buffered into Results.stderr if no errConsumer is given).  Either
+       may be an IConsumer or a callable taking one chunk.  While any
+       consumer is paused the local SSH window is not re-opened, so a
+       slow consumer stalls the remote command instead of growing our
+       buffers.
+    '''
+
+    def __init__(self, command, result, consumer, errConsumer=None,
+                 timeout=None, reactor=reactor, *args, **kwargs):
+        CommandChannel.__init__(self, command, result, timeout=timeout,
+                                reactor=reactor, *args, **kwargs)
+        self.windowHeld = False
+        self.consumers = []
+        self.consumer = self._addConsumer(consumer)
+        self.errConsumer = None
+        if errConsumer is not None:
+            self.errConsumer = self._addConsumer(errConsumer)
+
+    def _addConsumer(self, consumer):
+        if not hasattr(consumer, 'write'):
+            consumer = _CallableConsumer(consumer)
+        producer = _OutputProducer(self)
+        consumer.registerProducer(producer, True)
+        self.consumers.append((consumer, producer))
+        return consumer
+
+    def holdWindow(self):
+        'Stop re-opening the local window until every consumer resumes'
+        self.windowHeld = True
+
+    def releaseWindow(self):
+        'Re-open the local window once no consumer is paused'
+        if [p for c, p in self.consumers if p.paused]:
+            return
+        self.windowHeld = False
+        bytesToAdd = self.localWindowSize - self.localWindowLeft
+        if bytesToAdd > 0 and self.conn and not self.localClosed:
+            self.conn.adjustWindow(self, bytesToAdd)
+
+    def dataReceived(self, data):
+        self.consumer.write(data)
+
+    def extReceived(self, dataType, data):
+        if dataType == 1:
+            if self.errConsumer is not None:
+                self.errConsumer.write(data)
+            else:
+                CommandChannel.extReceived(self, dataType, data)
+
+    def closed(self):
+        consumers, self.consumers = self.consumers, []
+        for consumer, producer in consumers:
+            consumer.unregisterProducer()
+        CommandChannel.closed(self)
 
 
 class SFTPChannel(channel.SSHChannel):
     name = 'session'
+    # Room for a full window of pipelined 32KB reads, like OpenSSH
+    localWindowSize = 2 * 1024 * 1024
 
     def __init__(self, clientHandle, connection,
-                 timeout=None, reactor=reactor, *args, **kwargs):
+                 timeout=None, reactor=reactor,
+                 priority=PRIORITY_INTERACTIVE, *args, **kwargs):
         channel.SSHChannel.__init__(self, *args, **kwargs)
         self.clientHandle = clientHandle
         self.conn = connection
         self.timeout = timeout
         self.reactor = reactor
+        self.priority = priority
+        self.client = None
+        self.onClose = defer.Deferred()  # Fires with the channel once closed
         log.debug('SFTP Channel initialized')
 
     def channelOpen(self, whatever):
         log.debug('SFTP Channel opened')
         d = self.conn.sendRequest(
             self, 'subsystem', NS('sftp'), wantReply=True)
-        d.addCallbacks(self._cbSFTP)
+        d.addCallbacks(self._cbSFTP, self._ebSFTP)
+
+    def _ebSFTP(self, reason):
+        log.debug('SFTPChannel: sftp subsystem failed %s' % reason)
+        if not self.clientHandle.called:
+            self.clientHandle.errback(reason)
+        self.loseConnection()
 
     def _cbSFTP(self, result):
         client = FileTransferClient()
+        self.client = client
         client.makeConnection(self)
         self.dataReceived = client.dataReceived
         log.debug('setting clientHandle to be %s' % client)
@@ -143,5 +632,26 @@ class SFTPChannel(channel.SSHChannel):
         else:
             res = (reason.code, reason.desc)
 
-        self.clientHandle.errback(res)
+        if not self.clientHandle.called:
+            self.clientHandle.errback(res)
         channel.SSHChannel.openFailed(self, reason)
+        if not self.onClose.called:
+            self.onClose.callback(self)
+
+    def closed(self):
+        log.debug('SFTP Channel closed')
+        reason = ConnectionLost('SFTP channel closed')
+        if not self.clientHandle.called:
+            self.clientHandle.errback(reason)
+        # FileTransferClient doesn't fail its outstanding requests itself.
+        # Some are never waited on (closing handles), so don't let their
+        # failures be reported as unhandled.
+        if self.client is not None:
+            requests, self.client.openRequests = self.client.openRequests, {}
+            for d in requests.values():
+                d.errback(reason)
+                d.addErrback(self._ebRequestLost)
+        self.onClose.callback(self)
+
+    def _ebRequestLost(self, reason):
+        log.debug('SFTPChannel: request lost with the channel %s' % reason)
@@ -1,14 +1,248 @@
 from twisted.conch.ssh import connection
+from twisted.conch.error import ConchError
+from twisted.internet import reactor
+import heapq
+import itertools
+import struct
 import logging
 log = logging.getLogger('txsshclient.connection')
 
+# OpenSSH's default MaxSessions
+DEFAULT_MAX_CHANNELS = 10
+
+# Largest receive window auto-tuning grows a channel to
+DEFAULT_MAX_WINDOW_SIZE = 16 * 1024 * 1024
+
+# Open failures that mean the server is out of sessions rather than that
+# the channel itself was refused.
+LIMIT_REASONS = (connection.OPEN_ADMINISTRATIVELY_PROHIBITED,
+                 connection.OPEN_RESOURCE_SHORTAGE)
+
+
+class ChannelScheduler:
+    '''Queue channel opens so no more than limit channels are open at once.
+
+       Queued channels open in priority order (lower first), then in the
+       order they were submitted.  If the server refuses a channel because
+       it is out of sessions while others are open, the limit is lowered
+       to what the server accepted and the channel is queued again.  With
+       maxQueue set, channels that would have to wait behind a full queue
+       fail right away instead.
+
+       Long lived channels (shells and pooled SFTP sessions, which set
+       longLived) never close on their own, so they may only hold
+       limit - 1 of the slots (at least one).  The last slot is kept for
+       commands and transfers, which would otherwise queue until a shell
+       was closed; further long lived channels wait for one to close.
+    '''
+
+    def __init__(self, open, limit=DEFAULT_MAX_CHANNELS, maxQueue=None):
+        self.open = open
+        self.limit = limit
+        self.maxQueue = maxQueue
+        self.queue = []
+        self.keys = {}
+        self.active = set()
+        self.longLived = set()  # the active channels that are long lived
+        self.counter = itertools.count()
+
+    def hasRoom(self):
+        return not self.queue and \
+            (self.limit is None or len(self.active) < self.limit)
+
+    def submit(self, channel):
+        if self.maxQueue is not None and not self.hasRoom() and \
+                len(self.queue) >= self.maxQueue:
+            log.debug('Channel queue full, shedding %s' % channel)
+            channel.openFailed(ConchError('Channel queue full',
+                                          connection.OPEN_RESOURCE_SHORTAGE))
+            return
+        key = (getattr(channel, 'priority', 0), next(self.counter))
+        self.keys[channel] = key
+        heapq.heappush(self.queue, key + (channel,))
+        self.pump()
+
+    def pump(self):
+        waiting = []  # long lived channels that have to wait for a slot
+        while self.queue and \
+                (self.limit is None or len(self.active) < self.limit):
+            entry = heapq.heappop(self.queue)
+            channel = entry[-1]
+            if getattr(channel, 'longLived', False):
+                if self.limit is not None and \
+                        len(self.longLived) >= max(self.limit - 1, 1):
+                    waiting.append(entry)
+                    continue
+                self.longLived.add(channel)
+            self.active.add(channel)
+            self.open(channel)
+        for entry in waiting:
+            heapq.heappush(self.queue, entry)
+
+    def cancel(self, channel):
+        '''Drop a channel that hasn't been opened yet.
+           Returns True if the channel was still queued.
+        '''
+        for entry in self.queue:
+            if entry[-1] is channel:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                del self.keys[channel]
+                return True
+        return False
+
+    def release(self, channel):
+        'A channel closed; let the next one open'
+        if channel in self.active:
+            self.active.remove(channel)
+            self.longLived.discard(channel)
+            self.keys.pop(channel, None)
+            self.pump()
+
+    def openFailed(self, channel, reasonCode):
+        '''The server refused a channel.
+           Returns True if the channel was queued to try again.
+        '''
+        self.active.discard(channel)
+        self.longLived.discard(channel)
+        if reasonCode in LIMIT_REASONS and self.active:
+            self.limit = len(self.active)
+            log.debug('Server refused channel with %i open, lowering limit'
+                      % self.limit)
+            heapq.heappush(self.queue, self.keys[channel] + (channel,))
+            return True
+        self.keys.pop(channel, None)
+        self.pump()
+        return False
+
+    def clear(self):
+        'Forget every channel; returns the ones that were still queued'
+        queued = [entry[-1] for entry in sorted(self.queue)]
+        self.queue = []
+        self.keys = {}
+        self.active = set()
+        self.longLived = set()
+        return queued
+
+
+class WindowTuner:
+    '''Grow a channel's receive window to cover its bandwidth-delay product.
+
+       Like TCP receive window auto-tuning: each time the window is
+       topped up we measure how fast the last stretch of it was used.  The
+       window is topped up once half of it is used, so a sender that is
+       window limited uses about half the window per round trip.  When the
+       rate delivers more than a quarter of the window in one round trip
+       the window is grown to four times what it delivers (and at least
+       doubled), up to maxWindow.
+    '''
+
+    def __init__(self, maxWindow=DEFAULT_MAX_WINDOW_SIZE, clock=None):
+        self.maxWindow = maxWindow
+        self.clock = clock or reactor.seconds
+        self.last = self.clock()
+
+    def tune(self, channel, rtt):
+        'Return the bytes to add to the window, growing it if needed'
+        now = self.clock()
+        consumed = channel.localWindowSize - channel.localWindowLeft
+        elapsed = now - self.last
+        self.last = now
+        if rtt and elapsed > 0 and channel.localWindowSize < self.maxWindow:
+            bdp = consumed * rtt / elapsed
+            if 4 * bdp > channel.localWindowSize:
+                size = max(channel.localWindowSize * 2, int(4 * bdp))
+                channel.localWindowSize = min(size, self.maxWindow)
+                log.debug('Grew %s window to %i (rtt %.3fs, %i B/s)' %
+                          (channel, channel.localWindowSize, rtt,
+                           consumed / elapsed))
+        return channel.localWindowSize - channel.localWindowLeft
+
 
 class Connection(connection.SSHConnection):
     def __init__(self, factory, deferred):
         self.factory = factory
         self.deferred = deferred
         connection.SSHConnection.__init__(self)
+        options = getattr(factory, 'options', {})
+        self.options = options
+        self.reactor = getattr(factory, 'reactor', reactor)
+        self.rtt = None  # Smoothed round trip time from channel opens
+        self.scheduler = ChannelScheduler(
+            self._openChannel,
+            limit=options.get('maxchannels', DEFAULT_MAX_CHANNELS),
+            maxQueue=options.get('maxqueue'))
 
     def serviceStarted(self):
         log.debug('Connection serviceStarted')
         self.deferred.callback(self)
+
+    def serviceStopped(self):
+        for channel in self.scheduler.clear():
+            channel.openFailed(ConchError('Connection lost before the '
+                                          'channel was opened',
+                                          connection.OPEN_CONNECT_FAILED))
+        connection.SSHConnection.serviceStopped(self)
+
+    def openChannel(self, channel, extra=''):
+        channel.openExtra = extra
+        windowSize = self.options.get('windowsize')
+        if windowSize:
+            channel.localWindowSize = channel.localWindowLeft = windowSize
+        maxPacket = self.options.get('maxpacket')
+        if maxPacket:
+            channel.localMaxPacket = maxPacket
+        self.scheduler.submit(channel)
+
+    def _openChannel(self, channel):
+        channel.openedAt = self.reactor.seconds()
+        connection.SSHConnection.openChannel(self, channel,
+                                             channel.openExtra)
+
+    def ssh_CHANNEL_OPEN_CONFIRMATION(self, packet):
+        localChannel = struct.unpack('>L', packet[:4])[0]
+        channel = self.channels[localChannel]
+        # An open is one round trip; keep a smoothed estimate like TCP.
+        sample = self.reactor.seconds() - channel.openedAt
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+        if self.options.get('autotune'):
+            channel.windowTuner = WindowTuner(
+                self.options.get('maxwindowsize', DEFAULT_MAX_WINDOW_SIZE),
+                self.reactor.seconds)
+        connection.SSHConnection.ssh_CHANNEL_OPEN_CONFIRMATION(self, packet)
+
+    def ssh_CHANNEL_OPEN_FAILURE(self, packet):
+        localChannel, reasonCode = struct.unpack('>2L', packet[:8])
+        channel = self.channels[localChannel]
+        if self.scheduler.openFailed(channel, reasonCode):
+            del self.channels[localChannel]
+            return
+        connection.SSHConnection.ssh_CHANNEL_OPEN_FAILURE(self, packet)
+
+    def sendClose(self, channel):
+        if self.scheduler.cancel(channel):
+            log.debug('Closed %s before it was opened' % channel)
+            channel.localClosed = True
+            # Let its deferreds fire; it will never be opened or closed.
+            channel.openFailed(ConchError('Channel closed before it was '
+                                          'opened',
+                                          connection.OPEN_CONNECT_FAILED))
+            return
+        connection.SSHConnection.sendClose(self, channel)
+
+    def channelClosed(self, channel):
+        connection.SSHConnection.channelClosed(self, channel)
+        self.scheduler.release(channel)
+
+    def adjustWindow(self, channel, bytesToAdd):
+        # Channels applying backpressure re-open their own window once
+        # their consumers have drained.
+        if getattr(channel, 'windowHeld', False):
+            return
+        tuner = getattr(channel, 'windowTuner', None)
+        if tuner is not None:
+            bytesToAdd = tuner.tune(channel, self.rtt)
+        connection.SSHConnection.adjustWindow(self, channel, bytesToAdd)
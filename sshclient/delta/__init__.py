@@ -0,0 +1,245 @@
+from twisted.internet import threads
+import os
+import pipes
+import posixpath
+import tempfile
+from StringIO import StringIO
+
+from sshclient.delta.helper import HashingReader, copyRange, deltas
+from sshclient.delta.helper import fileMd5, readSums, writeSums
+
+import logging
+log = logging.getLogger('txsshclient.delta')
+
+# The remote side of a delta transfer runs helper.py with this python
+# unless options['deltapython'] names another.
+DEFAULT_REMOTE_PYTHON = '"$(command -v python3 || command -v python)"'
+
+HELPER = open(os.path.join(os.path.dirname(__file__), 'helper.py')).read()
+
+
+def helperCommand(python, *args):
+    'The shell command that runs helper.py remotely with args'
+    return '%s -c %s %s' % (python, pipes.quote(HELPER),
+                            ' '.join([pipes.quote(str(a)) for a in args]))
+
+
+def checkResults(results):
+    'Fail with the helper\'s stderr if it exited non-zero'
+    if results.exitCode:
+        raise IOError('Delta helper failed (%s): %s' %
+                      (results.exitCode, results.stderr.strip()))
+    return results
+
+
+def fileSums(path):
+    '''Return what helper.py sums prints for a local file: its size and
+       block size, then a line for each block.
+    '''
+    out = StringIO()
+    with open(path, 'rb') as f:
+        writeSums(out, f, os.fstat(f.fileno()).st_size)
+    return out.getvalue()
+
+
+def fileDeltas(path, sums):
+    '''Match a local file against the output of helper.py sums.
+       Returns the size of the summed file and of this one, the
+       (offset, oldOffset, length) ranges and this file's md5.
+    '''
+    oldSize, block, old = readSums(sums)
+    with open(path, 'rb') as f:
+        reader = HashingReader(f)
+        ranges = list(deltas(reader, oldSize, block, old))
+    return oldSize, reader.size, ranges, reader.md5.hexdigest()
+
+
+def parseDeltas(output):
+    'Read what helper.py delta prints: return the ranges and the md5'
+    ranges = []
+    md5 = None
+    for line in output:
+        fields = line.split()
+        if fields[0] == 'C':
+            ranges.append((int(fields[1]), int(fields[2]), int(fields[3])))
+        elif fields[0] == 'L':
+            ranges.append((int(fields[1]), None, int(fields[2])))
+        elif fields[0] == 'M':
+            md5 = fields[1]
+    return ranges, md5
+
+
+def rangeStats(ranges):
+    'Bytes in ranges: the file size and how much was sent and matched'
+    size = sent = 0
+    for offset, oldOffset, length in ranges:
+        size += length
+        if oldOffset is None:
+            sent += length
+    return {'size': size, 'sent': sent, 'matched': size - sent}
+
+
+def _sentAll(path):
+    'rangeStats() for a file that was sent whole'
+    size = os.path.getsize(path)
+    return {'size': size, 'sent': size, 'matched': 0}
+
+
+def _output(results):
+    'Results.output as a file, spooled or not'
+    if isinstance(results.output, str):
+        return StringIO(results.output)
+    results.output.seek(0)
+    return results.output
+
+
+class DeltaTransfer:
+    '''Copy a file that the destination has an older version of, sending
+       only the parts that changed, the way rsync does.
+
+       The side with the old file splits it into blocks and sums each
+       with a rolling weak checksum (Adler-32) and md5; the side with the
+       new file rolls the weak checksum over it to find those blocks,
+       wherever they moved to.  The rest is sent over SFTP with pipelined
+       readChunk()/writeChunk() requests and the new file is put together
+       next to the old one, checked against the source's md5 and renamed
+       over it.  The remote side is helper.py, run with python through
+       run(); local checksums are worked out in a thread.
+
+       start() returns a Deferred that fires with a dict of the file's
+       size and the bytes sent and matched.
+    '''
+
+    def __init__(self, client, source, destination, timeout=None):
+        self.client = client
+        self.source = source
+        self.destination = destination
+        self.timeout = timeout
+        self.python = client.options.get('deltapython') or \
+            DEFAULT_REMOTE_PYTHON
+
+    def run(self, *args, **kwargs):
+        'run helper.py on the remote host'
+        d = self.client.run(helperCommand(self.python, *args),
+                            timeout=self.timeout, **kwargs)
+        d.addCallback(checkResults)
+        return d
+
+
+class DeltaGet(DeltaTransfer):
+    'DeltaTransfer of a remote source to a local destination'
+
+    def start(self):
+        if not os.path.isfile(self.destination):
+            return self._getAll()
+        d = threads.deferToThread(fileSums, self.destination)
+        d.addCallback(lambda sums: self.run('delta', self.source,
+                                            stdin=sums))
+        d.addCallback(self._cbDeltas)
+        return d
+
+    def _cbDeltas(self, results):
+        self.ranges, self.md5 = parseDeltas(_output(results))
+        fd, self.temp = tempfile.mkstemp(
+            dir=os.path.dirname(self.destination) or '.',
+            prefix='.%s.' % os.path.basename(self.destination))
+        os.close(fd)
+        d = threads.deferToThread(self._copyMatched)
+        d.addCallback(lambda ignored: self.client._getRanges(
+            self.source, self.temp,
+            [(o, l) for o, old, l in self.ranges if old is None],
+            self.timeout))
+        d.addCallback(lambda ignored: threads.deferToThread(self._finish))
+        d.addErrback(self._ebRemoveTemp)
+        return d
+
+    def _copyMatched(self):
+        'Fill in the matched blocks from the old file'
+        with open(self.temp, 'r+b') as new:
+            copies = [r for r in self.ranges if r[1] is not None]
+            if copies:
+                with open(self.destination, 'rb') as old:
+                    for offset, oldOffset, length in copies:
+                        copyRange(old, new, offset, oldOffset, length)
+            new.truncate(rangeStats(self.ranges)['size'])
+
+    def _finish(self):
+        with open(self.temp, 'rb') as f:
+            if fileMd5(f) != self.md5:
+                raise IOError('%s changed during the transfer' %
+                              self.source)
+        os.chmod(self.temp, os.stat(self.destination).st_mode & 07777)
+        os.rename(self.temp, self.destination)
+        return rangeStats(self.ranges)
+
+    def _getAll(self):
+        'Nothing to match against; get the whole file'
+        d = self.client.get(self.source, self.destination,
+                            timeout=self.timeout)
+        d.addCallback(lambda ignored: _sentAll(self.destination))
+        return d
+
+    def _ebRemoveTemp(self, reason):
+        if os.path.exists(self.temp):
+            os.remove(self.temp)
+        return reason
+
+
+class DeltaPut(DeltaTransfer):
+    'DeltaTransfer of a local source to a remote destination'
+
+    def start(self):
+        self.temp = posixpath.join(
+            posixpath.dirname(self.destination),
+            '.%s.delta' % posixpath.basename(self.destination))
+        d = self.run('sums', self.destination)
+        d.addCallback(self._cbSums)
+        return d
+
+    def _cbSums(self, results):
+        sums = _output(results)
+        if not int(sums.readline().split()[0]):
+            # The destination is missing or empty: there is nothing to
+            # match, and rolling over the whole file would only be slow.
+            return self._putAll()
+        sums.seek(0)
+        d = threads.deferToThread(fileDeltas, self.source, sums)
+        d.addCallback(self._cbDeltas)
+        return d
+
+    def _putAll(self):
+        'Nothing to match against; put the whole file'
+        d = self.client.put(self.source, self.destination,
+                            timeout=self.timeout)
+        d.addCallback(lambda ignored: _sentAll(self.source))
+        return d
+
+    def _cbDeltas(self, result):
+        oldSize, size, self.ranges, md5 = result
+        stats = rangeStats(self.ranges)
+        if oldSize == size and not stats['sent'] and \
+                all([offset == oldOffset for offset, oldOffset, length in
+                     self.ranges]):
+            log.debug('%s is unchanged' % self.destination)
+            return stats
+        return self._send(size, md5, stats)
+
+    def _send(self, size, md5, stats):
+        d = self.client._putRanges(
+            self.source, self.temp,
+            [(o, l) for o, old, l in self.ranges if old is None],
+            self.timeout)
+        copies = ''.join(['%d %d %d\n' % r for r in self.ranges
+                          if r[1] is not None])
+        d.addCallback(lambda ignored: self.run('patch', self.destination,
+                                               self.temp, size, md5,
+                                               stdin=copies))
+        d.addCallback(lambda ignored: stats)
+        d.addErrback(self._ebRemoveTemp)
+        return d
+
+    def _ebRemoveTemp(self, reason):
+        d = self.client.rm(self.temp, timeout=self.timeout)
+        d.addBoth(lambda ignored: reason)
+        return d
+
@@ -0,0 +1,282 @@
+'''Block checksums for rsync style delta transfers.
+
+sshclient.delta imports this module for the local side of a transfer and
+sends its source to the remote host to run with python -c for the other
+side, so it only uses the standard library and runs on Python 2.6 and 3.
+
+    sums PATH             print the size and block size of PATH, then
+                          the weak and strong sum of each block
+    delta PATH            read sums from stdin, print how to build PATH
+                          from the summed file and PATH's md5
+    patch OLD NEW SIZE MD5
+                          read copy lines from stdin, copy those ranges
+                          of OLD into NEW, check NEW against MD5, then
+                          rename NEW over OLD
+'''
+import hashlib
+import os
+import sys
+import zlib
+
+MIN_BLOCK = 2048
+MAX_BLOCK = 131072
+# Bytes read from a file at a time
+READ_SIZE = 1024 * 1024
+# Adler-32's modulus
+ADLER = 65521
+
+
+def blockSize(size):
+    'About the square root of size, in whole KB, as rsync picks it'
+    block = int(size ** 0.5) & ~1023
+    return max(MIN_BLOCK, min(MAX_BLOCK, block))
+
+
+def weakSum(data):
+    '''The rolling checksum of data: Adler-32, which deltas() rolls a
+       byte at a time.
+    '''
+    return zlib.adler32(bytes(data)) & 0xffffffff
+
+
+def strongSum(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def signatures(f, block):
+    'Yield (weak, strong) for each block of file f'
+    while True:
+        data = f.read(block)
+        if not data:
+            return
+        yield weakSum(data), strongSum(data)
+
+
+def deltas(f, size, block, sums):
+    '''Yield (offset, oldOffset, length) ranges that rebuild file f from
+       the size byte file whose block sums are given.  oldOffset is None
+       for ranges that have to be sent.
+
+       Each position is first checked for a whole block that is also at
+       some block of the old file; when that fails and the block after
+       it matches, the file was changed in place and the block is sent
+       as is.  Otherwise the weak sum is rolled a byte at a time until
+       it finds a block again, as rsync does, which catches data that
+       moved.
+    '''
+    strong = {}
+    weak = {}
+    for i, (w, s) in enumerate(sums):
+        length = min(block, size - i * block)
+        strong.setdefault((s, length), i * block)
+        if length == block:
+            weak.setdefault(w, set()).add(s)
+
+    out = []  # the pending range, to merge with the next
+
+    def emit(offset, oldOffset, length):
+        if out:
+            last = out[0]
+            if last[0] + last[2] == offset and (
+                    (last[1] is None and oldOffset is None) or
+                    (last[1] is not None and oldOffset is not None and
+                     last[1] + last[2] == oldOffset)):
+                out[0] = (last[0], last[1], last[2] + length)
+                return None
+        done = out and out[0] or None
+        out[:] = [(offset, oldOffset, length)]
+        return done
+
+    def match(data):
+        return strong.get((strongSum(data), len(data)))
+
+    buf = bytearray()
+    base = 0  # file offset of buf[0]
+    p = 0
+    eof = False
+    rolling = False
+    literal = None  # offset of the data being rolled over
+    while True:
+        if not eof and len(buf) - p < 2 * block + 1:
+            del buf[:p]
+            base += p
+            p = 0
+            data = f.read(READ_SIZE)
+            if data:
+                buf.extend(data)
+            else:
+                eof = True
+            continue
+        avail = len(buf) - p
+        if not rolling:
+            if avail == 0:
+                break
+            n = min(block, avail)
+            oldOffset = match(buf[p:p + n])
+            if oldOffset is None and n == block and avail >= 2 * block and \
+                    match(buf[p + block:p + 2 * block]) is not None:
+                oldOffset, n = None, block
+            elif oldOffset is None and n == block:
+                w = weakSum(buf[p:p + block])
+                a, b = w & 0xffff, w >> 16
+                rolling = True
+                literal = base + p
+            elif oldOffset is None:
+                # A short tail that matches nothing
+                n = avail
+            if not rolling:
+                done = emit(base + p, oldOffset, n)
+                if done:
+                    yield done
+                p += n
+                continue
+        elif b << 16 | a in weak and \
+                strongSum(buf[p:p + block]) in weak[b << 16 | a]:
+            if literal < base + p:
+                done = emit(literal, None, base + p - literal)
+                if done:
+                    yield done
+            rolling = False
+            continue
+        if avail <= block:
+            # Nothing left to roll in; the old file's short last block
+            # may still match the tail.
+            n = avail
+            oldOffset = match(buf[p:p + n])
+            if oldOffset is None:
+                done = emit(literal, None, base + p + n - literal)
+            else:
+                if literal < base + p:
+                    done = emit(literal, None, base + p - literal)
+                    if done:
+                        yield done
+                done = emit(base + p, oldOffset, n)
+            if done:
+                yield done
+            p += n
+            rolling = False
+            continue
+        old = buf[p]
+        a = (a - old + buf[p + block]) % ADLER
+        b = (b - block * old - 1 + a) % ADLER
+        p += 1
+    if out:
+        yield out[0]
+
+
+class HashingReader:
+    'Read a file while keeping its md5 and size'
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.md5.update(data)
+        self.size += len(data)
+        return data
+
+
+def fileMd5(f):
+    reader = HashingReader(f)
+    while reader.read(READ_SIZE):
+        pass
+    return reader.md5.hexdigest()
+
+
+def copyRange(source, destination, offset, oldOffset, length):
+    source.seek(oldOffset)
+    destination.seek(offset)
+    while length > 0:
+        data = source.read(min(length, READ_SIZE))
+        if not data:
+            raise IOError('%s is shorter than expected' % source.name)
+        destination.write(data)
+        length -= len(data)
+
+
+def readSums(f):
+    'Read what sums prints: return size, block and a list of sums'
+    size, block = [int(field) for field in f.readline().split()]
+    sums = []
+    for line in f:
+        w, s = line.split()
+        sums.append((int(w, 16), s))
+    return size, block, sums
+
+
+def writeSums(out, f, size):
+    block = blockSize(size)
+    out.write('%d %d\n' % (size, block))
+    for w, s in signatures(f, block):
+        out.write('%08x %s\n' % (w, s))
+
+
+def sums(path):
+    if not os.path.isfile(path):
+        # Nothing to match against
+        sys.stdout.write('0 %d\n' % blockSize(0))
+        return
+    f = open(path, 'rb')
+    try:
+        writeSums(sys.stdout, f, os.fstat(f.fileno()).st_size)
+    finally:
+        f.close()
+
+
+def delta(path):
+    size, block, old = readSums(sys.stdin)
+    f = open(path, 'rb')
+    try:
+        reader = HashingReader(f)
+        for offset, oldOffset, length in deltas(reader, size, block, old):
+            if oldOffset is None:
+                sys.stdout.write('L %d %d\n' % (offset, length))
+            else:
+                sys.stdout.write('C %d %d %d\n' % (offset, oldOffset, length))
+        sys.stdout.write('M %s\n' % reader.md5.hexdigest())
+    finally:
+        f.close()
+
+
+def patch(old, new, size, md5):
+    try:
+        destination = open(new, 'r+b')
+        try:
+            if os.path.exists(old):
+                source = open(old, 'rb')
+                try:
+                    for line in sys.stdin:
+                        offset, oldOffset, length = [int(field) for field in
+                                                     line.split()]
+                        copyRange(source, destination, offset, oldOffset,
+                                  length)
+                finally:
+                    source.close()
+                os.chmod(new, os.stat(old).st_mode & 0xfff)
+            destination.truncate(int(size))
+            destination.seek(0)
+            if fileMd5(destination) != md5:
+                raise IOError('%s changed during the transfer' % old)
+        finally:
+            destination.close()
+    except Exception:
+        os.remove(new)
+        raise
+    os.rename(new, old)
+
+
+def main(args):
+    commands = {'sums': sums, 'delta': delta, 'patch': patch}
+    if not args or args[0] not in commands:
+        sys.stderr.write('usage: sums PATH | delta PATH | '
+                         'patch OLD NEW SIZE MD5\n')
+        return 2
+    commands[args[0]](*args[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,131 @@
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from twisted.python import failure
+from zope.interface import implements
+
+import logging
+log = logging.getLogger('txsshclient.lines')
+
+# Batches an iterLines() consumer may fall behind by before the remote
+# command is paused.
+DEFAULT_MAX_BATCHES = 16
+
+
+class LineSplitter:
+    '''Split a stream of chunks into complete lines.
+
+       feed() returns the lines completed by a chunk, without their
+       newlines; a partial line is carried over to the next chunk.  Only
+       the partial line is held, so memory is bounded by the longest line
+       rather than the whole output.
+    '''
+
+    def __init__(self):
+        self.partial = []
+
+    def feed(self, data):
+        index = data.rfind('\n')
+        if index == -1:
+            if data:
+                self.partial.append(data)
+            return []
+        self.partial.append(data[:index])
+        lines = ''.join(self.partial).split('\n')
+        rest = data[index + 1:]
+        self.partial = rest and [rest] or []
+        return lines
+
+    def flush(self):
+        'Return the last line if the output did not end with a newline'
+        partial, self.partial = self.partial, []
+        if partial:
+            return [''.join(partial)]
+        return []
+
+
+class LineConsumer:
+    '''Consumer that hands each batch of complete lines to a callable.'''
+    implements(IConsumer)
+
+    def __init__(self, onLines):
+        self.onLines = onLines
+        self.splitter = LineSplitter()
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        # The output is finished; deliver a trailing unterminated line.
+        self.producer = None
+        lines = self.splitter.flush()
+        if lines:
+            self.onLines(lines)
+
+    def write(self, data):
+        lines = self.splitter.feed(data)
+        if lines:
+            self.onLines(lines)
+
+
+class LineIterator(LineConsumer):
+    '''Consumer that queues batches of lines to be pulled with next().
+
+       next() returns a Deferred that fires with the next list of lines,
+       or None once the output is finished.  If the command failed it
+       errbacks instead.  When maxBatches batches are waiting
+       the remote command is paused until they are read.  Once finished,
+       results holds the command's Results.
+    '''
+
+    def __init__(self, maxBatches=DEFAULT_MAX_BATCHES):
+        LineConsumer.__init__(self, self._queue)
+        self.maxBatches = maxBatches
+        self.batches = []
+        self.waiting = None
+        self.paused = False
+        self.finished = False
+        self.results = None
+        self.failure = None
+
+    def _queue(self, lines):
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            d.callback(lines)
+            return
+        self.batches.append(lines)
+        if len(self.batches) >= self.maxBatches and not self.paused and \
+                self.producer is not None:
+            log.debug('LineIterator: %i batches waiting, pausing' %
+                      len(self.batches))
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def next(self):
+        if self.batches:
+            lines = self.batches.pop(0)
+            if self.paused and len(self.batches) <= self.maxBatches / 2:
+                self.paused = False
+                if self.producer is not None:
+                    self.producer.resumeProducing()
+            return defer.succeed(lines)
+        if self.finished:
+            if self.failure is not None:
+                return defer.fail(self.failure)
+            return defer.succeed(None)
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+    def finish(self, result):
+        '''Called with the command's Results or Failure once it is done'''
+        self.finished = True
+        if isinstance(result, failure.Failure):
+            self.failure = result
+        else:
+            self.results = result
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            if self.failure is not None:
+                d.errback(self.failure)
+            else:
+                d.callback(None)
@@ -0,0 +1,127 @@
+from sshclient.lines import LineSplitter
+
+import logging
+log = logging.getLogger('txsshclient.parsers')
+
+
+class Parser:
+    '''Base class for incremental output parsers.
+
+       A parser is given the command's stdout a chunk at a time with
+       feed() as it arrives, then finish() once the output is complete.
+       records() returns (and forgets) the records parsed so far.  One
+       parser instance handles one command's output.
+
+       This base class keeps each chunk as a record; subclasses override
+       feed() and finish() to turn the output into their own records.
+    '''
+
+    def __init__(self):
+        self.parsed = []
+
+    def feed(self, chunk):
+        self.parsed.append(chunk)
+
+    def finish(self):
+        pass
+
+    def records(self):
+        records, self.parsed = self.parsed, []
+        return records
+
+
+class LineParser(Parser):
+    '''Parser that turns each line of output into at most one record.
+
+       Subclasses override parseLine(), returning a record or None to
+       skip the line.  The first skip lines are ignored.
+    '''
+
+    def __init__(self, skip=0):
+        Parser.__init__(self)
+        self.splitter = LineSplitter()
+        self.skip = skip
+
+    def feed(self, chunk):
+        self.parseLines(self.splitter.feed(chunk))
+
+    def finish(self):
+        self.parseLines(self.splitter.flush())
+
+    def parseLines(self, lines):
+        if self.skip:
+            skipped, lines = lines[:self.skip], lines[self.skip:]
+            self.skip -= len(skipped)
+        for line in lines:
+            record = self.parseLine(line)
+            if record is not None:
+                self.parsed.append(record)
+
+    def parseLine(self, line):
+        return line
+
+
+class TableParser(LineParser):
+    '''Parse whitespace separated columns into dicts, e.g. ps -o output.
+
+       Column names are taken from the first line unless columns is
+       given.  The last column keeps any spaces (e.g. a command line).
+       convert maps column names to callables applied to their values.
+    '''
+
+    def __init__(self, columns=None, skip=0, convert=None):
+        LineParser.__init__(self, skip)
+        self.columns = columns
+        self.convert = convert or {}
+
+    def parseLine(self, line):
+        if not line.strip():
+            return None
+        if self.columns is None:
+            self.columns = line.split()
+            return None
+        values = line.split(None, len(self.columns) - 1)
+        record = dict(zip(self.columns, values))
+        for column, convert in self.convert.iteritems():
+            if column in record:
+                record[column] = convert(record[column])
+        return record
+
+
+class KeyValueParser(LineParser):
+    '''Parse "key: value" lines into (key, value) pairs, e.g. /proc/meminfo.
+    '''
+
+    def __init__(self, separator=':', skip=0):
+        LineParser.__init__(self, skip)
+        self.separator = separator
+
+    def parseLine(self, line):
+        key, sep, value = line.partition(self.separator)
+        if not sep:
+            return None
+        return key.strip(), value.strip()
+
+
+class DfParser(TableParser):
+    'Parse df -P output (POSIX format, sizes in 1024 byte blocks)'
+
+    def __init__(self):
+        TableParser.__init__(self,
+                             columns=['filesystem', 'blocks', 'used',
+                                      'available', 'capacity', 'mounted'],
+                             skip=1,
+                             convert={'blocks': int,
+                                      'used': int,
+                                      'available': int})
+
+
+class NetstatParser(TableParser):
+    'Parse netstat -tn / -tan connection lines'
+
+    def __init__(self):
+        TableParser.__init__(self,
+                             columns=['proto', 'recvq', 'sendq', 'local',
+                                      'foreign', 'state'],
+                             skip=2,
+                             convert={'recvq': int, 'sendq': int})
@@ -0,0 +1,486 @@
+import collections
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import error
+from twisted.internet.interfaces import IPushProducer, IConsumer
+from twisted.python import failure
+from zope.interface import implements
+
+from sshclient.channel import SFTPChannel, PRIORITY_INTERACTIVE
+
+import logging
+log = logging.getLogger('txsshclient.sftp')
+
+# Seconds an SFTP session may sit idle before the pool closes it
+DEFAULT_IDLE_TIMEOUT = 300
+
+# Read/write requests a transfer keeps in flight, as OpenSSH's sftp -R
+DEFAULT_SFTP_REQUESTS = 64
+
+
+class SFTPSession:
+    '''One SFTP subsystem channel shared by every file operation.
+
+       Opening a channel, starting the remote sftp-server and the FXP_INIT
+       handshake are done once; after that operations are multiplexed on
+       the one FileTransferClient by SFTP request id.  If the channel
+       closes (the sftp-server died or the connection was lost) the
+       requests in flight fail and the next getClient() opens a new one.
+    '''
+
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self.channel = None
+        self.client = None
+        self.waiting = []
+        self.lastUsed = self.reactor.seconds()
+
+    def isOpen(self, connection):
+        'Is the session open, or opening, on connection?'
+        return self.channel is not None and self.channel.conn is connection
+
+    def outstanding(self):
+        'Number of requests waiting on the session'
+        if self.client is None:
+            return len(self.waiting)
+        return len(self.client.openRequests)
+
+    def getClient(self, connection, priority=PRIORITY_INTERACTIVE):
+        '''Return a Deferred firing with a FileTransferClient on connection.
+        '''
+        if self.client is not None and self.channel.conn is connection:
+            return defer.succeed(self.client)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if self.channel is None or self.channel.conn is not connection:
+            self.open(connection, priority)
+        return d
+
+    def open(self, connection, priority=PRIORITY_INTERACTIVE):
+        log.debug('Opening shared SFTP session')
+        self.client = None
+        clientHandle = defer.Deferred()
+        self.channel = SFTPChannel(clientHandle, connection=connection,
+                                   reactor=self.reactor, priority=priority)
+        # It stays open between operations.
+        self.channel.longLived = True
+        clientHandle.addCallbacks(self._cbOpened, self._ebOpened,
+                                  callbackArgs=(self.channel,),
+                                  errbackArgs=(self.channel,))
+        self.channel.onClose.addCallback(self._cbClosed)
+        connection.openChannel(self.channel)
+        return self.channel
+
+    def _cbOpened(self, client, channel):
+        if channel is not self.channel:
+            return
+        log.debug('Shared SFTP session ready')
+        self.client = client
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(client)
+
+    def _ebOpened(self, reason, channel):
+        if channel is not self.channel:
+            return
+        log.debug('Opening shared SFTP session failed: %s' % (reason,))
+        self.channel = None
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(reason)
+
+    def _cbClosed(self, channel):
+        if channel is self.channel:
+            log.debug('Shared SFTP session closed')
+            self.channel = None
+            self.client = None
+
+    def close(self):
+        channel, self.channel = self.channel, None
+        self.client = None
+        if channel is not None:
+            channel.loseConnection()
+
+
+class SFTPPool:
+    '''A pool of SFTP sessions on a connection.
+
+       One sftp-server handles its requests one at a time, so heavy
+       workloads are spread over up to maxSize sessions.  A request goes
+       to an idle session if there is one, else to a new session while
+       the pool is below maxSize, else to the session with the fewest
+       outstanding requests.  warm() opens minIdle sessions as soon as
+       the connection is up so the first operation doesn't wait for the
+       subsystem to start.  Sessions left unused for idleTimeout seconds
+       are closed, down to minIdle.  getClient() works like
+       SFTPSession.getClient().
+    '''
+
+    def __init__(self, minIdle=0, maxSize=1,
+                 idleTimeout=DEFAULT_IDLE_TIMEOUT, reactor=reactor):
+        self.minIdle = minIdle
+        self.maxSize = max(maxSize, minIdle, 1)
+        self.idleTimeout = idleTimeout
+        self.reactor = reactor
+        self.sessions = []
+        self.reapId = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def warm(self, connection):
+        'Open sessions on a new connection up to minIdle'
+        self._prune(connection)
+        while len(self.sessions) < self.minIdle:
+            log.debug('Pre-warming SFTP session %i' % len(self.sessions))
+            self._newSession().open(connection)
+
+    def getClient(self, connection, priority=PRIORITY_INTERACTIVE):
+        session = self.choose(connection)
+        session.lastUsed = self.reactor.seconds()
+        return session.getClient(connection, priority)
+
+    def choose(self, connection):
+        'Pick the session for the next request'
+        self._prune(connection)
+        for session in self.sessions:
+            if session.outstanding() == 0:
+                return session
+        if len(self.sessions) < self.maxSize:
+            return self._newSession()
+        return min(self.sessions, key=lambda session: session.outstanding())
+
+    def _newSession(self):
+        session = _PooledSession(self, self.reactor)
+        self.sessions.append(session)
+        self._startReaper()
+        return session
+
+    def _prune(self, connection):
+        # Drop sessions that closed or belong to an old connection.
+        self.sessions = [session for session in self.sessions
+                         if session.isOpen(connection) or
+                         (session.channel is None and session.waiting)]
+
+    def _sessionClosed(self, session):
+        self.sessions = [s for s in self.sessions
+                         if s.channel is not None or s.waiting]
+        if not self.sessions:
+            self._stopReaper()
+
+    def _startReaper(self):
+        if self.idleTimeout and self.reapId is None:
+            self.reapId = self.reactor.callLater(self.idleTimeout, self.reap)
+
+    def _stopReaper(self):
+        reapId, self.reapId = self.reapId, None
+        if reapId is not None and reapId.active():
+            reapId.cancel()
+
+    def reap(self):
+        'Close sessions idle for idleTimeout, keeping minIdle'
+        self.reapId = None
+        now = self.reactor.seconds()
+        for session in list(self.sessions):
+            if len(self.sessions) <= self.minIdle:
+                break
+            if session.outstanding() == 0 and \
+                    now - session.lastUsed >= self.idleTimeout:
+                log.debug('Closing idle SFTP session')
+                self.sessions.remove(session)
+                session.close()
+        if len(self.sessions) > self.minIdle:
+            self._startReaper()
+
+
+class _PooledSession(SFTPSession):
+    'SFTPSession that tells its pool when its channel closes'
+
+    def __init__(self, pool, reactor=reactor):
+        SFTPSession.__init__(self, reactor)
+        self.pool = pool
+
+    def _cbClosed(self, channel):
+        SFTPSession._cbClosed(self, channel)
+        if self.channel is None:
+            self.pool._sessionClosed(self)
+
+
+class TransferChunks:
+    '''Which parts of a file a transfer still has to move.
+
+       Chunks are handed out from a cursor that only moves forward; short
+       reads leave holes that are handed out again before the cursor moves
+       on.  Once the end of the file is known nothing past it is handed
+       out.  Every call is O(1) (amortized), however large the file.
+    '''
+
+    def __init__(self, bufSize, start=0):
+        self.bufSize = bufSize
+        self.offset = start
+        self.holes = collections.deque()
+        self.end = None
+
+    def next(self):
+        'Return the (offset, length) to transfer next, or None when done'
+        hole = self._nextHole()
+        if hole is not None:
+            return hole
+        if self.end is not None and self.offset >= self.end:
+            return None
+        length = self.bufSize
+        if self.end is not None:
+            length = min(length, self.end - self.offset)
+        chunk = (self.offset, length)
+        self.offset += length
+        return chunk
+
+    def _nextHole(self):
+        while self.holes:
+            offset, length = self.holes.popleft()
+            if self.end is None or offset < self.end:
+                return offset, length
+
+    def received(self, offset, length, size):
+        'size bytes of the length byte chunk at offset arrived'
+        if size < length:
+            self.holes.append((offset + size, length - size))
+
+    def eof(self, offset):
+        'The file ends at offset'
+        if self.end is None or offset < self.end:
+            self.end = offset
+
+
+class RangeChunks(TransferChunks):
+    '''TransferChunks for only some (offset, length) ranges of a file,
+       in order, as a delta transfer sends them.
+    '''
+
+    def __init__(self, bufSize, ranges):
+        TransferChunks.__init__(self, bufSize)
+        self.ranges = collections.deque(ranges)
+
+    def next(self):
+        hole = self._nextHole()
+        if hole is not None:
+            return hole
+        while self.ranges:
+            offset, length = self.ranges[0]
+            if self.end is not None and offset >= self.end:
+                return None
+            size = min(length, self.bufSize)
+            if size == length:
+                self.ranges.popleft()
+            else:
+                self.ranges[0] = (offset + size, length - size)
+            if self.end is not None:
+                size = min(size, self.end - offset)
+            return offset, size
+        return None
+
+
+class SFTPReader:
+    '''Push producer that reads an open remote file into a consumer.
+
+       Up to requests reads are kept in flight; their replies may arrive
+       out of order, so data is held until everything before it has been
+       written.  No new reads are asked for while the consumer is paused.
+       start() returns a Deferred that fires with the number of bytes
+       written once the file is done, or fails with the first read error;
+       if the consumer stops it, it fails with ConnectionLost.
+       With maxSize set, a file that turns out to be larger fails with
+       ValueError.  Only the part from start up to end (or EOF) is read;
+       the count fired with then includes start.
+    '''
+    implements(IPushProducer)
+
+    def __init__(self, remote, consumer, bufSize, requests, maxSize=None,
+                 start=0, end=None):
+        self.remote = remote
+        self.consumer = consumer
+        self.chunks = TransferChunks(bufSize, start)
+        if end is not None:
+            self.chunks.eof(end)
+        self.requests = requests
+        self.maxSize = maxSize
+        self.outstanding = 0
+        self.pending = {}  # offset: data received ahead of self.offset
+        self.offset = start  # end of what was written to the consumer
+        self.paused = False
+        self.stopped = False
+        self.exhausted = False
+        self.error = None
+        self.done = defer.Deferred()
+
+    def start(self):
+        self.consumer.registerProducer(self, True)
+        self._read()
+        return self.done
+
+    def _read(self):
+        while not (self.paused or self.stopped or self.exhausted) and \
+                self.error is None and self.outstanding < self.requests:
+            chunk = self.chunks.next()
+            if chunk is None:
+                self.exhausted = True
+                break
+            start, length = chunk
+            self.outstanding += 1
+            d = self.remote.readChunk(start, length)
+            d.addBoth(self._cbRead, start, length)
+        if self.outstanding == 0 and (self.exhausted or self.stopped or
+                                      self.error is not None):
+            self._finish()
+
+    def _cbRead(self, data, start, length):
+        self.outstanding -= 1
+        if isinstance(data, failure.Failure):
+            if data.check(EOFError):
+                self.chunks.eof(start)
+            elif self.error is None:
+                self.error = data
+        else:
+            self.chunks.received(start, length, len(data))
+            if data:
+                self.pending[start] = data
+                self._write()
+        # A short read may have left a hole to ask for.
+        self.exhausted = False
+        self._read()
+
+    def _write(self):
+        while self.offset in self.pending and not self.stopped and \
+                self.error is None:
+            data = self.pending.pop(self.offset)
+            self.offset += len(data)
+            if self.maxSize is not None and self.offset > self.maxSize:
+                self.error = failure.Failure(ValueError(
+                    'File is larger than %i bytes' % self.maxSize))
+                return
+            self.consumer.write(data)
+
+    def _finish(self):
+        if self.done.called:
+            return
+        self.pending = {}
+        self.consumer.unregisterProducer()
+        if self.error is not None:
+            self.done.errback(self.error)
+        else:
+            self.done.callback(self.offset)
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._read()
+
+    def stopProducing(self):
+        self.stopped = True
+        if self.error is None:
+            self.error = failure.Failure(error.ConnectionLost(
+                'The consumer stopped the transfer'))
+        self._read()
+
+
+class SFTPWriter:
+    '''Consumer that writes what it is given to an open remote file.
+
+       Data is cut into bufSize writes, up to requests of them in flight;
+       the rest waits in a queue and a registered producer is paused
+       until the queue has been sent.  After the first failed write the
+       queue is dropped and the producer stopped.  finish() returns a
+       Deferred that fires with the number of bytes written once every
+       write has been answered, or fails with the first error.
+    '''
+    implements(IConsumer)
+
+    def __init__(self, remote, bufSize, requests):
+        self.remote = remote
+        self.bufSize = bufSize
+        self.requests = requests
+        self.offset = 0  # where the next write goes
+        self.queue = collections.deque()
+        self.outstanding = 0
+        self.producer = None
+        self.paused = False
+        self.finishing = False
+        self.error = None
+        self.done = defer.Deferred()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if self.queue:
+            self._pause()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        for i in range(0, len(data), self.bufSize):
+            self.queue.append(data[i:i + self.bufSize])
+        self._send()
+        if self.queue:
+            self._pause()
+
+    def producerDone(self, result):
+        '''Callback for the Deferred from the producer's
+           startProducing(); finishes the file.
+        '''
+        self.unregisterProducer()
+        if isinstance(result, failure.Failure) and self.error is None:
+            self.error = result
+            self.queue.clear()
+        return self.finish()
+
+    def finish(self):
+        'No more data is coming; see the class docstring'
+        self.finishing = True
+        self._checkDone()
+        return self.done
+
+    def _pause(self):
+        if self.producer is not None and not self.paused:
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def _send(self):
+        while self.queue and self.error is None and \
+                self.outstanding < self.requests:
+            data = self.queue.popleft()
+            self.outstanding += 1
+            d = self.remote.writeChunk(self.offset, data)
+            self.offset += len(data)
+            d.addBoth(self._cbWrite)
+
+    def _cbWrite(self, result):
+        self.outstanding -= 1
+        if isinstance(result, failure.Failure):
+            if self.error is None:
+                self.error = result
+                self.queue.clear()
+                producer, self.producer = self.producer, None
+                if producer is not None:
+                    producer.stopProducing()
+        else:
+            self._send()
+            if self.paused and not self.queue and self.producer is not None:
+                self.paused = False
+                self.producer.resumeProducing()
+        self._checkDone()
+
+    def _checkDone(self):
+        if not self.finishing or self.outstanding or self.queue or \
+                self.done.called:
+            return
+        if self.error is not None:
+            self.done.errback(self.error)
+        else:
+            self.done.callback(self.offset)
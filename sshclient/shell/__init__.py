@@ -0,0 +1,237 @@
+from twisted.conch.ssh import common
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet.error import TimeoutError, ConnectionDone
+import uuid
+
+from sshclient.channel import CommandChannel, OutputBuffer, Results
+
+import logging
+log = logging.getLogger('txsshclient.shell')
+
+# Written to the shell's stdin for every command.  The command runs with
+# stdin from /dev/null so it can't swallow the commands queued behind it,
+# then a sentinel carrying the exit code is printed on stdout and a
+# second one on stderr so both streams can be split.
+SCRIPT = '''{ %(command)s
+} </dev/null
+printf '%(marker)s%(seq)d:%%d\\n' $?
+printf '%(marker)s%(seq)d\\n' >&2
+'''
+
+
+class SentinelSplitter:
+    '''Split a stream on lines that start with a marker.
+
+       feed() returns (output, sentinel) pairs.  sentinel is the rest of
+       the marker line, or None when the output isn't terminated yet.
+    '''
+
+    def __init__(self, marker):
+        self.marker = marker
+        self.partial = ''
+
+    def feed(self, data):
+        data = self.partial + data
+        self.partial = ''
+        pieces = []
+        while data:
+            index = data.find(self.marker)
+            if index == -1:
+                # Hold back anything that could be the start of a marker.
+                split = max(len(data) - len(self.marker) + 1, 0)
+                pieces.append((data[:split], None))
+                self.partial = data[split:]
+                break
+            end = data.find('\n', index)
+            if end == -1:
+                pieces.append((data[:index], None))
+                self.partial = data[index:]
+                break
+            pieces.append((data[:index],
+                           data[index + len(self.marker):end]))
+            data = data[end + 1:]
+        return pieces
+
+
+class ShellCommand:
+    'A command queued on a ShellChannel'
+
+    def __init__(self, command, seq, result, timeout=None):
+        self.command = command
+        self.seq = seq
+        self.result = result
+        self.timeout = timeout
+        self.timeoutId = None
+        self.out = OutputBuffer()
+        self.err = OutputBuffer()
+        self.exit = None
+        self.outDone = False
+        self.errDone = False
+
+
+class ShellChannel(CommandChannel):
+    '''A long lived remote shell that runs commands one after another.
+
+       Commands are written to the shell's stdin as soon as run() is called
+       and their output is split back apart with sentinel markers, so each
+       command costs about one round trip instead of a channel open, an
+       exec request and a close.  Commands share the shell's state: a cd
+       or an exported variable carries over to the commands after it.
+
+       A command that times out can't be interrupted on its own, so the
+       whole session is closed and the commands queued behind it fail.
+       result fires with the shell's Results once the session closes.
+    '''
+
+    longLived = True  # see connection.ChannelScheduler
+
+    def __init__(self, shell, result, commandTimeout=None,
+                 reactor=reactor, *args, **kwargs):
+        CommandChannel.__init__(self, shell, result, reactor=reactor,
+                                *args, **kwargs)
+        self.commandTimeout = commandTimeout
+        self.marker = 'txsshclient-%s:' % uuid.uuid4().hex
+        self.stdout = SentinelSplitter(self.marker)
+        self.stderr = SentinelSplitter(self.marker)
+        self.pending = []
+        self.seq = 0
+        self.started = False
+        self.closeRequested = False
+
+    def channelOpen(self, _):
+        log.debug('ShellChannel: starting shell "%s"' % self.command)
+        req = self.conn.sendRequest(self,
+                                    "exec",
+                                    common.NS(self.command),
+                                    wantReply=True)
+        req.addCallback(self._cbStarted)
+        req.addErrback(self._ebStarted)
+        return req
+
+    def _cbStarted(self, _):
+        self.started = True
+        for command in self.pending:
+            self.write(self.script(command))
+        self.startTimer()
+        if self.closeRequested:
+            self._sendEOF()
+
+    def openFailed(self, reason):
+        self._failPending()
+        CommandChannel.openFailed(self, reason)
+
+    def _ebStarted(self, reason):
+        log.debug('ShellChannel: shell failed to start %s' % reason)
+        self.loseConnection()
+
+    def script(self, command):
+        return SCRIPT % {'command': command.command,
+                         'marker': self.marker,
+                         'seq': command.seq}
+
+    def run(self, command, timeout=None):
+        '''run a command in the shell.
+           @param: command: a command to run. (string)
+           @param: timeout: An optional timeout. (int/float)
+           returns a deferred.
+        '''
+        d = defer.Deferred()
+        if self.closing or self.localClosed or self.closeRequested:
+            d.errback(ConnectionDone('Shell session closed'))
+            return d
+        self.seq += 1
+        command = ShellCommand(command, self.seq, d,
+                               timeout or self.commandTimeout)
+        self.pending.append(command)
+        if self.started:
+            self.write(self.script(command))
+            self.startTimer()
+        return d
+
+    def close(self):
+        'Let the shell exit once the queued commands are done'
+        if self.closeRequested:
+            return
+        self.closeRequested = True
+        # Commands still waiting for the shell or the window are written
+        # before the EOF.
+        if self.started:
+            self._sendEOF()
+
+    def startTimer(self):
+        # Only the command at the head of the queue is running.
+        if not self.pending:
+            return
+        command = self.pending[0]
+        if command.timeout and not command.timeoutId:
+            command.timeoutId = self.reactor.callLater(command.timeout,
+                                                       self._timeoutCalled)
+
+    def timeoutCancel(self):
+        if self.pending:
+            timeoutId, self.pending[0].timeoutId = \
+                self.pending[0].timeoutId, None
+            if timeoutId:
+                timeoutId.cancel()
+
+    def _timeoutCalled(self):
+        command = self.pending.pop(0)
+        log.debug('ShellChannel: "%s" timed out' % command.command)
+        command.timeoutId = None
+        command.result.errback(TimeoutError())
+        self.loseConnection()
+
+    def _running(self, done):
+        for command in self.pending:
+            if not getattr(command, done):
+                return command
+
+    def dataReceived(self, data):
+        for output, sentinel in self.stdout.feed(data):
+            command = self._running('outDone')
+            if command is None:
+                self.data.write(output)
+                continue
+            command.out.write(output)
+            if sentinel is not None:
+                command.exit = int(sentinel.split(':')[1])
+                command.outDone = True
+                self._checkDone()
+
+    def extReceived(self, dataType, data):
+        if dataType != 1:
+            return
+        for output, sentinel in self.stderr.feed(data):
+            command = self._running('errDone')
+            if command is None:
+                self.err.write(output)
+                continue
+            command.err.write(output)
+            if sentinel is not None:
+                command.errDone = True
+                self._checkDone()
+
+    def _checkDone(self):
+        while self.pending and \
+                self.pending[0].outDone and self.pending[0].errDone:
+            self.timeoutCancel()
+            command = self.pending.pop(0)
+            command.result.callback(Results(command.command,
+                                            command.out.getvalue(),
+                                            command.exit,
+                                            command.err.getvalue()))
+            self.startTimer()
+
+    def eofReceived(self):
+        pass
+
+    def closed(self):
+        self._failPending()
+        CommandChannel.closed(self)
+
+    def _failPending(self):
+        self.timeoutCancel()
+        pending, self.pending = self.pending, []
+        for command in pending:
+            command.result.errback(ConnectionDone('Shell session closed'))
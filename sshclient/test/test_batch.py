@@ -0,0 +1,29 @@
+from sshclient.batch import FrameSplitter, MARKER
+from twisted.trial.unittest import TestCase
+
+
+def frame(index, exit, out, err):
+    return '%s %d %d %d %d\n%s%s' % (MARKER, index, exit, len(out),
+                                     len(err), out, err)
+
+
+class FrameSplitterTestCase(TestCase):
+    def test_split_across_chunks(self):
+        output = (frame(0, 0, 'hi\n', '') +
+                  frame(1, 2, 'line\n' * 100, 'oops\n') +
+                  frame(2, 0, '', '') +
+                  frame(3, 1, '\0\n' + MARKER + ' 9 9 9 9\n', ''))
+        for size in (1, 7, 4096):
+            splitter = FrameSplitter()
+            frames = []
+            for i in range(0, len(output), size):
+                frames.extend(splitter.feed(output[i:i + size]))
+            self.assertEqual(frames,
+                             [(0, 0, 'hi\n', ''),
+                              (1, 2, 'line\n' * 100, 'oops\n'),
+                              (2, 0, '', ''),
+                              (3, 1, '\0\n' + MARKER + ' 9 9 9 9\n', '')])
+
+    def test_bad_header(self):
+        splitter = FrameSplitter()
+        self.assertRaises(ValueError, splitter.feed, 'motd banner\n')
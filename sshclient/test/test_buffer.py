@@ -0,0 +1,82 @@
+from sshclient.channel import OutputBuffer, SpoolingBuffer, SpooledOutput
+from sshclient.channel import DiscardBuffer, CappedBuffer, TailBuffer
+from twisted.trial.unittest import TestCase
+
+
+class OutputBufferTestCase(TestCase):
+    def test_empty(self):
+        buf = OutputBuffer()
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.getvalue(), '')
+
+    def test_write_joins_once(self):
+        buf = OutputBuffer()
+        for chunk in ('hello', '', ' ', 'world'):
+            buf.write(chunk)
+        self.assertEqual(len(buf), 11)
+        self.assertEqual(buf.getvalue(), 'hello world')
+        self.assertEqual(buf.chunks, ['hello world'])
+        self.assertEqual(buf.memoryview()[6:].tobytes(), 'world')
+
+
+class SpoolingBufferTestCase(TestCase):
+    def test_small_output_stays_in_memory(self):
+        buf = SpoolingBuffer(10)
+        buf.write('0123456789')
+        self.assertIdentical(buf.file, None)
+        self.assertEqual(buf.getvalue(), '0123456789')
+
+    def test_large_output_spills(self):
+        buf = SpoolingBuffer(10)
+        buf.write('01234')
+        buf.write('56789abcdef')
+        buf.write('\nmore')
+        self.assertNotIdentical(buf.file, None)
+        self.assertEqual(buf.chunks, [])
+
+        output = buf.getvalue()
+        self.assertIsInstance(output, SpooledOutput)
+        self.assertEqual(len(output), 21)
+        self.assertEqual(list(output), ['0123456789abcdef\n', 'more'])
+        self.assertEqual(output.mmap()[10:16], 'abcdef')
+        output.close()
+
+
+class CaptureBufferTestCase(TestCase):
+    def test_discard(self):
+        buf = DiscardBuffer()
+        buf.write('hello')
+        self.assertEqual(len(buf), 5)
+        self.assertEqual(buf.getvalue(), '')
+        self.assertTrue(buf.truncated)
+
+    def test_capped(self):
+        full = []
+        buf = CappedBuffer(8, OutputBuffer(), lambda: full.append(True))
+        buf.write('0123')
+        buf.write('4567')
+        self.assertFalse(buf.truncated)
+        buf.write('89')
+        buf.write('ab')
+        self.assertEqual(buf.getvalue(), '01234567')
+        self.assertTrue(buf.truncated)
+        self.assertEqual(full, [True])
+
+    def test_capped_spooling(self):
+        buf = CappedBuffer(8, SpoolingBuffer(4))
+        buf.write('0123456789')
+        output = buf.getvalue()
+        self.assertEqual(output.read(), '01234567')
+        output.close()
+
+    def test_tail(self):
+        buf = TailBuffer(8)
+        buf.write('0123')
+        self.assertFalse(buf.truncated)
+        for chunk in ('4567', '89', 'abcd'):
+            buf.write(chunk)
+        self.assertTrue(len(buf.chunks) <= 3)
+        self.assertEqual(buf.getvalue(), '6789abcd')
+        self.assertTrue(buf.truncated)
+        buf.write('ef')
+        self.assertEqual(buf.getvalue(), '89abcdef')
@@ -0,0 +1,93 @@
+from sshclient.cache import ResultCache, SingleFlight
+from twisted.internet import defer
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+
+class ResultCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResultCache(maxSize=2, staleTTL=5,
+                                 clock=self.clock.seconds)
+
+    def test_fresh_stale_expired(self):
+        self.cache.put('uname', 'Linux', 10)
+        self.assertEqual(self.cache.get('uname'), ('Linux', True))
+
+        self.clock.advance(12)
+        self.assertEqual(self.cache.get('uname'), ('Linux', False))
+        self.assertTrue(self.cache.startRefresh('uname'))
+        self.assertFalse(self.cache.startRefresh('uname'))
+        self.cache.refreshFailed('uname')
+        self.assertTrue(self.cache.startRefresh('uname'))
+
+        self.clock.advance(3)
+        self.assertEqual(self.cache.get('uname'), (None, False))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', 1, 10)
+        self.cache.put('b', 2, 10)
+        self.cache.get('a')
+        self.cache.put('c', 3, 10)
+        self.assertTrue('a' in self.cache)
+        self.assertFalse('b' in self.cache)
+        self.assertTrue('c' in self.cache)
+
+    def test_invalidate_tag(self):
+        self.cache.put('cat /etc/hosts', 'hosts', 10, tags=['/etc/hosts'])
+        self.cache.put('uname', 'Linux', 10, tags=['/proc/version'])
+        self.cache.invalidateTag('/etc/hosts')
+        self.assertFalse('cat /etc/hosts' in self.cache)
+        self.assertTrue('uname' in self.cache)
+        self.assertEqual(self.cache.tags.keys(), ['/proc/version'])
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.inflight = SingleFlight(self.clock)
+        self.started = []
+
+    def start(self):
+        d = defer.Deferred()
+        self.started.append(d)
+        return d
+
+    def test_shared_result(self):
+        first = self.inflight.call('uname', self.start)
+        second = self.inflight.call('uname', self.start)
+        self.assertEqual(len(self.started), 1)
+
+        self.started[0].callback('Linux')
+        self.assertEqual(self.successResultOf(first), 'Linux')
+        self.assertEqual(self.successResultOf(second), 'Linux')
+        self.assertFalse('uname' in self.inflight)
+
+        self.inflight.call('uname', self.start)
+        self.assertEqual(len(self.started), 2)
+
+    def test_per_caller_timeout(self):
+        first = self.inflight.call('uname', self.start, timeout=1)
+        second = self.inflight.call('uname', self.start, timeout=5)
+        self.clock.advance(2)
+        self.failureResultOf(first, TimeoutError)
+        self.assertNoResult(second)
+        self.assertFalse(self.started[0].called)
+
+        self.started[0].callback('Linux')
+        self.assertEqual(self.successResultOf(second), 'Linux')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel_last_caller_cancels_operation(self):
+        first = self.inflight.call('uname', self.start)
+        second = self.inflight.call('uname', self.start)
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertFalse(self.started[0].called)
+
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertTrue(self.started[0].called)
+        self.assertFalse('uname' in self.inflight)
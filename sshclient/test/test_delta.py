@@ -0,0 +1,76 @@
+from sshclient.delta import helperCommand, parseDeltas, rangeStats
+from sshclient.delta.helper import blockSize, deltas, signatures
+from twisted.trial.unittest import TestCase
+from StringIO import StringIO
+
+import random
+import subprocess
+
+
+class DeltasTestCase(TestCase):
+    def setUp(self):
+        self.old = ''.join([chr(random.randrange(256))
+                            for i in range(20000)])
+
+    def delta(self, new, old=None):
+        'Return the ranges for new and check that they rebuild it'
+        if old is None:
+            old = self.old
+        block = 1024
+        sums = list(signatures(StringIO(old), block))
+        ranges = list(deltas(StringIO(new), len(old), block, sums))
+        rebuilt = ''
+        for offset, oldOffset, length in ranges:
+            self.assertEqual(offset, len(rebuilt))
+            if oldOffset is None:
+                rebuilt += new[offset:offset + length]
+            else:
+                rebuilt += old[oldOffset:oldOffset + length]
+        self.assertEqual(rebuilt, new)
+        return ranges
+
+    def test_unchanged(self):
+        self.assertEqual(self.delta(self.old), [(0, 0, 20000)])
+
+    def test_changed_in_place(self):
+        new = self.old[:5000] + 'x' * 10 + self.old[5010:]
+        self.assertEqual(self.delta(new), [(0, 0, 4096),
+                                           (4096, None, 1024),
+                                           (5120, 5120, 14880)])
+
+    def test_inserted(self):
+        new = self.old[:5000] + 'inserted' + self.old[5000:]
+        ranges = self.delta(new)
+        self.assertEqual(rangeStats(ranges)['sent'], 1024 + 8)
+        # Everything after the insertion is found shifted
+        self.assertEqual(ranges[-1], (5120 + 8, 5120, 14880))
+
+    def test_removed(self):
+        new = self.old[:5000] + self.old[7000:]
+        # From the block it was in to the old block at 7168, now at 5168
+        self.assertEqual(rangeStats(self.delta(new))['sent'], 5168 - 4096)
+
+    def test_empty(self):
+        self.assertEqual(self.delta(''), [])
+        self.assertEqual(self.delta('new', old=''), [(0, None, 3)])
+
+    def test_block_size(self):
+        self.assertEqual(blockSize(0), 2048)
+        self.assertEqual(blockSize(1024 ** 3), 32768)
+        self.assertEqual(blockSize(1024 ** 4), 131072)
+
+
+class HelperTestCase(TestCase):
+    def test_command(self):
+        'The helper runs as a python -c script'
+        path = self.mktemp()
+        open(path, 'w').write('data\n' * 1000)
+        command = helperCommand('python', 'delta', path)
+        process = subprocess.Popen(command, shell=True,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate('0 2048\n')[0]
+        self.assertEqual(process.returncode, 0)
+        ranges, md5 = parseDeltas(StringIO(output))
+        self.assertEqual(ranges, [(0, None, 5000)])
+        self.assertEqual(len(md5), 32)
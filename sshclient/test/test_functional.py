@@ -1,8 +1,18 @@
 from test_common import SSHServer, ServerProtocol, ClientProtocol
+import sshclient
 from sshclient import SSHClient
+from sshclient import CAPTURE_DISCARD, CAPTURE_HEAD, CAPTURE_TAIL
+from sshclient.cache import ResultCache
+from sshclient.parsers import TableParser
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor, defer
+from twisted.internet.task import deferLater
+from twisted.internet.error import TimeoutError, ConnectionDone
+from twisted.python.failure import Failure
+from twisted.web.client import FileBodyProducer
+from StringIO import StringIO
 from twisted.conch.ssh.filetransfer import SFTPError
+from twisted.conch.ssh.connection import OPEN_CONNECT_FAILED
 
 import getpass
 import logging
@@ -22,6 +32,27 @@ def touch(path):
         os.utime(path, None)
 
 
+class PausingConsumer:
+    'Consumer that pauses its producer after the first write'
+
+    def __init__(self):
+        self.producer = None
+        self.received = 0
+        self.paused = defer.Deferred()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.received += len(data)
+        if not self.paused.called:
+            self.producer.pauseProducing()
+            self.paused.callback(None)
+
+
 class IPV4FunctionalBaseTestCase(TestCase):
     def setUp(self):
         self.hostname = '127.0.0.1'
@@ -73,6 +104,427 @@ class IPV4FunctionalBaseTestCase(TestCase):
         d.addCallback(got_hi)
         return d
 
+    @defer.inlineCallbacks
+    def test_run_many(self):
+        finished = []
+        commands = ['sleep 0.5 && echo %i' % i for i in range(5)]
+        results = yield self.client.runMany(
+            commands,
+            concurrency=2,
+            onResult=lambda index, result: finished.append(index))
+
+        self.assertEqual([r.output for r in results],
+                         ['%i\n' % i for i in range(5)])
+        self.assertEqual(sorted(finished), range(5))
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_run_many_queued_channels(self):
+        self.client.options['maxchannels'] = 2
+        results = yield self.client.runMany(['echo %i' % i for i in range(5)])
+        self.assertEqual([r.output for r in results],
+                         ['%i\n' % i for i in range(5)])
+        self.assertEqual(self.client.connection.scheduler.limit, 2)
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_run_queued_timeout(self):
+        'A run() waiting behind maxchannels times out and is dropped'
+        self.client.options['maxchannels'] = 1
+        running = self.client.run('sleep 1')
+        queued = self.client.run('echo hi', timeout=0.2)
+        yield self.assertFailure(queued, TimeoutError)
+        result = yield running
+        self.assertEqual(result.exitCode, 0)
+        # It was dropped from the queue rather than opened late
+        self.assertEqual(self.client.connection.scheduler.queue, [])
+
+    @defer.inlineCallbacks
+    def test_run_queued_disconnect(self):
+        'A run() waiting behind maxchannels fails when the connection goes'
+        self.client.options['maxchannels'] = 1
+        running = self.client.run('sleep 1')
+        queued = self.client.run('echo hi')
+        yield deferLater(reactor, 0.2, lambda: None)
+        self.client.disconnect()
+        yield running
+        results = yield defer.DeferredList([queued], consumeErrors=True)
+        # The channel failed itself, before the connection lost errback
+        self.assertEqual(results[0][1].value,
+                         (OPEN_CONNECT_FAILED,
+                          'Connection lost before the channel was opened'))
+
+    @defer.inlineCallbacks
+    def test_run_many_timeout(self):
+        results = yield self.client.runMany(['sleep 2', 'echo hi'],
+                                            timeout=1)
+        self.assertIsInstance(results[0], Failure)
+        results[0].trap(TimeoutError)
+        self.assertEqual(results[1].output, 'hi\n')
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_run_command_cached(self):
+        try:
+            sandbox = tempfile.mkdtemp()
+            path = '/'.join([sandbox, 'cached'])
+            open(path, 'w').write('one')
+            self.client.resultCache = ResultCache()
+
+            first = yield self.client.run('cat %s' % path, cacheTTL=60,
+                                          cacheTags=[path])
+            open(path, 'w').write('two')
+            second = yield self.client.run('cat %s' % path, cacheTTL=60,
+                                           cacheTags=[path])
+            self.assertIdentical(first, second)
+            self.assertEqual(second.output, 'one')
+
+            yield self.client.chmod(path, '644')
+            third = yield self.client.run('cat %s' % path, cacheTTL=60,
+                                          cacheTags=[path])
+            self.assertEqual(third.output, 'two')
+            defer.returnValue(third)
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_run_command_coalesced(self):
+        command = 'sleep 0.5; echo $$'
+        impatient = self.client.run(command, timeout=0.1, coalesce=True)
+        first = self.client.run(command, coalesce=True)
+        second = self.client.run(command, coalesce=True)
+        self.assertTrue(('run', command, None) in self.client.inflight)
+
+        yield self.assertFailure(impatient, TimeoutError)
+        first = yield first
+        second = yield second
+        self.assertIdentical(first, second)
+        self.assertFalse(('run', command, None) in self.client.inflight)
+        defer.returnValue(second)
+
+    @defer.inlineCallbacks
+    def test_run_command_coalesced_cancel(self):
+        command = 'sleep 5'
+        first = self.client.run(command, coalesce=True)
+        second = self.client.run(command, coalesce=True)
+        yield deferLater(reactor, 0.2, lambda: None)
+        first.cancel()
+        second.cancel()
+        yield self.assertFailure(first, defer.CancelledError)
+        yield self.assertFailure(second, defer.CancelledError)
+        self.assertFalse(('run', command, None) in self.client.inflight)
+
+    @defer.inlineCallbacks
+    def test_run_command_coalesced_spoolsize(self):
+        'Coalescing works with spoolsize set; spooled output isn\'t shared'
+        self.client.options['spoolsize'] = 1024
+        command = 'sleep 0.5; echo $$'
+        first = self.client.run(command, coalesce=True)
+        second = self.client.run(command, coalesce=True)
+        self.assertTrue(('run', command, 1024) in self.client.inflight)
+        first = yield first
+        second = yield second
+        self.assertIdentical(first, second)
+
+        command = 'sleep 0.5; head -c 100000 /dev/zero'
+        first = self.client.run(command, coalesce=True)
+        second = self.client.run(command, coalesce=True)
+        first = yield first
+        second = yield second
+        self.assertNotIdentical(first.output, second.output)
+        self.assertEqual(first.output.read(), '\0' * 100000)
+        self.assertEqual(second.output.read(), '\0' * 100000)
+
+    @defer.inlineCallbacks
+    def test_shells_leave_room_for_run(self):
+        'Open shells never take the last of maxchannels'
+        self.client.options['maxchannels'] = 2
+        first = self.client.openShell()
+        second = self.client.openShell()
+        result = yield first.run('echo one')
+        self.assertEqual(result.output, 'one\n')
+
+        result = yield self.client.run('echo hi', timeout=5)
+        self.assertEqual(result.output, 'hi\n')
+
+        # The second shell opens once the first is closed
+        waiting = second.run('echo two')
+        first.close()
+        result = yield waiting
+        self.assertEqual(result.output, 'two\n')
+        second.close()
+        yield defer.gatherResults([first.result, second.result])
+
+    @defer.inlineCallbacks
+    def test_shell_session(self):
+        session = self.client.openShell()
+        first = session.run('cd /tmp; printf hi')
+        second = session.run('pwd; echo oops >&2; exit_code() { return 3; }'
+                             '; exit_code')
+        third = session.run('cat')
+
+        result = yield first
+        self.assertEqual(result.output, 'hi')
+        self.assertEqual(result.exitCode, 0)
+
+        result = yield second
+        self.assertEqual(result.output, '/tmp\n')
+        self.assertEqual(result.stderr, 'oops\n')
+        self.assertEqual(result.exitCode, 3)
+
+        # Commands can't read the queued commands from stdin.
+        result = yield third
+        self.assertEqual(result.output, '')
+
+        session.close()
+        result = yield session.result
+        self.assertEqual(result.exitCode, 0)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def test_shell_session_close_queued(self):
+        'Commands still waiting on the window or the shell run before EOF'
+        session = self.client.openShell()
+        early = session.run('echo early')
+        session.close()
+        result = yield early
+        self.assertEqual(result.output, 'early\n')
+
+        session = self.client.openShell()
+        yield session.run('true')
+        big = session.run('echo %s | wc -c' % ('x' * (1024 * 1024)))
+        last = session.run('echo last')
+        session.close()
+        result = yield big
+        self.assertEqual(result.output.strip(), str(1024 * 1024 + 1))
+        result = yield last
+        self.assertEqual(result.output, 'last\n')
+
+    @defer.inlineCallbacks
+    def test_shell_session_timeout(self):
+        session = self.client.openShell()
+        slow = session.run('sleep 2', timeout=1)
+        queued = session.run('echo hi')
+        yield self.assertFailure(slow, TimeoutError)
+        yield self.assertFailure(queued, ConnectionDone)
+
+    def test_run_command_stdin(self):
+        d = self.client.run('cat', stdin='hello')
+
+        def got_hello(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, 'hello')
+            return data
+
+        d.addCallback(got_hello)
+        return d
+
+    @defer.inlineCallbacks
+    def test_run_command_stdin_file(self):
+        size = 4 * 1024 * 1024
+        stdin = tempfile.TemporaryFile()
+        stdin.write('x' * size)
+        stdin.seek(0)
+        result = yield self.client.run('wc -c', stdin=stdin)
+        self.assertEqual(int(result.output), size)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def test_run_command_stdin_producer(self):
+        size = 4 * 1024 * 1024
+        producer = FileBodyProducer(StringIO('x' * size))
+        result = yield self.client.run('wc -c', stdin=producer)
+        self.assertEqual(int(result.output), size)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def test_run_batch(self):
+        finished = []
+        results = yield self.client.runBatch(
+            ['pwd', 'echo oops >&2; exit 3', 'cd /; x=1; pwd',
+             'echo $x; pwd; cat'],
+            onResult=lambda index, result: finished.append(index))
+        self.assertEqual(finished, [0, 1, 2, 3])
+        # Each command starts afresh, like its own exec.
+        cwd = results[0].output
+        self.assertEqual([(r.exitCode, r.output, r.stderr) for r in results],
+                         [(0, cwd, ''),
+                          (3, '', 'oops\n'),
+                          (0, '/\n', ''),
+                          (0, '\n' + cwd, '')])
+
+    @defer.inlineCallbacks
+    def test_run_many_batched(self):
+        commands = ['echo %i' % i for i in range(7)]
+        results = yield self.client.runMany(commands, concurrency=2,
+                                            batchSize=3)
+        self.assertEqual([r.output for r in results],
+                         ['%i\n' % i for i in range(7)])
+
+    @defer.inlineCallbacks
+    def test_run_batch_timeout(self):
+        results = yield self.client.runBatch(['echo hi', 'sleep 5',
+                                              'echo late'], timeout=1)
+        self.assertEqual(results[0].output, 'hi\n')
+        self.assertTrue(isinstance(results[1], Failure))
+        results[1].trap(TimeoutError)
+        results[2].trap(TimeoutError)
+
+    def test_run_command_spooled(self):
+        d = self.client.run('head -c 100000 /dev/zero', spoolSize=1024)
+
+        def got_zeros(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(len(data.output), 100000)
+            self.assertEqual(data.output.read(), '\0' * 100000)
+            self.assertEqual(data.stderr, '')
+            data.output.close()
+            return data
+
+        d.addCallback(got_zeros)
+        return d
+
+    def test_run_command_window_options(self):
+        self.client.options.update({'windowsize': 16384,
+                                    'maxpacket': 8192,
+                                    'autotune': True})
+        d = self.client.run('head -c 1000000 /dev/zero')
+
+        def got_zeros(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, '\0' * 1000000)
+            self.assertTrue(self.client.connection.rtt is not None)
+            return data
+
+        d.addCallback(got_zeros)
+        return d
+
+    def test_run_command_discard(self):
+        d = self.client.run('head -c 100000 /dev/zero; echo oops >&2',
+                            capture=CAPTURE_DISCARD)
+
+        def got_results(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, '')
+            self.assertEqual(data.stderr, 'oops\n')
+            self.assertTrue(data.truncated)
+            return data
+
+        d.addCallback(got_results)
+        return d
+
+    def test_run_command_capped(self):
+        # Never exits on its own; the cap has to stop it.
+        d = self.client.run('yes', capture=CAPTURE_HEAD, captureSize=1000)
+
+        def got_results(data):
+            self.assertEqual(data.output, 'y\n' * 500)
+            self.assertTrue(data.truncated)
+            return data
+
+        d.addCallback(got_results)
+        return d
+
+    def test_run_command_tail(self):
+        d = self.client.run('seq 1 100000', capture=CAPTURE_TAIL,
+                            captureSize=13)
+
+        def got_results(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, '99999\n100000\n')
+            self.assertTrue(data.truncated)
+            return data
+
+        d.addCallback(got_results)
+        return d
+
+    def test_run_command_parsed(self):
+        d = self.client.run('printf "a b\\n1 2\\n3 4\\n"',
+                            parser=TableParser())
+
+        def got_records(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, [{'a': '1', 'b': '2'},
+                                           {'a': '3', 'b': '4'}])
+            return data
+
+        d.addCallback(got_records)
+        return d
+
+    def test_run_command_parse_error(self):
+        d = self.client.run('printf "a\\nx\\n"',
+                            parser=TableParser(convert={'a': int}))
+        return self.assertFailure(d, ValueError)
+
+    def test_stream_command(self):
+        chunks = []
+        errors = []
+        d = self.client.stream('echo hi; echo oops >&2', chunks.append,
+                               errConsumer=errors.append)
+
+        def got_hi(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, '')
+            self.assertEqual(''.join(chunks), 'hi\n')
+            self.assertEqual(''.join(errors), 'oops\n')
+            return data
+
+        d.addCallback(got_hi)
+        return d
+
+    @defer.inlineCallbacks
+    def test_stream_command_backpressure(self):
+        size = 1024 * 1024
+        consumer = PausingConsumer()
+        d = self.client.stream('head -c %d /dev/zero' % size, consumer)
+
+        yield consumer.paused
+        yield deferLater(reactor, 0.5, lambda: None)
+        # The remote side can not send more than one window while paused.
+        self.assertTrue(consumer.received <= 131072)
+        self.assertFalse(d.called)
+
+        consumer.producer.resumeProducing()
+        result = yield d
+        self.assertEqual(result.exitCode, 0)
+        self.assertEqual(consumer.received, size)
+        defer.returnValue(result)
+
+    def test_run_lines(self):
+        batches = []
+        d = self.client.runLines('seq 1 5000; printf end', batches.append)
+
+        def got_lines(data):
+            self.assertEqual(data.exitCode, 0)
+            self.assertEqual(data.output, '')
+            lines = [line for batch in batches for line in batch]
+            self.assertEqual(lines,
+                             [str(i) for i in range(1, 5001)] + ['end'])
+            return data
+
+        d.addCallback(got_lines)
+        return d
+
+    @defer.inlineCallbacks
+    def test_iter_lines(self):
+        lines = self.client.iterLines('seq 1 200000', maxBatches=1)
+        # Nothing is read for a while; the command must wait for us.
+        # Only the rest of the open window (128KB) can arrive meanwhile.
+        yield deferLater(reactor, 0.5, lambda: None)
+        buffered = sum(len(line) + 1 for batch in lines.batches
+                       for line in batch)
+        self.assertTrue(buffered <= 131072)
+        self.assertFalse(lines.finished)
+
+        received = []
+        while True:
+            batch = yield lines.next()
+            if batch is None:
+                break
+            received.extend(batch)
+        self.assertEqual(received, [str(i) for i in range(1, 200001)])
+        self.assertEqual(lines.results.exitCode, 0)
+
     @defer.inlineCallbacks
     def test_lsdir(self):
         try:
@@ -104,6 +556,50 @@ class IPV4FunctionalBaseTestCase(TestCase):
         finally:
             shutil.rmtree(sandbox)
 
+    @defer.inlineCallbacks
+    def test_sftp_session_shared(self):
+        try:
+            sandbox = tempfile.mkdtemp()
+            directories = ['/'.join([sandbox, str(i)]) for i in range(20)]
+            yield self.client.mkdir(directories[0])
+            pool = self.client.sftpPool
+            channel = pool.sessions[0].channel
+            # Concurrent operations are multiplexed on the one channel
+            yield defer.gatherResults([self.client.mkdir(directory)
+                                       for directory in directories[1:]])
+            self.assertEqual(len(pool), 1)
+            self.assertIdentical(pool.sessions[0].channel, channel)
+            self.assertEqual(sorted(os.listdir(sandbox)),
+                             sorted(str(i) for i in range(20)))
+
+            # A session that dies is replaced on the next operation
+            channel.loseConnection()
+            yield channel.onClose
+            result = yield self.client.ls(sandbox)
+            self.assertEqual(len(result), 20)
+            self.assertEqual(len(pool), 1)
+            self.assertNotIdentical(pool.sessions[0].channel, channel)
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_sftp_pool(self):
+        pool = self.client.sftpPool
+        pool.minIdle, pool.maxSize = 2, 3
+        try:
+            sandbox = tempfile.mkdtemp()
+            yield self.client.ls(sandbox)
+            # Warm the pool up to the new settings
+            pool.warm(self.client.connection)
+            self.assertEqual(len(pool), 2)
+            yield defer.gatherResults([
+                self.client.mkdir('/'.join([sandbox, str(i)]))
+                for i in range(12)])
+            self.assertEqual(len(pool), 3)
+            self.assertEqual(len(os.listdir(sandbox)), 12)
+        finally:
+            shutil.rmtree(sandbox)
+
     @defer.inlineCallbacks
     def test_rmdir(self):
         try:
@@ -196,6 +692,43 @@ class IPV4FunctionalBaseTestCase(TestCase):
             shutil.rmtree(source_sandbox)
             shutil.rmtree(destination_sandbox)
 
+    @defer.inlineCallbacks
+    def test_put_bytes(self):
+        try:
+            self.client.options.update({'buffersize': 4096,
+                                        'sftprequests': 8})
+            source_data = os.urandom(64 * 1024 + 17)
+            destination_sandbox = tempfile.mkdtemp()
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+
+            size = yield self.client.putBytes(source_data, destination_path)
+            self.assertEqual(size, len(source_data))
+            self.assertEqual(source_data,
+                             open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_from_producer(self):
+        try:
+            self.client.options.update({'buffersize': 4096,
+                                        'sftprequests': 8})
+            source_data = os.urandom(256 * 1024 + 17)
+            destination_sandbox = tempfile.mkdtemp()
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+
+            producer = FileBodyProducer(StringIO(source_data),
+                                        readSize=16384)
+            size = yield self.client.putFromProducer(producer,
+                                                     destination_path)
+            self.assertEqual(size, len(source_data))
+            self.assertEqual(source_data,
+                             open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(destination_sandbox)
+
     @defer.inlineCallbacks
     def test_get(self):
         try:
@@ -221,6 +754,597 @@ class IPV4FunctionalBaseTestCase(TestCase):
             shutil.rmtree(source_sandbox)
             shutil.rmtree(destination_sandbox)
 
+    @defer.inlineCallbacks
+    def test_get_pipelined(self):
+        try:
+            # Many small chunks, read several at a time
+            self.client.options.update({'buffersize': 4096,
+                                        'sftprequests': 8})
+            source_data = os.urandom(1024 * 1024 + 17)
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').write(source_data)
+
+            yield self.client.get(source_path, destination_path)
+            self.assertEqual(source_data,
+                             open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_pipelined(self):
+        try:
+            self.client.options.update({'buffersize': 4096,
+                                        'sftprequests': 8})
+            source_data = os.urandom(1024 * 1024 + 17)
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').write(source_data)
+
+            yield self.client.put(source_path, destination_path)
+            self.assertEqual(source_data,
+                             open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_empty(self):
+        try:
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').close()
+
+            yield self.client.put(source_path, destination_path)
+            self.assertEqual('', open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_exact_multiple(self):
+        'A file of whole buffers, with fewer than sftprequests of them'
+        try:
+            source_data = os.urandom(2 * 32768)
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').write(source_data)
+
+            yield self.client.put(source_path, destination_path)
+            self.assertEqual(source_data,
+                             open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_get_bytes(self):
+        try:
+            source_data = 'key: value\n' * 1000
+            source_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            open(source_path, 'w').write(source_data)
+
+            result = yield self.client.getBytes(source_path)
+            self.assertEqual(result, source_data)
+            yield self.assertFailure(self.client.getBytes(source_path,
+                                                          maxSize=100),
+                                     ValueError)
+        finally:
+            shutil.rmtree(source_sandbox)
+
+    @defer.inlineCallbacks
+    def test_get_to_consumer(self):
+        try:
+            self.client.options.update({'buffersize': 4096,
+                                        'sftprequests': 8})
+            source_data = os.urandom(256 * 1024 + 17)
+            source_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            open(source_path, 'w').write(source_data)
+
+            class SlowConsumer:
+                'Pauses after every write and resumes a little later'
+                def __init__(self):
+                    self.data = []
+
+                def registerProducer(self, producer, streaming):
+                    self.producer = producer
+
+                def unregisterProducer(self):
+                    self.producer = None
+
+                def write(self, data):
+                    self.data.append(data)
+                    self.producer.pauseProducing()
+                    reactor.callLater(0, self.producer.resumeProducing)
+
+            consumer = SlowConsumer()
+            size = yield self.client.getToConsumer(source_path, consumer)
+            self.assertEqual(size, len(source_data))
+            self.assertEqual(''.join(consumer.data), source_data)
+        finally:
+            shutil.rmtree(source_sandbox)
+
+    def bigFile(self, sandbox):
+        'An 8MB file, too big to transfer within the tests\' timeouts'
+        path = '/'.join([sandbox, 'test_source_file'])
+        open(path, 'w').write(os.urandom(8 * 1024 * 1024))
+        return path
+
+    @defer.inlineCallbacks
+    def test_get_timeout_stops(self):
+        'Nothing more is written locally once a get times out'
+        try:
+            sandbox = tempfile.mkdtemp()
+            source_path = self.bigFile(sandbox)
+            destination_path = '/'.join([sandbox, 'test_destination_file'])
+
+            d = self.client.get(source_path, destination_path, timeout=0.3)
+            yield self.assertFailure(d, TimeoutError)
+            size = os.path.getsize(destination_path)
+            yield deferLater(reactor, 1, lambda: None)
+            self.assertEqual(os.path.getsize(destination_path), size)
+            self.assertTrue(size < os.path.getsize(source_path))
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_timeout_stops(self):
+        'Only the writes in flight land once a put times out'
+        try:
+            self.client.options['sftprequests'] = 4
+            sandbox = tempfile.mkdtemp()
+            source_path = self.bigFile(sandbox)
+            destination_path = '/'.join([sandbox, 'test_destination_file'])
+
+            d = self.client.put(source_path, destination_path, timeout=0.3)
+            yield self.assertFailure(d, TimeoutError)
+            size = os.path.getsize(destination_path)
+            yield deferLater(reactor, 1, lambda: None)
+            self.assertTrue(os.path.getsize(destination_path) <=
+                            size + 4 * 32768)
+            self.assertTrue(os.path.getsize(destination_path) <
+                            os.path.getsize(source_path))
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_get_to_consumer_timeout_stops(self):
+        'Nothing more is written to the consumer once it times out'
+        try:
+            sandbox = tempfile.mkdtemp()
+            source_path = self.bigFile(sandbox)
+            data = []
+
+            d = self.client.getToConsumer(source_path, data.append,
+                                          timeout=0.3)
+            yield self.assertFailure(d, TimeoutError)
+            size = len(data)
+            yield deferLater(reactor, 1, lambda: None)
+            self.assertEqual(len(data), size)
+            self.assertTrue(len(''.join(data)) < os.path.getsize(source_path))
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_get_resume(self):
+        try:
+            self.client.options.update({'buffersize': 4096})
+            source_data = os.urandom(100 * 1024 + 17)
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').write(source_data)
+
+            # Only the rest is fetched, so a stale prefix is kept...
+            open(destination_path, 'w').write('x' * 40000)
+            yield self.client.get(source_path, destination_path, resume=True)
+            data = open(destination_path, 'r').read()
+            self.assertEqual(data[:40000], 'x' * 40000)
+            self.assertEqual(data[40000:], source_data[40000:])
+
+            # ...unless the tail is verified
+            open(destination_path, 'w').write('x' * 40000)
+            yield self.client.get(source_path, destination_path, resume=True,
+                                  verify=1024)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+
+            open(destination_path, 'w').write(source_data[:40000])
+            yield self.client.get(source_path, destination_path, resume=True,
+                                  verify=1024)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+
+            # A larger destination is replaced
+            open(destination_path, 'w').write(source_data + 'more')
+            yield self.client.get(source_path, destination_path, resume=True)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_resume(self):
+        try:
+            self.client.options.update({'buffersize': 4096})
+            source_data = os.urandom(100 * 1024 + 17)
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').write(source_data)
+
+            open(destination_path, 'w').write('x' * 40000)
+            yield self.client.put(source_path, destination_path, resume=True)
+            data = open(destination_path, 'r').read()
+            self.assertEqual(data[:40000], 'x' * 40000)
+            self.assertEqual(data[40000:], source_data[40000:])
+
+            open(destination_path, 'w').write('x' * 40000)
+            yield self.client.put(source_path, destination_path, resume=True,
+                                  verify=1024)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+
+            open(destination_path, 'w').write(source_data[:40000])
+            yield self.client.put(source_path, destination_path, resume=True,
+                                  verify=1024)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+
+            open(destination_path, 'w').write(source_data + 'more')
+            yield self.client.put(source_path, destination_path, resume=True)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+
+            os.remove(destination_path)
+            yield self.client.put(source_path, destination_path, resume=True)
+            self.assertEqual(source_data, open(destination_path, 'r').read())
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    def make_tree(self, root, target='a/one'):
+        os.makedirs(os.path.join(root, 'a', 'b'))
+        os.mkdir(os.path.join(root, 'empty'))
+        for path, data in (('top', 'top\n'),
+                           ('a/one', 'one\n' * 1000),
+                           ('a/b/two', os.urandom(70000)),
+                           # Files put() used to fail on
+                           ('a/b/zero', ''),
+                           ('a/blocks', os.urandom(2 * 32768))):
+            open(os.path.join(root, path), 'w').write(data)
+        os.chmod(os.path.join(root, 'a', 'one'), 0o600)
+        os.symlink(target, os.path.join(root, 'link'))
+
+    def assertSameTree(self, source, destination, links=True):
+        for dirpath, dirnames, filenames in os.walk(source):
+            relative = os.path.relpath(dirpath, source)
+            self.assertTrue(os.path.isdir(os.path.join(destination,
+                                                       relative)))
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                copy = os.path.join(destination, relative, name)
+                if os.path.islink(path) and links:
+                    self.assertEqual(os.readlink(path), os.readlink(copy))
+                else:
+                    self.assertEqual(open(path).read(), open(copy).read())
+
+    @defer.inlineCallbacks
+    def test_get_tree(self):
+        try:
+            source = tempfile.mkdtemp()
+            destination = os.path.join(tempfile.mkdtemp(), 'copy')
+            self.make_tree(source)
+
+            results = yield self.client.getTree(source, destination,
+                                                concurrency=2,
+                                                preserve=True)
+            self.assertEqual([r for r in results if r[2] is not None], [])
+            self.assertEqual(len(results), 10)
+            self.assertSameTree(source, destination)
+            self.assertEqual(
+                os.stat(os.path.join(destination, 'a', 'one')).st_mode &
+                0o777, 0o600)
+
+            shutil.rmtree(destination)
+            results = yield self.client.getTree(
+                source, destination, symlinks=sshclient.SYMLINKS_FOLLOW)
+            self.assertSameTree(source, destination, links=False)
+            self.assertFalse(os.path.islink(os.path.join(destination,
+                                                         'link')))
+
+            shutil.rmtree(destination)
+            results = yield self.client.getTree(
+                source, destination, symlinks=sshclient.SYMLINKS_SKIP)
+            self.assertFalse(os.path.lexists(os.path.join(destination,
+                                                          'link')))
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(os.path.dirname(destination))
+
+    @defer.inlineCallbacks
+    def test_put_tree(self):
+        try:
+            source = tempfile.mkdtemp()
+            destination = os.path.join(tempfile.mkdtemp(), 'copy')
+            # The test server makes link targets absolute
+            self.make_tree(source, os.path.join(source, 'a', 'one'))
+
+            results = yield self.client.putTree(source, destination,
+                                                preserve=True)
+            self.assertEqual([r for r in results if r[2] is not None], [])
+            self.assertSameTree(source, destination)
+            self.assertEqual(
+                os.stat(os.path.join(destination, 'a', 'one')).st_mode &
+                0o777, 0o600)
+
+            # Again over the existing copy
+            results = yield self.client.putTree(source, destination)
+            self.assertEqual([r for r in results if r[2] is not None], [])
+            self.assertSameTree(source, destination)
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(os.path.dirname(destination))
+
+    def files_in(self, results):
+        return sorted(os.path.basename(r[1]) for r in results
+                      if r[0] is not None and not os.path.isdir(r[1]))
+
+    @defer.inlineCallbacks
+    def test_sync_get_tree(self):
+        try:
+            source = tempfile.mkdtemp()
+            destination = os.path.join(tempfile.mkdtemp(), 'copy')
+            self.make_tree(source)
+
+            results = yield self.client.getTree(source, destination,
+                                                sync=True)
+            self.assertEqual(self.files_in(results),
+                             ['blocks', 'link', 'one', 'top', 'two', 'zero'])
+            self.assertSameTree(source, destination)
+
+            # Nothing changed
+            results = yield self.client.getTree(source, destination,
+                                                sync=True)
+            self.assertEqual(self.files_in(results), [])
+
+            os.remove(os.path.join(source, 'link'))
+            os.symlink('top', os.path.join(source, 'link'))
+            results = yield self.client.getTree(source, destination,
+                                                sync=True)
+            self.assertEqual(self.files_in(results), ['link'])
+            self.assertEqual(os.readlink(os.path.join(destination, 'link')),
+                             'top')
+
+            open(os.path.join(source, 'a', 'one'), 'a').write('more\n')
+            open(os.path.join(source, 'a', 'b', 'zero'), 'w').write('z')
+            os.mkdir(os.path.join(destination, 'extra'))
+            open(os.path.join(destination, 'extra', 'file'), 'w').write('x')
+            open(os.path.join(destination, 'stale'), 'w').write('x')
+            results = yield self.client.getTree(source, destination,
+                                                sync=True, delete=True,
+                                                symlinks=sshclient.SYMLINKS_SKIP)
+            self.assertEqual(self.files_in(results), ['one', 'zero'])
+            self.assertEqual(sorted(os.path.basename(r[1]) for r in results
+                                    if r[0] is None), ['extra', 'stale'])
+            self.assertSameTree(source, destination)
+            self.assertEqual(sorted(os.listdir(destination)),
+                             ['a', 'empty', 'link', 'top'])
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(os.path.dirname(destination))
+
+    @defer.inlineCallbacks
+    def test_sync_put_tree(self):
+        try:
+            source = tempfile.mkdtemp()
+            destination = os.path.join(tempfile.mkdtemp(), 'copy')
+            self.make_tree(source)
+
+            results = yield self.client.putTree(source, destination,
+                                                sync=True,
+                                                symlinks=sshclient.SYMLINKS_SKIP)
+            self.assertEqual(self.files_in(results),
+                             ['blocks', 'one', 'top', 'two', 'zero'])
+            # SFTP times are whole seconds
+            self.assertEqual(
+                int(os.stat(os.path.join(source, 'top')).st_mtime),
+                os.stat(os.path.join(destination, 'top')).st_mtime)
+
+            results = yield self.client.putTree(source, destination,
+                                                sync=True,
+                                                symlinks=sshclient.SYMLINKS_SKIP)
+            self.assertEqual(self.files_in(results), [])
+
+            open(os.path.join(source, 'top'), 'a').write('more\n')
+            # The empty file gains data and the whole-buffer one is emptied
+            open(os.path.join(source, 'a', 'b', 'zero'), 'w').write('z')
+            open(os.path.join(source, 'a', 'blocks'), 'w').close()
+            os.makedirs(os.path.join(destination, 'extra', 'deeper'))
+            open(os.path.join(destination, 'extra', 'deeper', 'file'),
+                 'w').write('x')
+            results = yield self.client.putTree(source, destination,
+                                                sync=True, delete=True,
+                                                symlinks=sshclient.SYMLINKS_SKIP)
+            self.assertEqual([r for r in results if r[2] is not None], [])
+            self.assertEqual(self.files_in(results), ['blocks', 'top', 'zero'])
+            for path in ('top', 'a/blocks', 'a/b/zero'):
+                self.assertEqual(open(os.path.join(source, path)).read(),
+                                 open(os.path.join(destination, path)).read())
+            self.assertFalse(os.path.exists(os.path.join(destination,
+                                                         'extra')))
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(os.path.dirname(destination))
+
+    @defer.inlineCallbacks
+    def test_sync_put_tree_links(self):
+        'An unchanged link is left alone by the next sync'
+        try:
+            source = tempfile.mkdtemp()
+            destination = os.path.join(tempfile.mkdtemp(), 'copy')
+            # The test server makes link targets absolute
+            self.make_tree(source, os.path.join(source, 'a', 'one'))
+
+            results = yield self.client.putTree(source, destination,
+                                                sync=True)
+            self.assertTrue('link' in self.files_in(results))
+            results = yield self.client.putTree(source, destination,
+                                                sync=True)
+            self.assertEqual(self.files_in(results), [])
+
+            os.remove(os.path.join(source, 'link'))
+            os.symlink(os.path.join(source, 'top'),
+                       os.path.join(source, 'link'))
+            results = yield self.client.putTree(source, destination,
+                                                sync=True)
+            self.assertEqual(self.files_in(results), ['link'])
+            self.assertEqual(os.readlink(os.path.join(destination, 'link')),
+                             os.path.join(source, 'top'))
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(os.path.dirname(destination))
+
+    def changed(self, data):
+        'data changed in place, with an insertion and appended to'
+        return data[:50000] + 'x' * 3000 + data[53000:150000] + \
+            'inserted' + data[150000:] + 'appended'
+
+    @defer.inlineCallbacks
+    def test_get_delta(self):
+        try:
+            sandbox = tempfile.mkdtemp()
+            source_path = os.path.join(sandbox, 'source')
+            destination_path = os.path.join(sandbox, 'destination')
+            old = os.urandom(400 * 1024)
+            open(source_path, 'w').write(old)
+
+            stats = yield self.client.getDelta(source_path, destination_path)
+            self.assertEqual(stats['sent'], len(old))
+            self.assertEqual(old, open(destination_path).read())
+
+            new = self.changed(old)
+            open(source_path, 'w').write(new)
+            os.chmod(destination_path, 0o640)
+            stats = yield self.client.getDelta(source_path, destination_path)
+            self.assertEqual(new, open(destination_path).read())
+            self.assertEqual(stats['size'], len(new))
+            self.assertTrue(0 < stats['sent'] < 20000, stats)
+            self.assertEqual(stats['sent'] + stats['matched'], len(new))
+            self.assertEqual(os.stat(destination_path).st_mode & 0o777,
+                             0o640)
+            self.assertEqual(sorted(os.listdir(sandbox)),
+                             ['destination', 'source'])
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_put_delta(self):
+        try:
+            sandbox = tempfile.mkdtemp()
+            source_path = os.path.join(sandbox, 'source')
+            destination_path = os.path.join(sandbox, 'destination')
+            old = os.urandom(400 * 1024)
+            open(source_path, 'w').write(old)
+
+            # Put whole: no destination, then an empty one
+            stats = yield self.client.putDelta(source_path, destination_path)
+            self.assertEqual(stats['sent'], len(old))
+            self.assertEqual(old, open(destination_path).read())
+            open(destination_path, 'w').close()
+            stats = yield self.client.putDelta(source_path, destination_path)
+            self.assertEqual(stats['sent'], len(old))
+            self.assertEqual(old, open(destination_path).read())
+
+            stats = yield self.client.putDelta(source_path, destination_path)
+            self.assertEqual(stats['sent'], 0)
+
+            new = self.changed(old)
+            open(source_path, 'w').write(new)
+            os.chmod(destination_path, 0o640)
+            stats = yield self.client.putDelta(source_path, destination_path)
+            self.assertEqual(new, open(destination_path).read())
+            self.assertTrue(0 < stats['sent'] < 20000, stats)
+            self.assertEqual(os.stat(destination_path).st_mode & 0o777,
+                             0o640)
+            self.assertEqual(sorted(os.listdir(sandbox)),
+                             ['destination', 'source'])
+
+            # Only the last, partial block is sent
+            open(source_path, 'w').write(new[:10000])
+            stats = yield self.client.putDelta(source_path, destination_path)
+            self.assertEqual(new[:10000], open(destination_path).read())
+            self.assertEqual(stats['sent'], 10000 % 2048)
+        finally:
+            shutil.rmtree(sandbox)
+
+    @defer.inlineCallbacks
+    def test_get_coalesced(self):
+        try:
+            source_data = 'This was my sourcefile...'
+            source_sandbox = tempfile.mkdtemp()
+            destination_sandbox = tempfile.mkdtemp()
+            source_path = '/'.join([source_sandbox, 'test_source_file'])
+            destination_path = '/'.join([destination_sandbox,
+                                         'test_destination_file'])
+            open(source_path, 'w').write(source_data)
+
+            self.client.options['coalesce'] = True
+            first = self.client.get(source_path, destination_path)
+            second = self.client.get(source_path, destination_path)
+            key = ('get', source_path, destination_path, False, 0)
+            self.assertTrue(key in self.client.inflight)
+            # A get that checks the destination is not the same request
+            verified = self.client.get(source_path, destination_path,
+                                       verify=1)
+            key = ('get', source_path, destination_path, False, 1)
+            self.assertTrue(key in self.client.inflight)
+            result = yield defer.gatherResults([first, second, verified])
+            self.assertEqual(source_data,
+                             open(destination_path, 'r').read())
+            defer.returnValue(result)
+        finally:
+            shutil.rmtree(source_sandbox)
+            shutil.rmtree(destination_sandbox)
+
+    @defer.inlineCallbacks
+    def test_get_coalesced_cancel(self):
+        'The shared get stops once every caller has cancelled'
+        try:
+            sandbox = tempfile.mkdtemp()
+            source_path = self.bigFile(sandbox)
+            destination_path = '/'.join([sandbox, 'test_destination_file'])
+
+            self.client.options['coalesce'] = True
+            first = self.client.get(source_path, destination_path)
+            second = self.client.get(source_path, destination_path)
+            yield deferLater(reactor, 0.3, lambda: None)
+            first.cancel()
+            second.cancel()
+            yield self.assertFailure(first, defer.CancelledError)
+            yield self.assertFailure(second, defer.CancelledError)
+            self.assertEqual(list(self.client.inflight.flights), [])
+            size = os.path.getsize(destination_path)
+            yield deferLater(reactor, 1, lambda: None)
+            self.assertEqual(os.path.getsize(destination_path), size)
+            self.assertTrue(size < os.path.getsize(source_path))
+        finally:
+            shutil.rmtree(sandbox)
+
     @defer.inlineCallbacks
     def test_chown(self):
         try:
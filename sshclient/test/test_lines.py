@@ -0,0 +1,87 @@
+from sshclient.lines import LineSplitter, LineConsumer, LineIterator
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+
+class FakeProducer:
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class LineSplitterTestCase(TestCase):
+    def test_partial_lines(self):
+        splitter = LineSplitter()
+        self.assertEqual(splitter.feed('one\ntw'), ['one'])
+        self.assertEqual(splitter.feed('o'), [])
+        self.assertEqual(splitter.feed('\nthree\nfour\n'),
+                         ['two', 'three', 'four'])
+        self.assertEqual(splitter.flush(), [])
+
+    def test_unterminated(self):
+        splitter = LineSplitter()
+        self.assertEqual(splitter.feed('a\n\nb'), ['a', ''])
+        self.assertEqual(splitter.flush(), ['b'])
+
+    def test_matches_splitlines(self):
+        output = 'x' * 100 + '\n' + 'line\n' * 50 + 'y' * 70000 + '\nend'
+        splitter = LineSplitter()
+        lines = []
+        for i in range(0, len(output), 4096):
+            lines.extend(splitter.feed(output[i:i + 4096]))
+        lines.extend(splitter.flush())
+        self.assertEqual(lines, output.splitlines())
+
+
+class LineConsumerTestCase(TestCase):
+    def test_batches(self):
+        batches = []
+        consumer = LineConsumer(batches.append)
+        consumer.registerProducer(FakeProducer(), True)
+        consumer.write('a\nb')
+        consumer.write('c\n')
+        consumer.write('d')
+        consumer.unregisterProducer()
+        self.assertEqual(batches, [['a'], ['bc'], ['d']])
+
+
+class LineIteratorTestCase(TestCase):
+    def setUp(self):
+        self.producer = FakeProducer()
+        self.lines = LineIterator(maxBatches=2)
+        self.lines.registerProducer(self.producer, True)
+
+    def test_waiting(self):
+        d = self.lines.next()
+        self.assertFalse(d.called)
+        self.lines.write('a\n')
+        self.assertEqual(self.successResultOf(d), ['a'])
+
+    def test_backpressure(self):
+        self.lines.write('a\n')
+        self.assertFalse(self.producer.paused)
+        self.lines.write('b\n')
+        self.assertTrue(self.producer.paused)
+        self.assertEqual(self.successResultOf(self.lines.next()), ['a'])
+        self.assertFalse(self.producer.paused)
+
+    def test_finish(self):
+        self.lines.write('a\nb')
+        self.lines.unregisterProducer()
+        self.lines.finish('results')
+        self.assertEqual(self.successResultOf(self.lines.next()), ['a'])
+        self.assertEqual(self.successResultOf(self.lines.next()), ['b'])
+        self.assertEqual(self.successResultOf(self.lines.next()), None)
+        self.assertEqual(self.lines.results, 'results')
+
+    def test_failure(self):
+        d = self.lines.next()
+        self.lines.finish(Failure(TimeoutError()))
+        self.failureResultOf(d, TimeoutError)
+        self.failureResultOf(self.lines.next(), TimeoutError)
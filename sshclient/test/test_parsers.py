@@ -0,0 +1,58 @@
+from sshclient.parsers import Parser, TableParser, KeyValueParser, DfParser
+from sshclient.parsers import NetstatParser
+from twisted.trial.unittest import TestCase
+
+
+def parse(parser, output, chunkSize=7):
+    records = []
+    for i in range(0, len(output), chunkSize):
+        parser.feed(output[i:i + chunkSize])
+        records.extend(parser.records())
+    parser.finish()
+    records.extend(parser.records())
+    return records
+
+
+class ParserTestCase(TestCase):
+    def test_chunks(self):
+        self.assertEqual(''.join(parse(Parser(), 'hi\nthere\n', 4)),
+                         'hi\nthere\n')
+
+    def test_table(self):
+        output = ('  PID   RSS COMMAND\n'
+                  '    1  4096 /sbin/init splash\n'
+                  '  812   128 sshd: user@pts/0\n')
+        records = parse(TableParser(convert={'PID': int}), output)
+        self.assertEqual(records,
+                         [{'PID': 1, 'RSS': '4096',
+                           'COMMAND': '/sbin/init splash'},
+                          {'PID': 812, 'RSS': '128',
+                           'COMMAND': 'sshd: user@pts/0'}])
+
+    def test_key_value(self):
+        output = 'MemTotal:  16318412 kB\nMemFree:    1024 kB\nbogus\nx: 1'
+        self.assertEqual(parse(KeyValueParser(), output),
+                         [('MemTotal', '16318412 kB'),
+                          ('MemFree', '1024 kB'),
+                          ('x', '1')])
+
+    def test_df(self):
+        output = ('Filesystem     1024-blocks    Used Available Capacity '
+                  'Mounted on\n'
+                  '/dev/sda1        102400   51200     51200      50% '
+                  '/mnt/my disk\n')
+        self.assertEqual(parse(DfParser(), output, chunkSize=3),
+                         [{'filesystem': '/dev/sda1', 'blocks': 102400,
+                           'used': 51200, 'available': 51200,
+                           'capacity': '50%', 'mounted': '/mnt/my disk'}])
+
+    def test_netstat(self):
+        output = ('Active Internet connections (servers and established)\n'
+                  'Proto Recv-Q Send-Q Local Address   Foreign Address '
+                  'State\n'
+                  'tcp        0      0 0.0.0.0:22      0.0.0.0:*       '
+                  'LISTEN\n')
+        self.assertEqual(parse(NetstatParser(), output),
+                         [{'proto': 'tcp', 'recvq': 0, 'sendq': 0,
+                           'local': '0.0.0.0:22', 'foreign': '0.0.0.0:*',
+                           'state': 'LISTEN'}])
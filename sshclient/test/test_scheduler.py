@@ -0,0 +1,93 @@
+from sshclient.connection import ChannelScheduler
+from sshclient.channel import PRIORITY_INTERACTIVE, PRIORITY_BULK
+from twisted.conch.ssh import connection
+from twisted.trial.unittest import TestCase
+
+
+class FakeChannel:
+    def __init__(self, name, priority=PRIORITY_INTERACTIVE, longLived=False):
+        self.name = name
+        self.priority = priority
+        self.longLived = longLived
+        self.failure = None
+
+    def openFailed(self, reason):
+        self.failure = reason
+
+
+class ChannelSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.opened = []
+        self.scheduler = ChannelScheduler(self.opened.append, limit=2,
+                                          maxQueue=2)
+
+    def test_limit_and_priority(self):
+        a, b = FakeChannel('a'), FakeChannel('b')
+        bulk = FakeChannel('bulk', PRIORITY_BULK)
+        c = FakeChannel('c')
+        for channel in (a, b, bulk, c):
+            self.scheduler.submit(channel)
+        self.assertEqual(self.opened, [a, b])
+
+        self.scheduler.release(a)
+        self.assertEqual(self.opened, [a, b, c])
+        self.scheduler.release(b)
+        self.assertEqual(self.opened, [a, b, c, bulk])
+
+    def test_long_lived_leave_a_slot(self):
+        shells = [FakeChannel('shell%i' % i, longLived=True)
+                  for i in range(2)]
+        a = FakeChannel('a')
+        for channel in shells + [a]:
+            self.scheduler.submit(channel)
+        self.assertEqual(self.opened, [shells[0], a])
+
+        self.scheduler.release(a)
+        self.assertEqual(self.opened, [shells[0], a])
+        self.scheduler.release(shells[0])
+        self.assertEqual(self.opened, [shells[0], a, shells[1]])
+
+    def test_load_shedding(self):
+        channels = [FakeChannel(i) for i in range(5)]
+        for channel in channels:
+            self.scheduler.submit(channel)
+        self.assertEqual(self.opened, channels[:2])
+        self.assertIdentical(channels[3].failure, None)
+        self.assertEqual(channels[4].failure.data,
+                         connection.OPEN_RESOURCE_SHORTAGE)
+
+    def test_learn_limit_from_open_failure(self):
+        a, b = FakeChannel('a'), FakeChannel('b')
+        self.scheduler.submit(a)
+        self.scheduler.submit(b)
+        requeued = self.scheduler.openFailed(
+            b, connection.OPEN_ADMINISTRATIVELY_PROHIBITED)
+        self.assertTrue(requeued)
+        self.assertEqual(self.scheduler.limit, 1)
+
+        self.scheduler.release(a)
+        self.assertEqual(self.opened, [a, b, b])
+
+    def test_open_failure_without_open_channels(self):
+        a = FakeChannel('a')
+        self.scheduler.submit(a)
+        requeued = self.scheduler.openFailed(
+            a, connection.OPEN_ADMINISTRATIVELY_PROHIBITED)
+        self.assertFalse(requeued)
+        self.assertEqual(self.scheduler.limit, 2)
+
+    def test_cancel_queued(self):
+        channels = [FakeChannel(i) for i in range(3)]
+        for channel in channels:
+            self.scheduler.submit(channel)
+        self.assertTrue(self.scheduler.cancel(channels[2]))
+        self.assertFalse(self.scheduler.cancel(channels[0]))
+        self.scheduler.release(channels[0])
+        self.assertEqual(self.opened, channels[:2])
+
+    def test_clear(self):
+        channels = [FakeChannel(i) for i in range(3)]
+        for channel in channels:
+            self.scheduler.submit(channel)
+        self.assertEqual(self.scheduler.clear(), channels[2:])
+        self.assertTrue(self.scheduler.hasRoom())
@@ -0,0 +1,338 @@
+from sshclient import SSHClient
+from sshclient.sftp import SFTPPool, TransferChunks, RangeChunks
+from sshclient.sftp import SFTPReader, SFTPWriter
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+import tempfile
+
+
+class FakeClient:
+    def __init__(self):
+        self.openRequests = {}
+
+
+class FakeConnection:
+    def __init__(self):
+        self.opened = []
+
+    def openChannel(self, channel):
+        self.opened.append(channel)
+
+    def sendClose(self, channel):
+        channel.closed()
+
+    def ready(self):
+        'Finish opening every channel'
+        for channel in self.opened:
+            if not channel.clientHandle.called:
+                channel.client = FakeClient()
+                channel.clientHandle.callback(channel.client)
+
+
+class FakeFile:
+    'Remote file handle whose requests are answered by the test'
+    def __init__(self):
+        self.reads = []
+        self.writes = []
+        self.closed = False
+        self.error = None
+
+    def readChunk(self, offset, length):
+        d = defer.Deferred()
+        self.reads.append((offset, length, d))
+        return d
+
+    def writeChunk(self, offset, data):
+        d = defer.Deferred()
+        self.writes.append((offset, data, d))
+        return d
+
+    def close(self):
+        self.closed = True
+
+
+class SFTPPoolTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.connection = FakeConnection()
+        self.pool = SFTPPool(minIdle=1, maxSize=3, idleTimeout=60,
+                             reactor=self.clock)
+
+    def getClient(self):
+        clients = []
+        self.pool.getClient(self.connection).addCallback(clients.append)
+        self.connection.ready()
+        return clients[0]
+
+    def test_warm(self):
+        self.pool.warm(self.connection)
+        self.assertEqual(len(self.connection.opened), 1)
+        # The first operation uses the warm session
+        client = self.getClient()
+        self.assertEqual(len(self.connection.opened), 1)
+        self.assertIdentical(client, self.connection.opened[0].client)
+
+    def test_least_outstanding(self):
+        first = self.getClient()
+        first.openRequests = {1: None, 2: None}
+        # Busy sessions make the pool grow up to maxSize
+        second = self.getClient()
+        second.openRequests = {3: None}
+        third = self.getClient()
+        third.openRequests = {4: None, 5: None, 6: None}
+        self.assertEqual(len(self.pool), 3)
+        self.assertIdentical(self.getClient(), second)
+        second.openRequests = {}
+        self.assertIdentical(self.getClient(), second)
+
+    def test_reap_idle(self):
+        for i in range(3):
+            self.getClient().openRequests = {i: None}
+        self.assertEqual(len(self.pool), 3)
+        for channel in self.connection.opened:
+            channel.client.openRequests = {}
+        self.clock.advance(60)
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_closed_sessions_stop_reaper(self):
+        self.getClient()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.connection.opened[0].closed()
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TransferChunksTestCase(TestCase):
+    def test_next_chunks(self):
+        chunks = TransferChunks(4)
+        self.assertEqual(chunks.next(), (0, 4))
+        self.assertEqual(chunks.next(), (4, 4))
+
+    def test_start(self):
+        chunks = TransferChunks(4, start=10)
+        self.assertEqual(chunks.next(), (10, 4))
+
+    def test_known_end(self):
+        chunks = TransferChunks(4, start=2)
+        chunks.eof(8)
+        self.assertEqual(chunks.next(), (2, 4))
+        self.assertEqual(chunks.next(), (6, 2))
+        self.assertEqual(chunks.next(), None)
+
+    def test_short_read_before_eof(self):
+        # A short read whose hole is only asked for after a later read
+        # has already hit EOF.
+        chunks = TransferChunks(4)
+        for i in range(3):
+            chunks.next()
+        chunks.received(0, 4, 4)
+        chunks.received(4, 4, 2)
+        chunks.eof(8)
+        self.assertEqual(chunks.next(), (6, 2))
+        chunks.eof(6)
+        self.assertEqual(chunks.next(), None)
+
+    def test_holes_past_eof(self):
+        chunks = TransferChunks(4)
+        chunks.next()
+        chunks.next()
+        chunks.received(4, 4, 1)
+        chunks.eof(5)
+        self.assertEqual(chunks.next(), None)
+
+
+class RangeChunksTestCase(TestCase):
+    def test_ranges(self):
+        chunks = RangeChunks(4, [(2, 6), (20, 3)])
+        self.assertEqual(chunks.next(), (2, 4))
+        chunks.received(2, 4, 1)
+        self.assertEqual(chunks.next(), (3, 3))
+        self.assertEqual(chunks.next(), (6, 2))
+        self.assertEqual(chunks.next(), (20, 3))
+        self.assertEqual(chunks.next(), None)
+
+    def test_eof(self):
+        chunks = RangeChunks(4, [(2, 6), (20, 3)])
+        chunks.eof(5)
+        self.assertEqual(chunks.next(), (2, 3))
+        self.assertEqual(chunks.next(), None)
+
+
+class PutTestCase(TestCase):
+    def setUp(self):
+        self.client = SSHClient({'hostname': '127.0.0.1',
+                                 'port': 22,
+                                 'user': 'user',
+                                 'buffersize': 4,
+                                 'sftprequests': 3})
+        self.local = tempfile.TemporaryFile()
+        self.local.write('0123456789abcdefghij')
+        self.local.seek(0)
+        self.remote = FakeFile()
+
+    def test_pipelined(self):
+        results = []
+        self.client._cbputfile(self.remote, self.local).addBoth(results.append)
+        # Only sftprequests writes are in flight at once
+        self.assertEqual([w[:2] for w in self.remote.writes],
+                         [(0, '0123'), (4, '4567'), (8, '89ab')])
+        for i in range(5):
+            self.remote.writes[i][2].callback(None)
+        self.assertEqual(len(self.remote.writes), 5)
+        self.assertEqual(self.remote.writes[4][:2], (16, 'ghij'))
+        self.assertEqual(results, [None])
+        self.assertTrue(self.remote.closed)
+
+    def test_first_error_after_drain(self):
+        results = []
+        self.client._cbputfile(self.remote, self.local).addBoth(results.append)
+        self.remote.writes[1][2].errback(IOError('first'))
+        self.remote.writes[0][2].errback(IOError('second'))
+        # No new writes once one failed, but the last one is waited for
+        self.assertEqual(len(self.remote.writes), 3)
+        self.assertEqual(results, [])
+        self.remote.writes[2][2].callback(None)
+        self.assertEqual(len(self.remote.writes), 3)
+        self.assertEqual(str(results[0].value), 'first')
+        self.assertTrue(self.remote.closed)
+
+
+class FakeConsumer:
+    def __init__(self):
+        self.producer = None
+        self.data = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class SFTPReaderTestCase(TestCase):
+    def setUp(self):
+        self.remote = FakeFile()
+        self.consumer = FakeConsumer()
+        self.results = []
+
+    def start(self, maxSize=None):
+        reader = SFTPReader(self.remote, self.consumer, 4, 2, maxSize)
+        reader.start().addBoth(self.results.append)
+        return reader
+
+    def answer(self, i, data):
+        offset, length, d = self.remote.reads[i]
+        if data is None:
+            d.errback(EOFError())
+        else:
+            d.callback(data)
+
+    def test_in_order(self):
+        self.start()
+        self.assertEqual([r[:2] for r in self.remote.reads], [(0, 4), (4, 4)])
+        self.answer(1, '4567')
+        self.assertEqual(self.consumer.data, [])
+        self.answer(0, '0123')
+        self.assertEqual(self.consumer.data, ['0123', '4567'])
+        self.answer(2, '89')  # short read, the hole is asked for again
+        self.answer(3, None)
+        self.assertEqual(self.remote.reads[4][:2], (10, 2))
+        self.answer(4, None)
+        self.assertEqual(''.join(self.consumer.data), '0123456789')
+        self.assertEqual(self.results, [10])
+        self.assertEqual(self.consumer.producer, None)
+
+    def test_paused(self):
+        reader = self.start()
+        reader.pauseProducing()
+        self.answer(0, '0123')
+        self.answer(1, '4567')
+        self.assertEqual(len(self.remote.reads), 2)
+        reader.resumeProducing()
+        self.assertEqual([r[:2] for r in self.remote.reads[2:]],
+                         [(8, 4), (12, 4)])
+
+    def test_error_drains(self):
+        self.start()
+        self.remote.reads[0][2].errback(IOError('boom'))
+        self.assertEqual(self.results, [])
+        self.answer(1, '4567')
+        self.assertEqual(len(self.remote.reads), 2)
+        self.assertEqual(self.consumer.data, [])
+        self.assertEqual(str(self.results[0].value), 'boom')
+
+    def test_max_size(self):
+        self.start(maxSize=6)
+        self.answer(0, '0123')
+        self.answer(1, '4567')
+        self.assertEqual(self.consumer.data, ['0123'])
+        self.assertEqual(len(self.remote.reads), 3)
+        self.answer(2, '89ab')
+        self.assertEqual(len(self.remote.reads), 3)
+        self.assertTrue(self.results[0].check(ValueError))
+
+    def test_stopped(self):
+        reader = self.start()
+        self.answer(0, '0123')
+        reader.stopProducing()
+        self.assertEqual(self.results, [])
+        self.answer(1, '4567')
+        self.answer(2, '89ab')
+        self.assertEqual(len(self.remote.reads), 3)
+        self.assertEqual(self.consumer.data, ['0123'])
+        self.assertTrue(self.results[0].check(ConnectionLost))
+
+
+class FakeProducer:
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class SFTPWriterTestCase(TestCase):
+    def setUp(self):
+        self.remote = FakeFile()
+        self.producer = FakeProducer()
+        self.writer = SFTPWriter(self.remote, 4, 2)
+        self.writer.registerProducer(self.producer, True)
+        self.results = []
+
+    def test_flow_control(self):
+        self.writer.write('0123456789')
+        self.assertEqual([w[:2] for w in self.remote.writes],
+                         [(0, '0123'), (4, '4567')])
+        self.assertTrue(self.producer.paused)
+        self.remote.writes[0][2].callback(None)
+        self.assertEqual(self.remote.writes[2][:2], (8, '89'))
+        self.assertFalse(self.producer.paused)
+        self.writer.producerDone(None).addBoth(self.results.append)
+        self.assertEqual(self.results, [])
+        self.remote.writes[1][2].callback(None)
+        self.remote.writes[2][2].callback(None)
+        self.assertEqual(self.results, [10])
+
+    def test_write_error(self):
+        self.writer.write('0123456789')
+        self.remote.writes[0][2].errback(IOError('boom'))
+        self.assertTrue(self.producer.stopped)
+        self.assertEqual(len(self.remote.writes), 2)
+        self.writer.finish().addBoth(self.results.append)
+        self.assertEqual(self.results, [])
+        self.remote.writes[1][2].callback(None)
+        self.assertEqual(str(self.results[0].value), 'boom')
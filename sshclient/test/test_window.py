@@ -0,0 +1,47 @@
+from sshclient.connection import WindowTuner
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+
+class FakeChannel:
+    def __init__(self, windowSize):
+        self.localWindowSize = windowSize
+        self.localWindowLeft = windowSize
+
+
+class WindowTunerTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tuner = WindowTuner(maxWindow=1024 * 1024,
+                                 clock=self.clock.seconds)
+        self.channel = FakeChannel(128 * 1024)
+
+    def consume(self, size, seconds):
+        self.clock.advance(seconds)
+        self.channel.localWindowLeft -= size
+
+    def test_grows_when_window_limited(self):
+        # Half the window used per 100ms round trip
+        self.consume(64 * 1024, 0.1)
+        toAdd = self.tuner.tune(self.channel, 0.1)
+        self.assertEqual(self.channel.localWindowSize, 256 * 1024)
+        self.assertEqual(toAdd, 192 * 1024)
+
+    def test_steady_when_not_window_limited(self):
+        # Slow consumer: half the window over ten round trips
+        self.consume(64 * 1024, 1.0)
+        toAdd = self.tuner.tune(self.channel, 0.1)
+        self.assertEqual(self.channel.localWindowSize, 128 * 1024)
+        self.assertEqual(toAdd, 64 * 1024)
+
+    def test_capped_at_max_window(self):
+        for i in range(10):
+            self.consume(self.channel.localWindowLeft / 2, 0.1)
+            self.tuner.tune(self.channel, 0.1)
+            self.channel.localWindowLeft = self.channel.localWindowSize
+        self.assertEqual(self.channel.localWindowSize, 1024 * 1024)
+
+    def test_no_rtt(self):
+        self.consume(64 * 1024, 0.1)
+        self.assertEqual(self.tuner.tune(self.channel, None), 64 * 1024)
+        self.assertEqual(self.channel.localWindowSize, 128 * 1024)
@@ -0,0 +1,405 @@
+from twisted.internet import defer
+import os
+import posixpath
+import shutil
+import stat
+
+import logging
+log = logging.getLogger('txsshclient.tree')
+
+# What getTree()/putTree() do with symbolic links
+SYMLINKS_COPY = 'copy'  # recreate the link, pointing at the same target
+SYMLINKS_FOLLOW = 'follow'  # transfer what the link points at
+SYMLINKS_SKIP = 'skip'  # leave links out
+
+DEFAULT_TREE_CONCURRENCY = 8
+
+# Directories deeper than this are reported as errors, which stops
+# followed symlink loops.
+MAX_DEPTH = 64
+
+
+def localAttrs(st):
+    'SFTP style attributes from an os.stat() result'
+    return {'size': st.st_size,
+            'uid': st.st_uid,
+            'gid': st.st_gid,
+            'permissions': st.st_mode,
+            'atime': int(st.st_atime),
+            'mtime': int(st.st_mtime)}
+
+
+def upToDate(attrs, existing):
+    '''Is the existing destination file the same as the source, going by
+       size and mtime?  (rsync's quick check)
+    '''
+    return existing is not None and \
+        stat.S_ISREG(existing['permissions']) and \
+        existing['size'] == attrs['size'] and \
+        int(existing['mtime']) == int(attrs['mtime'])
+
+
+class TreeTransfer:
+    '''Copy a directory tree between the local host and the remote one.
+
+       Directories are listed and created as the walk reaches them; files
+       and symlinks are transferred as soon as their directory exists,
+       up to concurrency operations (listings and transfers) at once over
+       the client's shared SFTP sessions.  A failed entry doesn't stop the
+       walk.  start() returns a Deferred that fires once everything is
+       done with a list of (source, destination, result) for every file,
+       symlink and directory, where result is None or a Failure.
+
+       With sync set, each destination directory is listed too and files
+       whose size and mtime match the source are left alone (and out of
+       the results), as are symlinks with the same target; transferred
+       files get the source's mtime, so the next sync skips them.  With delete set, destination entries that
+       aren't in the source are removed and listed with a source of None.
+
+       Subclasses implement the side specific parts.  joinSource() and
+       joinDestination() take a directory and a name and return a path;
+       the rest return Deferreds:
+
+           listSource(path), listDestination(path)
+               fire with a list of (name, attrs) for the directory
+           statSource(path)
+               fires with the attrs of what path points at
+           readSourceLink(path), readDestinationLink(path)
+               fire with a symlink's target
+           makeDirectory(path)
+               fires once the destination directory exists
+           copyFile(source, destination), copyLink(source, destination)
+               transfer one file or symlink
+           removeDestination(path, attrs)
+               removes a destination entry, a directory with its contents
+           setMode(path, mode), setTimes(path, atime, mtime)
+               set a destination entry's permissions or times
+    '''
+
+    def __init__(self, client, source, destination,
+                 concurrency=DEFAULT_TREE_CONCURRENCY,
+                 symlinks=SYMLINKS_COPY, preserve=False, timeout=None,
+                 sync=False, delete=False):
+        if symlinks not in (SYMLINKS_COPY, SYMLINKS_FOLLOW, SYMLINKS_SKIP):
+            raise ValueError('Unknown symlinks mode %r' % (symlinks,))
+        self.client = client
+        self.source = source
+        self.destination = destination
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.symlinks = symlinks
+        self.preserve = preserve
+        self.timeout = timeout
+        self.sync = sync
+        self.delete = delete
+        self.results = []
+        self.transfers = []
+        # (destination, mode) of directories, set once their contents
+        # are written in case the mode doesn't allow writing
+        self.directories = []
+
+    def start(self):
+        d = self.makeDirectory(self.destination)
+        d.addCallback(self._cbWalk, self.source, self.destination, None, 0)
+        d.addErrback(self._ebEntry, self.source, self.destination)
+        d.addCallback(self._cbWalked)
+        return d
+
+    def _cbWalk(self, ignored, source, destination, attrs, depth):
+        if depth > MAX_DEPTH:
+            raise ValueError('%s is more than %i directories deep' %
+                             (source, MAX_DEPTH))
+        d = self.semaphore.run(self.listSource, source)
+        if self.sync or self.delete:
+            d.addCallback(self._cbListDestination, destination)
+        else:
+            d.addCallback(lambda entries: (entries, []))
+        d.addCallback(self._cbListed, source, destination, attrs, depth)
+        return d
+
+    def _cbListDestination(self, entries, destination):
+        d = self.semaphore.run(self.listDestination, destination)
+        # It was just made if it didn't exist.
+        d.addErrback(lambda reason: [])
+        d.addCallback(lambda existing: (entries, existing))
+        return d
+
+    def _cbListed(self, listings, source, destination, attrs, depth):
+        entries, existing = listings
+        self.results.append((source, destination, None))
+        if self.preserve and attrs is not None:
+            self.directories.append((destination, attrs['permissions']))
+        existing = dict(existing)
+        walks = []
+        for name, attrs in sorted(entries):
+            d = self._entry(self.joinSource(source, name),
+                            self.joinDestination(destination, name),
+                            attrs, existing.pop(name, None), depth)
+            if d is not None:
+                walks.append(d)
+        if self.delete:
+            for name, attrs in sorted(existing.items()):
+                self._remove(self.joinDestination(destination, name), attrs)
+        return defer.DeferredList(walks)
+
+    def _entry(self, source, destination, attrs, existing, depth):
+        '''Start on one directory entry; returns a Deferred if it needs
+           looking at first (directories, followed and synced links)
+        '''
+        mode = attrs['permissions']
+        if stat.S_ISLNK(mode):
+            if self.symlinks == SYMLINKS_SKIP:
+                return None
+            if self.symlinks == SYMLINKS_COPY:
+                if self.sync and existing is not None and \
+                        stat.S_ISLNK(existing['permissions']):
+                    return self._syncLink(source, destination)
+                self._transfer(self.copyLink, source, destination, None)
+                return None
+            d = self.semaphore.run(self.statSource, source)
+            d.addCallback(self._cbFollowed, source, destination, existing,
+                          depth)
+            d.addErrback(self._ebEntry, source, destination)
+            return d
+        if stat.S_ISDIR(mode):
+            d = self.makeDirectory(destination)
+            d.addCallback(self._cbWalk, source, destination, attrs,
+                          depth + 1)
+            d.addErrback(self._ebEntry, source, destination)
+            return d
+        if stat.S_ISREG(mode):
+            if self.sync and upToDate(attrs, existing):
+                return None
+            self._transfer(self.copyFile, source, destination, attrs)
+        else:
+            log.debug('Skipping special file %s' % source)
+        return None
+
+    def _syncLink(self, source, destination):
+        'Copy a link over an existing one unless it points the same way'
+        d = self.semaphore.run(self._readLinks, source, destination)
+        d.addCallback(self._cbReadLinks, source, destination)
+        # Let copyLink() report what is wrong.
+        d.addErrback(lambda ignored: self._transfer(
+            self.copyLink, source, destination, None))
+        return d
+
+    def _readLinks(self, source, destination):
+        return defer.gatherResults([self.readSourceLink(source),
+                                    self.readDestinationLink(destination)],
+                                   consumeErrors=True)
+
+    def _cbReadLinks(self, targets, source, destination):
+        if targets[0] != targets[1]:
+            self._transfer(self.copyLink, source, destination, None)
+
+    def _cbFollowed(self, attrs, source, destination, existing, depth):
+        if stat.S_ISLNK(attrs['permissions']):
+            return None
+        return self._entry(source, destination, attrs, existing, depth)
+
+    def _transfer(self, transfer, source, destination, attrs):
+        d = self.semaphore.run(transfer, source, destination)
+        if attrs is not None:
+            d.addCallback(self._cbTransferred, destination, attrs)
+        d.addCallbacks(self._cbEntry, self._ebEntry,
+                       callbackArgs=(source, destination),
+                       errbackArgs=(source, destination))
+        self.transfers.append(d)
+
+    def _cbTransferred(self, ignored, destination, attrs):
+        d = defer.succeed(None)
+        if self.preserve:
+            d.addCallback(lambda ignored: self.setMode(
+                destination, stat.S_IMODE(attrs['permissions'])))
+        if self.sync:
+            d.addCallback(lambda ignored: self.setTimes(
+                destination, attrs['atime'], attrs['mtime']))
+        return d
+
+    def _remove(self, destination, attrs):
+        d = self.semaphore.run(self.removeDestination, destination, attrs)
+        d.addCallbacks(self._cbEntry, self._ebEntry,
+                       callbackArgs=(None, destination),
+                       errbackArgs=(None, destination))
+        self.transfers.append(d)
+
+    def _cbEntry(self, ignored, source, destination):
+        self.results.append((source, destination, None))
+
+    def _ebEntry(self, reason, source, destination):
+        log.debug('Tree: %s failed: %s' % (source or destination,
+                                           reason.getErrorMessage()))
+        self.results.append((source, destination, reason))
+
+    def _cbWalked(self, ignored):
+        # Every directory has been listed, so every transfer has started.
+        d = defer.DeferredList(self.transfers)
+        d.addCallback(self._cbDone)
+        return d
+
+    def _cbDone(self, ignored):
+        modes = []
+        for destination, mode in reversed(self.directories):
+            d = self.setMode(destination, stat.S_IMODE(mode))
+            d.addErrback(self._ebEntry, destination, destination)
+            modes.append(d)
+        d = defer.DeferredList(modes)
+        d.addCallback(lambda ignored: self.results)
+        return d
+
+    # Listings of either side, as (name, attrs) lists
+
+    def _listLocal(self, path):
+        return defer.maybeDeferred(self._listdir, path)
+
+    def _listdir(self, path):
+        return [(name, localAttrs(os.lstat(os.path.join(path, name))))
+                for name in os.listdir(path)]
+
+    def _listRemote(self, path):
+        d = self.client.ls(path, timeout=self.timeout)
+        d.addCallback(self._cbls)
+        return d
+
+    def _cbls(self, files):
+        return [(name, attrs) for name, longname, attrs in files
+                if name not in ('.', '..')]
+
+
+class GetTree(TreeTransfer):
+    'TreeTransfer from a remote directory to a local one'
+
+    def joinSource(self, directory, name):
+        return posixpath.join(directory, name)
+
+    def joinDestination(self, directory, name):
+        return os.path.join(directory, name)
+
+    def listSource(self, path):
+        return self._listRemote(path)
+
+    def listDestination(self, path):
+        return self._listLocal(path)
+
+    def statSource(self, path):
+        return self.client.stat(path, timeout=self.timeout)
+
+    def readSourceLink(self, path):
+        return self.client.readlink(path, timeout=self.timeout)
+
+    def readDestinationLink(self, path):
+        return defer.maybeDeferred(os.readlink, path)
+
+    def makeDirectory(self, path):
+        return defer.maybeDeferred(self._mkdir, path)
+
+    def _mkdir(self, path):
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+    def copyFile(self, source, destination):
+        return self.client.get(source, destination, timeout=self.timeout)
+
+    def copyLink(self, source, destination):
+        d = self.client.readlink(source, timeout=self.timeout)
+        d.addCallback(self._cbreadlink, destination)
+        return d
+
+    def _cbreadlink(self, target, destination):
+        if os.path.lexists(destination):
+            os.remove(destination)
+        os.symlink(target, destination)
+
+    def removeDestination(self, path, attrs):
+        return defer.maybeDeferred(self._rm, path, attrs)
+
+    def _rm(self, path, attrs):
+        if stat.S_ISDIR(attrs['permissions']):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def setMode(self, path, mode):
+        return defer.maybeDeferred(os.chmod, path, mode)
+
+    def setTimes(self, path, atime, mtime):
+        return defer.maybeDeferred(os.utime, path, (atime, mtime))
+
+
+class PutTree(TreeTransfer):
+    'TreeTransfer from a local directory to a remote one'
+
+    def joinSource(self, directory, name):
+        return os.path.join(directory, name)
+
+    def joinDestination(self, directory, name):
+        return posixpath.join(directory, name)
+
+    def listSource(self, path):
+        return self._listLocal(path)
+
+    def listDestination(self, path):
+        return self._listRemote(path)
+
+    def statSource(self, path):
+        return defer.maybeDeferred(lambda: localAttrs(os.stat(path)))
+
+    def readSourceLink(self, path):
+        return defer.maybeDeferred(os.readlink, path)
+
+    def readDestinationLink(self, path):
+        return self.client.readlink(path, timeout=self.timeout)
+
+    def makeDirectory(self, path):
+        d = self.client.mkdir(path, timeout=self.timeout)
+        d.addErrback(self._ebmkdir, path)
+        return d
+
+    def _ebmkdir(self, reason, path):
+        # It may already be there.
+        d = self.client.stat(path, timeout=self.timeout)
+        d.addCallback(self._cbmkdir, reason)
+        d.addErrback(lambda ignored: reason)
+        return d
+
+    def _cbmkdir(self, attrs, reason):
+        if not stat.S_ISDIR(attrs['permissions']):
+            return reason
+
+    def copyFile(self, source, destination):
+        return self.client.put(source, destination, timeout=self.timeout)
+
+    def copyLink(self, source, destination):
+        d = self.client.rm(destination, timeout=self.timeout)
+        d.addErrback(lambda ignored: None)
+        d.addCallback(lambda ignored: self.client.ln(destination,
+                                                     os.readlink(source),
+                                                     timeout=self.timeout))
+        return d
+
+    def removeDestination(self, path, attrs):
+        if not stat.S_ISDIR(attrs['permissions']):
+            return self.client.rm(path, timeout=self.timeout)
+        # Empty the directory first
+        d = self._listRemote(path)
+        d.addCallback(self._cbrmdir, path)
+        return d
+
+    def _cbrmdir(self, entries, path):
+        d = defer.gatherResults([
+            self.removeDestination(posixpath.join(path, name), attrs)
+            for name, attrs in entries], consumeErrors=True)
+        d.addErrback(self._ebFirstError)
+        d.addCallback(lambda ignored: self.client.rmdir(
+            path, timeout=self.timeout))
+        return d
+
+    def _ebFirstError(self, reason):
+        reason.trap(defer.FirstError)
+        return reason.value.subFailure
+
+    def setMode(self, path, mode):
+        return self.client.chmod(path, '%o' % mode, timeout=self.timeout)
+
+    def setTimes(self, path, atime, mtime):
+        return self.client.utime(path, atime, mtime, timeout=self.timeout)
@@ -0,0 +1,78 @@
+#!/usr/local/bin/python
+'''Microbenchmark for collecting command output from channel packets.
+
+Compares the old "self.data = self.data + data" accumulation with the
+OutputBuffer used by CommandChannel.  Sizes are given in MB.
+
+    PYTHONPATH=. python tools/bench_buffer.py 1 100 1024
+
+Concatenation is only timed up to MAX_CONCAT MB.  It takes minutes at
+100 MB and grows with the square of the size, so 1 GB would take hours.
+'''
+import sys
+import time
+
+from sshclient.channel import OutputBuffer
+
+PACKET = 32768
+
+# Sizes above this (in MB) skip the concatenation run; it is quadratic.
+MAX_CONCAT = 100
+
+
+class ConcatChannel:
+    'The previous CommandChannel accumulation'
+
+    def __init__(self):
+        self.data = ''
+
+    def dataReceived(self, data):
+        # Attribute stores don't get CPython's in-place concat shortcut.
+        self.data = self.data + data
+
+
+class BufferChannel:
+    'The current CommandChannel accumulation'
+
+    def __init__(self):
+        self.data = OutputBuffer()
+
+    def dataReceived(self, data):
+        self.data.write(data)
+
+
+def concat(packet, count):
+    channel = ConcatChannel()
+    for i in xrange(count):
+        channel.dataReceived(packet)
+    return len(channel.data)
+
+
+def chunked(packet, count):
+    channel = BufferChannel()
+    for i in xrange(count):
+        channel.dataReceived(packet)
+    return len(channel.data.getvalue())
+
+
+def timeit(func, packet, count):
+    start = time.time()
+    func(packet, count)
+    return time.time() - start
+
+
+def main(sizes):
+    packet = 'x' * PACKET
+    print '%10s %12s %12s' % ('size (MB)', 'concat (s)', 'buffer (s)')
+    for size in sizes:
+        count = size * 1024 * 1024 / PACKET
+        buffered = timeit(chunked, packet, count)
+        if size <= MAX_CONCAT:
+            concatenated = '%12.3f' % timeit(concat, packet, count)
+        else:
+            concatenated = '%12s' % 'skipped'
+        print '%10d %s %12.3f' % (size, concatenated, buffered)
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1, 100, 1024])
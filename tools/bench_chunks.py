@@ -0,0 +1,131 @@
+#!/usr/local/bin/python
+'''Benchmark transfer chunk bookkeeping.
+
+First times the bookkeeping alone for a file of each size in 32KB chunks:
+the list that used to be scanned on every chunk against TransferChunks.
+Then get()s and put()s a sparse file of the last size through the unit test
+SSH server.  Sizes are given in MB.
+
+    PYTHONPATH=.:sshclient python tools/bench_chunks.py [size-MB ...]
+'''
+import getpass
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor, defer
+
+from sshclient import SSHClient
+from sshclient.sftp import TransferChunks
+from sshclient.test.test_common import SSHServer, ServerProtocol
+
+BUFSIZE = 32768
+# The list scan is quadratic; don't wait for it on large files.
+LIST_LIMIT = 256 * 1024 * 1024
+
+
+def listNext(chunks):
+    'The list scan get() and put() used before TransferChunks'
+    end = 0
+    for chunk in chunks:
+        if end != chunk[0]:
+            i = chunks.index(chunk)
+            chunks.insert(i, (end, chunk[0]))
+            return (end, chunk[0] - end)
+        if chunk[1] == 'eof':
+            return
+        end = chunk[1]
+    chunks.append((end, end + BUFSIZE))
+    return (end, BUFSIZE)
+
+
+def bookkeepList(size):
+    chunks = []
+    while True:
+        chunk = listNext(chunks)
+        if chunk is None:
+            return
+        start, length = chunk
+        if start >= size:
+            i = chunks.index((start, start + length))
+            chunks[i] = (start, 'eof')
+
+
+def bookkeepChunks(size):
+    chunks = TransferChunks(BUFSIZE)
+    while True:
+        chunk = chunks.next()
+        if chunk is None:
+            return
+        start, length = chunk
+        if start >= size:
+            chunks.eof(start)
+        else:
+            chunks.received(start, length, length)
+
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+
+@defer.inlineCallbacks
+def transfer(size):
+    server = SSHServer()
+    server.protocol = ServerProtocol
+    port = reactor.listenTCP(0, server, interface='127.0.0.1')
+    client = SSHClient({'hostname': '127.0.0.1',
+                        'port': port.getHost().port,
+                        'user': getpass.getuser(),
+                        'password': 'bench',
+                        'buffersize': BUFSIZE,
+                        'windowsize': 16 * 1024 * 1024})
+    client.connect()
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, 'source')
+    destination = os.path.join(tmp, 'destination')
+    with open(source, 'wb') as f:
+        f.truncate(size)
+    try:
+        yield client.ls(tmp)
+        for method in ('get', 'put'):
+            start = time.time()
+            yield getattr(client, method)(source, destination)
+            elapsed = time.time() - start
+            assert os.path.getsize(destination) == size
+            os.remove(destination)
+            print '%-4s %10d %10.2f s %8.2f MB/s' % (
+                method, size / 1024 / 1024, elapsed,
+                size / elapsed / 1024 / 1024)
+    finally:
+        client.disconnect()
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.remove(source)
+        os.rmdir(tmp)
+        yield port.stopListening()
+
+
+@defer.inlineCallbacks
+def main(sizes):
+    try:
+        print '%10s %14s %14s' % ('size (MB)', 'list (s)', 'chunks (s)')
+        for size in sizes:
+            if size <= LIST_LIMIT:
+                old = '%14.3f' % timed(bookkeepList, size)
+            else:
+                old = '%14s' % '-'
+            print '%10d %s %14.3f' % (size / 1024 / 1024, old,
+                                      timed(bookkeepChunks, size))
+        yield transfer(sizes[-1])
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    sizes = [int(a) * 1024 * 1024 for a in sys.argv[1:]] or \
+        [64 * 1024 * 1024, 256 * 1024 * 1024, 4096 * 1024 * 1024]
+    reactor.callWhenRunning(main, sizes)
+    reactor.run()
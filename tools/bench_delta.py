@@ -0,0 +1,88 @@
+#!/usr/local/bin/python
+'''Benchmark delta transfers of a file that changed slightly.
+
+Uses the delaying proxy from bench_window.py.  The destination starts as a
+copy of the source; then percent of the source is rewritten in place in
+scattered 4KB pieces and get()/put() are timed against getDelta() and
+putDelta().
+
+    PYTHONPATH=.:sshclient:tools python tools/bench_delta.py [rtt-ms] [size-MB] [percent]
+'''
+import getpass
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor, defer
+from twisted.internet.task import deferLater
+
+from sshclient import SSHClient
+from bench_window import listen
+
+
+def change(path, size, percent):
+    'Rewrite percent of the file in 4KB pieces'
+    with open(path, 'r+b') as f:
+        for i in range(int(size * percent / 100 / 4096)):
+            f.seek(random.randrange(size - 4096))
+            f.write(os.urandom(4096))
+
+
+@defer.inlineCallbacks
+def measure(rtt, method, source, destination):
+    serverPort, proxyPort = listen(rtt / 2.0)
+    client = SSHClient({'hostname': '127.0.0.1',
+                        'port': proxyPort.getHost().port,
+                        'user': getpass.getuser(),
+                        'password': 'bench',
+                        'buffersize': 32768,
+                        'windowsize': 16 * 1024 * 1024})
+    client.connect()
+    # Warm up the connection and the sftp session first
+    yield client.ls(os.path.dirname(source))
+    start = time.time()
+    stats = yield getattr(client, method)(source, destination)
+    elapsed = time.time() - start
+    with open(source, 'rb') as s:
+        with open(destination, 'rb') as d:
+            assert s.read() == d.read()
+    client.disconnect()
+    yield deferLater(reactor, rtt + 0.1, lambda: None)
+    yield proxyPort.stopListening()
+    yield serverPort.stopListening()
+    defer.returnValue((elapsed, stats))
+
+
+@defer.inlineCallbacks
+def main(rtt, size, percent):
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, 'source')
+    destination = os.path.join(tmp, 'destination')
+    old = os.path.join(tmp, 'old')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(size))
+    shutil.copy(source, old)
+    change(source, size, percent)
+    print 'rtt %i ms, %i MB, %i%% changed' % (rtt * 1000, size / 1024 / 1024,
+                                             percent)
+    try:
+        for method in ('get', 'getDelta', 'put', 'putDelta'):
+            shutil.copy(old, destination)
+            elapsed, stats = yield measure(rtt, method, source, destination)
+            sent = stats['sent'] if stats else size
+            print '%-9s %8.2f s %8.2f MB sent' % (method, elapsed,
+                                                  sent / 1024.0 / 1024)
+    finally:
+        shutil.rmtree(tmp)
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    rtt = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+    size = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else 32 * 1024 * 1024
+    percent = float(sys.argv[3]) if len(sys.argv) > 3 else 3
+    reactor.callWhenRunning(main, rtt, size, percent)
+    reactor.run()
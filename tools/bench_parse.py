@@ -0,0 +1,105 @@
+#!/usr/local/bin/python
+'''Benchmark parsing command output after close against parsing it as it
+arrives.
+
+Feeds ps-like output in 32KB packets, the way CommandChannel receives it,
+and parses it into records with TableParser:
+
+    after close  buffer the output, then splitlines() and parse every line
+    incremental  feed each packet to the parser (run(..., parser=...))
+    drained      as incremental, but records() is emptied every packet,
+                 as a caller aggregating the records would
+
+Each run happens in its own process so peak memory can be compared.
+Sizes are given in MB.
+
+    PYTHONPATH=. python tools/bench_parse.py 10 50 200
+'''
+import resource
+import subprocess
+import sys
+import time
+
+from sshclient.channel import OutputBuffer
+from sshclient.parsers import TableParser
+
+PACKET = 32768
+
+HEADER = '  PID  PPID   RSS COMMAND\n'
+ROW = '%5d %5d %5d /usr/sbin/daemon --config /etc/daemon/%d.conf\n'
+
+
+def packets(size):
+    'Yield size bytes of ps output in packets that split lines'
+    block = HEADER + ''.join(ROW % (i, 1, i % 4096, i)
+                             for i in range(1, 20000))
+    rows = block[len(HEADER):]
+    cycle = block + rows * (PACKET / len(rows) + 2)
+    sent = 0
+    offset = 0
+    while sent < size:
+        yield cycle[offset:offset + PACKET]
+        sent += PACKET
+        offset += PACKET
+        if offset >= len(block):
+            offset -= len(rows)
+
+
+def afterClose(size):
+    data = OutputBuffer()
+    for packet in packets(size):
+        data.write(packet)
+    parser = TableParser()
+    return [r for r in map(parser.parseLine, data.getvalue().splitlines())
+            if r is not None]
+
+
+def incremental(size):
+    parser = TableParser()
+    for packet in packets(size):
+        parser.feed(packet)
+    parser.finish()
+    return parser.records()
+
+
+def drained(size):
+    parser = TableParser()
+    rss = 0
+    for packet in packets(size):
+        parser.feed(packet)
+        for record in parser.records():
+            rss += int(record['RSS'])
+    parser.finish()
+    return parser.records()
+
+
+MODES = {'after close': afterClose,
+         'incremental': incremental,
+         'drained': drained}
+
+
+def child(mode, size):
+    start = time.time()
+    MODES[mode](size)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print elapsed, peak
+
+
+def main(sizes):
+    print '%10s %-12s %10s %14s' % ('size (MB)', 'mode', 'time (s)',
+                                    'peak RSS (MB)')
+    for size in sizes:
+        for mode in ('after close', 'incremental', 'drained'):
+            out = subprocess.check_output([sys.executable, __file__,
+                                           '--child', mode, str(size)])
+            elapsed, peak = out.split()
+            print '%10d %-12s %10.2f %14.1f' % (size, mode, float(elapsed),
+                                                int(peak) / 1024.0)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], int(sys.argv[3]) * 1024 * 1024)
+    else:
+        main([int(a) for a in sys.argv[1:]] or [10, 50, 200])
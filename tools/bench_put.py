@@ -0,0 +1,81 @@
+#!/usr/local/bin/python
+'''Benchmark uploading generated files from memory against temp files.
+
+Puts count small files through the unit test SSH server, first the old way
+(write a local temporary file, put() it, remove it) then with putBytes()
+and putFromProducer().  Files go out one after another, as a config push
+would write them.
+
+    PYTHONPATH=.:sshclient python tools/bench_put.py [count] [size-KB]
+'''
+import getpass
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+from twisted.internet import reactor, defer
+from twisted.web.client import FileBodyProducer
+
+from sshclient import SSHClient
+from sshclient.test.test_common import SSHServer, ServerProtocol
+
+
+@defer.inlineCallbacks
+def tempFile(client, data, destination):
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, data)
+        os.close(fd)
+        yield client.put(path, destination)
+    finally:
+        os.remove(path)
+
+
+def putBytes(client, data, destination):
+    return client.putBytes(data, destination)
+
+
+def putFromProducer(client, data, destination):
+    return client.putFromProducer(FileBodyProducer(StringIO(data)),
+                                  destination)
+
+
+@defer.inlineCallbacks
+def main(count, size):
+    server = SSHServer()
+    server.protocol = ServerProtocol
+    port = reactor.listenTCP(0, server, interface='127.0.0.1')
+    client = SSHClient({'hostname': '127.0.0.1',
+                        'port': port.getHost().port,
+                        'user': getpass.getuser(),
+                        'password': 'bench'})
+    client.connect()
+    tmp = tempfile.mkdtemp()
+    files = [('# generated %i\n' % i) + 'x' * size for i in range(count)]
+    print '%i files of %i KB' % (count, size / 1024)
+    try:
+        yield client.ls(tmp)
+        for name, put in (('temp file', tempFile),
+                          ('putBytes', putBytes),
+                          ('putFromProducer', putFromProducer)):
+            start = time.time()
+            for i, data in enumerate(files):
+                yield put(client, data, os.path.join(tmp, str(i)))
+            elapsed = time.time() - start
+            print '%-16s %8.2f s %8.2f ms/file' % (name, elapsed,
+                                                   elapsed * 1000 / count)
+    finally:
+        client.disconnect()
+        shutil.rmtree(tmp)
+        yield port.stopListening()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 4096
+    reactor.callWhenRunning(main, count, size)
+    reactor.run()
@@ -0,0 +1,75 @@
+#!/usr/local/bin/python
+'''Benchmark SFTP transfers over a slow link.
+
+Uses the delaying proxy from bench_window.py and times get() and put() of a
+file with one outstanding request (the old behaviour) against the default
+pipeline.
+
+    PYTHONPATH=.:sshclient:tools python tools/bench_sftp.py [rtt-ms] [size-MB]
+'''
+import getpass
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor, defer
+from twisted.internet.task import deferLater
+
+from sshclient import SSHClient
+from bench_window import listen
+
+
+@defer.inlineCallbacks
+def measure(rtt, method, source, destination, **options):
+    serverPort, proxyPort = listen(rtt / 2.0)
+    options.update({'hostname': '127.0.0.1',
+                    'port': proxyPort.getHost().port,
+                    'user': getpass.getuser(),
+                    'password': 'bench',
+                    'buffersize': 32768,
+                    'windowsize': 16 * 1024 * 1024})
+    client = SSHClient(options)
+    client.connect()
+    # Warm up the connection and the sftp session first
+    yield client.ls(os.path.dirname(source))
+    start = time.time()
+    yield getattr(client, method)(source, destination)
+    elapsed = time.time() - start
+    assert os.path.getsize(destination) == os.path.getsize(source)
+    client.disconnect()
+    yield deferLater(reactor, rtt + 0.1, lambda: None)
+    yield proxyPort.stopListening()
+    yield serverPort.stopListening()
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def main(rtt, size):
+    runs = [('sftprequests 1', {'sftprequests': 1}),
+            ('sftprequests 64', {})]
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, 'source')
+    destination = os.path.join(tmp, 'destination')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(size))
+    print 'rtt %i ms, %i MB' % (rtt * 1000, size / 1024 / 1024)
+    try:
+        for method in ('get', 'put'):
+            for name, options in runs:
+                elapsed = yield measure(rtt, method, source, destination,
+                                        **options)
+                print '%-4s %-16s %8.2f s %8.2f MB/s' % (
+                    method, name, elapsed, size / elapsed / 1024 / 1024)
+                os.remove(destination)
+    finally:
+        os.remove(source)
+        os.rmdir(tmp)
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    rtt = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+    size = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else 16 * 1024 * 1024
+    reactor.callWhenRunning(main, rtt, size)
+    reactor.run()
@@ -0,0 +1,120 @@
+#!/usr/local/bin/python
+'''Benchmark channel window sizes against the test server over a slow link.
+
+Starts the unit test SSH server behind a local TCP proxy that delays every
+packet by half the given round trip time, then times a large command
+output with the default window, a fixed larger window and auto-tuning.
+
+    PYTHONPATH=.:sshclient python tools/bench_window.py [rtt-ms] [size-MB]
+'''
+import getpass
+import sys
+import time
+
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.task import deferLater
+
+from sshclient import SSHClient
+from sshclient.test.test_common import SSHServer, ServerProtocol
+
+
+class DelayedRelay(protocol.Protocol):
+    'One side of the proxy, forwarding data to its peer after a delay'
+
+    def __init__(self, delay, peer=None):
+        self.delay = delay
+        self.peer = peer
+
+    def dataReceived(self, data):
+        reactor.callLater(self.delay, self._forward, data)
+
+    def _forward(self, data):
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.write(data)
+
+    def connectionLost(self, reason):
+        if self.peer is not None and self.peer.transport is not None:
+            reactor.callLater(self.delay, self.peer.transport.loseConnection)
+
+
+class InboundRelay(DelayedRelay):
+    'The client side of the proxy; connects out to the real server'
+
+    def connectionMade(self):
+        self.transport.pauseProducing()
+        client = protocol.ClientCreator(reactor, DelayedRelay, self.delay,
+                                        self)
+        d = client.connectTCP('127.0.0.1', self.factory.serverPort)
+        d.addCallback(self._cbConnected)
+
+    def _cbConnected(self, peer):
+        self.peer = peer
+        self.transport.resumeProducing()
+
+
+class DelayedProxy(protocol.ServerFactory):
+    def __init__(self, serverPort, delay):
+        self.serverPort = serverPort
+        self.delay = delay
+
+    def buildProtocol(self, addr):
+        p = InboundRelay(self.delay)
+        p.factory = self
+        return p
+
+
+def listen(delay):
+    'Start a test server behind a delaying proxy; returns the proxy port'
+    # The test server only serves one connection, so use one per run.
+    server = SSHServer()
+    server.protocol = ServerProtocol
+    serverPort = reactor.listenTCP(0, server, interface='127.0.0.1')
+    proxyPort = reactor.listenTCP(0, DelayedProxy(serverPort.getHost().port,
+                                                  delay),
+                                  interface='127.0.0.1')
+    return serverPort, proxyPort
+
+
+@defer.inlineCallbacks
+def measure(rtt, size, **options):
+    serverPort, proxyPort = listen(rtt / 2.0)
+    options.update({'hostname': '127.0.0.1',
+                    'port': proxyPort.getHost().port,
+                    'user': getpass.getuser(),
+                    'password': 'bench',
+                    'buffersize': 32768})
+    client = SSHClient(options)
+    client.connect()
+    # Warm up the connection (and the rtt estimate) first
+    yield client.run('true')
+    start = time.time()
+    result = yield client.run('head -c %d /dev/zero' % size)
+    elapsed = time.time() - start
+    assert len(result.output) == size
+    client.disconnect()
+    yield deferLater(reactor, rtt + 0.1, lambda: None)
+    yield proxyPort.stopListening()
+    yield serverPort.stopListening()
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def main(rtt, size):
+    runs = [('default window', {}),
+            ('windowsize 4MB', {'windowsize': 4 * 1024 * 1024}),
+            ('autotune', {'autotune': True})]
+    print 'rtt %i ms, %i MB' % (rtt * 1000, size / 1024 / 1024)
+    try:
+        for name, options in runs:
+            elapsed = yield measure(rtt, size, **options)
+            print '%-16s %8.2f s %8.2f MB/s' % (name, elapsed,
+                                                size / elapsed / 1024 / 1024)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    rtt = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+    size = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else 32 * 1024 * 1024
+    reactor.callWhenRunning(main, rtt, size)
+    reactor.run()